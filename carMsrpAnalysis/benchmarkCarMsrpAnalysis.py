@@ -0,0 +1,540 @@
+# benchmarkCarMsrpAnalysis
+#
+# This script is intended to:
+#	- Generate synthetic data sets like car-features-msrp.csv from 10k to 10M rows, and time each stage of
+#	  carMsrpAnalysis (as reported by its --profile) on them along with its peak memory, saving the results as json
+#	- Compare two sets of those results and flag anything that got slower or hungrier
+#	- Time how long carMsrpAnalysis takes to start up in each mode (--help, --predict) and check it against a budget
+#	- Check that each mode only imports the libraries it needs (e.g. --predict shouldn't load the plotting stack)
+#	- Generate load against --serve and measure its latency and throughput
+#
+# Each run is a fresh python process, so memory is measured per run and the startup timings include the interpreter
+# starting and every import.
+#
+# Written by Geoff Kottmeier
+
+import sys
+import traceback
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import runpy
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "carMsrpAnalysis.py")
+DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), "car-features-msrp.csv")
+
+# Seconds each mode should start (and for --predict, finish scoring predict-me.csv) within, and the libraries it
+# shouldn't be importing at all
+STARTUP_BUDGETS = {'help': 0.5, 'predict': 1.5}
+FORBIDDEN_MODULES = {
+	'help': ['numpy', 'pandas', 'scipy', 'sklearn', 'matplotlib', 'seaborn'],
+	'predict': ['sklearn', 'matplotlib', 'seaborn']}
+
+# Arguments to run carMsrpAnalysis with for each mode of the stage benchmark. {dir} is a directory for its output,
+# {model} a model file trained on the same data and {data} the data set.
+STAGE_MODES = {
+	'exploratory': ['--exploratory', '--charts', '{dir}', '--report', '{dir}/report.json'],
+	'model': ['--model', '--charts', '{dir}', '--model_file', '{model}'],
+	'predict': ['--predict', '--model_file', '{model}', '--predict_file', '{data}', '--predictions', '{dir}/predictions.csv'],
+	'tune': ['--tune', '--model_file', '{dir}/tuned.pkl'],
+	'stream_train': ['--stream_train', '--model_file', '{dir}/streamed.pkl'],
+	'refresh': ['--refresh', '--model_file', '{dir}/refreshed.pkl']}
+
+# ============= ARGUMENTS =============
+parser = argparse.ArgumentParser(description="Benchmark carMsrpAnalysis.")
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+runparser = subparsers.add_parser("run", help="Generate synthetic data sets and time each stage of carMsrpAnalysis on them.")
+runparser.add_argument('--rows','-n', help='Comma separated numbers of rows to generate, e.g. \'10k,1M,10M\'. Default is 10k,100k,1M.', required=False, default='10k,100k,1M')
+runparser.add_argument('--makes', help='Number of different makes in the generated data. Default is 48.', type=int, required=False, default=48)
+runparser.add_argument('--market_categories', help='Number of different market categories in the generated data (each car has up to 3). Default is 12.', type=int, required=False, default=12)
+runparser.add_argument('--modes','-m', help='Comma separated modes to time: ' + ', '.join(STAGE_MODES) + '. Default is exploratory,model,predict.', required=False, default='exploratory,model,predict')
+runparser.add_argument('--seed', help='Random seed for the generated data. Default is 1.', type=int, required=False, default=1)
+runparser.add_argument('--work_dir', help='Where generated data sets are kept. They\'re reused between runs with the same settings. Default is /tmp/carMsrpAnalysisBenchmark.', required=False, default=os.path.join("/tmp", "carMsrpAnalysisBenchmark"))
+runparser.add_argument('--baseline','-b', help='Results json to compare the results against once they\'re done.', required=False)
+runparser.add_argument('--output','-o', help='Path to save the results json to. If not passed, it\'s saved to /tmp/ with a timestamp.', required=False)
+
+compareparser = subparsers.add_parser("compare", help="Compare two stage benchmark results files and flag regressions.")
+compareparser.add_argument('baseline', help='Results json to compare against.')
+compareparser.add_argument('current', help='Results json to check.')
+
+for subparser in (runparser, compareparser):
+	subparser.add_argument('--threshold','-t', help='How much slower or bigger (as a fraction) a measurement can get before it\'s flagged. Default is 0.1.', type=float, required=False, default=0.1)
+	subparser.add_argument('--min_seconds', help='Timings under this many seconds in both runs are too noisy to flag. Default is 0.05.', type=float, required=False, default=0.05)
+
+startupparser = subparsers.add_parser("startup", help="Time how long each mode takes to start, and check it against its budget.")
+startupparser.add_argument('--repeats','-r', help='Number of times to run each mode. The median is checked against the budget. Default is 5.', type=int, required=False, default=5)
+startupparser.add_argument('--budget','-b', help='Budget for a mode in seconds, as MODE=SECONDS (can be passed more than once). Defaults are ' + ', '.join(mode + '=' + str(seconds) for mode, seconds in STARTUP_BUDGETS.items()) + '.', action='append', required=False, default=[])
+startupparser.add_argument('--model_file', help='Model file for --predict to use. If not passed, one is trained first.', required=False)
+startupparser.add_argument('--output','-o', help='Path to save the results json to.', required=False)
+
+loadparser = subparsers.add_parser("load", help="Send concurrent prediction requests to carMsrpAnalysis --serve and measure latency and throughput.")
+loadparser.add_argument('--server', help='URL of a running --serve to send requests to, e.g. http://127.0.0.1:8760. If not passed, one is started (and stopped afterwards).', required=False)
+loadparser.add_argument('--clients','-c', help='Number of clients sending requests at once. Default is 16.', type=int, required=False, default=16)
+loadparser.add_argument('--requests','-n', help='Number of requests each client sends. Default is 200.', type=int, required=False, default=200)
+loadparser.add_argument('--rows', help='Number of cars in each request. Default is 1.', type=int, required=False, default=1)
+loadparser.add_argument('--data', help='CSV to pick the cars sent from. Defaults to car-features-msrp.csv.', required=False, default=DATA)
+loadparser.add_argument('--batch_size', help='--batch_size for the started --serve.', type=int, required=False)
+loadparser.add_argument('--batch_wait', help='--batch_wait for the started --serve.', type=float, required=False)
+loadparser.add_argument('--model_file', help='Model file for the started --serve to use. If not passed, one is trained first.', required=False)
+loadparser.add_argument('--output','-o', help='Path to save the results json to.', required=False)
+
+# used internally, runs carMsrpAnalysis in this process and saves the names of the modules it imported
+modulesparser = subparsers.add_parser("modules")
+modulesparser.add_argument('--save', required=True)
+modulesparser.add_argument('--arguments', required=True, help='json list of arguments to pass to carMsrpAnalysis')
+
+# ============= GENERATION =============
+VEHICLE_STYLES = ['Sedan', '4dr SUV', 'Coupe', 'Convertible', '4dr Hatchback', 'Crew Cab Pickup', 'Extended Cab Pickup', 'Wagon', '2dr Hatchback', 'Passenger Minivan', 'Regular Cab Pickup', '2dr SUV', 'Passenger Van', 'Cargo Van']
+FUEL_TYPES = ['regular unleaded', 'premium unleaded (required)', 'premium unleaded (recommended)', 'flex-fuel (unleaded/E85)', 'diesel', 'electric']
+TRANSMISSION_TYPES = ['AUTOMATIC', 'MANUAL', 'AUTOMATED_MANUAL', 'DIRECT_DRIVE']
+DRIVEN_WHEELS = ['front wheel drive', 'rear wheel drive', 'all wheel drive', 'four wheel drive']
+VEHICLE_SIZES = ['Compact', 'Midsize', 'Large']
+
+# Turns a number of rows like '10k' or '1.5M' into a number
+def parseRows(rows):
+	multipliers = {'K': 1000, 'M': 1000 ** 2}
+	rows = rows.strip().upper()
+	try:
+		if rows[-1:] in multipliers:
+			return int(float(rows[:-1]) * multipliers[rows[-1]])
+		return int(rows)
+	except ValueError:
+		parser.error("Can't read '" + rows + "' as a number of rows")
+
+# Writes a csv of made up cars with the same columns as car-features-msrp.csv, a million rows at a time.
+# Each make has its own price level and popularity, and the MSRP goes up with the year, horsepower and market
+# categories, so the model has something to find.
+def generateCarData(filepath, rows, makes, marketCategories, seed):
+	import numpy as np
+	import pandas as pd
+
+	rng = np.random.default_rng(seed)
+	makenames = np.array(['Make' + str(make).zfill(3) for make in range(makes)])
+	makeprices = rng.lognormal(10.3, 0.5, makes)
+	makepopularity = rng.integers(2, 5700, makes)
+	categorynames = ['Category' + str(category).zfill(3) for category in range(marketCategories)]
+	categoryprices = rng.normal(3000, 2000, marketCategories)
+	# a pool of combinations to pick from, like the real data where most cars share a few common ones.
+	# The last one is for cars without a market category.
+	combinations = [sorted(rng.choice(marketCategories, size=rng.integers(1, min(3, marketCategories) + 1), replace=False)) for combination in range(marketCategories * 4)]
+	combinationnames = np.array([','.join(categorynames[category] for category in combination) for combination in combinations] + [''])
+	combinationprices = np.array([categoryprices[combination].sum() for combination in combinations] + [0.0])
+
+	with open(filepath + '.tmp', 'w', encoding='utf-8', newline='') as f:
+		written = 0
+		while written < rows:
+			count = min(1000000, rows - written)
+			make = rng.integers(0, makes, count)
+			year = rng.integers(1990, 2018, count)
+			hp = np.clip(rng.normal(250, 90, count), 60, 1000).round()
+			# about a third of the cars have no market category, as in the real data
+			combination = rng.integers(0, len(combinations), count) if combinations else np.zeros(count, dtype=int)
+			combination[rng.random(count) < 0.3] = len(combinations)
+			doors = rng.choice([2.0, 3.0, 4.0], count, p=[0.27, 0.03, 0.7])
+			doors[rng.random(count) < 0.001] = np.nan
+			highway = np.clip(rng.normal(27, 6, count) - (hp - 250) / 40, 10, 120).round()
+			msrp = makeprices[make] + (year - 1990) * 900 + (hp - 250) * 110 + combinationprices[combination] + rng.normal(0, 5000, count)
+
+			pd.DataFrame({'Make': makenames[make],
+				'Model': np.char.add('Model', rng.integers(0, 40, count).astype(str)),
+				'Year': year,
+				'Engine Fuel Type': rng.choice(FUEL_TYPES, count),
+				'Engine HP': hp,
+				'Engine Cylinders': np.clip((hp / 55).round(), 3, 16),
+				'Transmission Type': rng.choice(TRANSMISSION_TYPES, count, p=[0.7, 0.24, 0.05, 0.01]),
+				'Driven_Wheels': rng.choice(DRIVEN_WHEELS, count),
+				'Number of Doors': doors,
+				'Market Category': combinationnames[combination],
+				'Vehicle Size': rng.choice(VEHICLE_SIZES, count),
+				'Vehicle Style': rng.choice(VEHICLE_STYLES, count),
+				'highway MPG': highway,
+				'city mpg': (highway * 0.74).round(),
+				'Popularity': makepopularity[make],
+				'MSRP': np.maximum(msrp, 2000).round().astype(int)}).to_csv(f, index=False, header=(written == 0))
+			written += count
+	os.replace(filepath + '.tmp', filepath)
+
+# Generates the data set with a number of rows, unless it's already in the work directory from an earlier run
+def generateCase(args, rows):
+	os.makedirs(args.work_dir, exist_ok=True)
+	filepath = os.path.join(args.work_dir, 'cars-' + str(rows) + '-' + str(args.makes) + 'makes-' + str(args.market_categories) + 'categories-' + str(args.seed) + '.csv')
+	if not os.path.exists(filepath):
+		print("Generating " + str(rows) + " rows...")
+		generateCarData(filepath, rows, args.makes, args.market_categories, args.seed)
+	return filepath
+
+# ============= MEASUREMENT =============
+
+# Arguments to run carMsrpAnalysis with for each mode
+def modeArguments(mode, modelFile, workDir):
+	if mode == 'help':
+		return ['--help']
+	return ['--predict', '--model_file', modelFile, '--predictions', os.path.join(workDir, 'predictions.csv')]
+
+# Trains a model to time --predict with, without showing any of the charts
+def trainModel(modelFile):
+	print("Training a model for --predict...")
+	environment = dict(os.environ, MPLBACKEND='Agg')
+	proc = subprocess.run([sys.executable, SCRIPT, '--model', '--model_file', modelFile], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment, text=True)
+	if proc.returncode != 0:
+		sys.exit("Unable to train a model: " + proc.stderr)
+
+# Runs carMsrpAnalysis once, returning the wall clock time it took
+def timeRun(arguments):
+	start = time.perf_counter()
+	proc = subprocess.run([sys.executable, SCRIPT] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+	elapsed = time.perf_counter() - start
+	if proc.returncode != 0:
+		sys.exit("carMsrpAnalysis " + ' '.join(arguments) + " failed: " + proc.stderr)
+	return elapsed
+
+# Runs any command once, returning the wall clock time it took
+def timeRunCommand(command):
+	start = time.perf_counter()
+	subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return time.perf_counter() - start
+
+# Runs carMsrpAnalysis once in a fresh process, returning the top level names of every module it imported
+def importedModules(arguments, workDir):
+	savefile = os.path.join(workDir, 'modules.json')
+	proc = subprocess.run([sys.executable, os.path.realpath(__file__), 'modules', '--save', savefile, '--arguments', json.dumps(arguments)], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+	if proc.returncode != 0:
+		sys.exit("carMsrpAnalysis " + ' '.join(arguments) + " failed: " + proc.stderr)
+	with open(savefile, 'r', encoding='utf-8') as f:
+		return json.load(f)
+
+# Times each mode, and checks its median time and imports against the budgets.
+# Returns the results and the number of modes that went over their budget.
+def runStartupBenchmark(args, budgets, workDir):
+	# how long python takes to start doing nothing, for comparison
+	baseline = statistics.median(timeRunCommand([sys.executable, '-c', 'pass']) for repeat in range(args.repeats))
+	print("Python on its own: " + '{0:.3f}'.format(baseline) + "s")
+
+	modelFile = args.model_file
+	if 'predict' in budgets and not modelFile:
+		modelFile = os.path.join(workDir, 'model.pkl')
+		trainModel(modelFile)
+
+	results = []
+	failures = 0
+	for mode, budget in budgets.items():
+		arguments = modeArguments(mode, modelFile, workDir)
+		timings = [timeRun(arguments) for repeat in range(args.repeats)]
+		median = statistics.median(timings)
+		forbidden = sorted(set(importedModules(arguments, workDir)) & set(FORBIDDEN_MODULES.get(mode, [])))
+
+		passed = median <= budget and not forbidden
+		failures += not passed
+		results.append({'mode': mode, 'budget_seconds': budget, 'median_seconds': median, 'min_seconds': min(timings), 'timings': timings, 'forbidden_imports': forbidden, 'passed': passed})
+		print('{0:>6}  {1:<8} median {2:.3f}s, min {3:.3f}s, budget {4:.3f}s'.format('ok' if passed else 'OVER', mode, median, min(timings), budget) + (', imported ' + ', '.join(forbidden) if forbidden else ''))
+
+	return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+			'python': sys.version,
+			'platform': platform.platform(),
+			'python_startup_seconds': baseline},
+		'results': results}, failures
+
+# ============= LOAD =============
+
+# Reads the header and rows of a csv as lines of text, so requests can be made up from them without parsing anything
+def readCarLines(dataFile):
+	try:
+		with open(dataFile, 'r', encoding='utf-8') as f:
+			header = f.readline()
+			lines = [line if line.endswith('\n') else line + '\n' for line in f if line.strip()]
+	except OSError as e:
+		sys.exit("Unable to read " + dataFile + ": " + str(e))
+	if not lines:
+		sys.exit(dataFile + " doesn't have any cars in it.")
+	return header, lines
+
+# Picks a free port for the service to listen on
+def freePort():
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+# Starts carMsrpAnalysis --serve, returning the process once it's listening
+def startService(args, modelFile, port):
+	arguments = ['--serve', '--model_file', modelFile, '--port', str(port)]
+	if args.batch_size is not None:
+		arguments += ['--batch_size', str(args.batch_size)]
+	if args.batch_wait is not None:
+		arguments += ['--batch_wait', str(args.batch_wait)]
+	proc = subprocess.Popen([sys.executable, SCRIPT] + arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+	line = proc.stdout.readline()
+	if not line.startswith('Serving'):
+		proc.kill()
+		sys.exit("Unable to start the service: " + line + proc.stdout.read())
+	return proc
+
+# Gets json from the service
+def requestJson(url, method, path, body=None):
+	connection = http.client.HTTPConnection(url.hostname, url.port or 8760, timeout=60)
+	try:
+		connection.request(method, path, body=body, headers={'Content-Type': 'text/csv'} if body else {})
+		response = connection.getresponse()
+		return response.status, json.loads(response.read().decode('utf-8'))
+	finally:
+		connection.close()
+
+# Sends requests of randomly picked cars one after another, adding how long each took to latencies
+def runLoadClient(url, header, lines, args, seed, latencies, failures):
+	rng = random.Random(seed)
+	for request in range(args.requests):
+		body = (header + ''.join(rng.choice(lines) for row in range(args.rows))).encode('utf-8')
+		start = time.perf_counter()
+		try:
+			status, content = requestJson(url, 'POST', '/predict', body)
+		except (OSError, ValueError):
+			status = None
+		elapsed = time.perf_counter() - start
+		if status == 200 and len(content['predictions']) == args.rows:
+			latencies.append(elapsed)
+		else:
+			failures.append(status)
+
+# Runs every client at once against the service and summarizes how it went, along with the service's own stats
+def runLoadBenchmark(args, url):
+	header, lines = readCarLines(args.data)
+	latencies = []
+	failures = []
+	print("Sending " + str(args.clients * args.requests) + " requests of " + str(args.rows) + " rows from " + str(args.clients) + " clients...")
+	clients = [threading.Thread(target=runLoadClient, args=(url, header, lines, args, seed, latencies, failures)) for seed in range(args.clients)]
+	start = time.perf_counter()
+	for client in clients:
+		client.start()
+	for client in clients:
+		client.join()
+	elapsed = time.perf_counter() - start
+
+	latencies.sort()
+	percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+	results = {'clients': args.clients, 'requests': len(latencies) + len(failures), 'rows_per_request': args.rows, 'failures': len(failures),
+		'seconds': elapsed,
+		'requests_per_second': len(latencies) / elapsed,
+		'rows_per_second': len(latencies) * args.rows / elapsed,
+		'latency_ms': {'p50': percentiles[49] * 1000 if percentiles else None,
+			'p99': percentiles[98] * 1000 if percentiles else None,
+			'max': latencies[-1] * 1000 if latencies else None}}
+	print('{0:.1f} requests/s, {1:.1f} rows/s, latency p50 {2:.2f} ms, p99 {3:.2f} ms, {4} failed'.format(results['requests_per_second'], results['rows_per_second'], results['latency_ms']['p50'] or 0, results['latency_ms']['p99'] or 0, len(failures)))
+
+	try:
+		status, results['service'] = requestJson(url, 'GET', '/stats')
+		print("Service averaged " + str(results['service']['rows_per_batch']) + " rows per batch, latency p50 " + str(results['service']['latency_ms']['p50']) + " ms, p99 " + str(results['service']['latency_ms']['p99']) + " ms")
+	except (OSError, ValueError) as e:
+		print("Unable to get the service's stats: " + str(e))
+
+	return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+			'python': sys.version,
+			'platform': platform.platform(),
+			'cpus': os.cpu_count()},
+		'results': results}, len(failures)
+
+# ============= STAGES =============
+
+# Runs carMsrpAnalysis in one mode with --profile, returning its per stage timings and peak memory
+def runStageCase(mode, dataFile, modelFile, workDir):
+	profileFile = os.path.join(workDir, 'profile.json')
+	arguments = [argument.format(dir=workDir, model=modelFile, data=dataFile) for argument in STAGE_MODES[mode]]
+	environment = dict(os.environ, MPLBACKEND='Agg')
+	start = time.perf_counter()
+	proc = subprocess.run([sys.executable, SCRIPT] + arguments + ['--data', dataFile, '--no_cache', '--profile', profileFile], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment, text=True)
+	elapsed = time.perf_counter() - start
+	if proc.returncode != 0:
+		sys.exit("carMsrpAnalysis " + ' '.join(arguments) + " failed: " + proc.stderr)
+	with open(profileFile, 'r', encoding='utf-8') as f:
+		profile = json.load(f)
+
+	# a stage can come up more than once in a run (e.g. plot), so they're added together
+	timings = {}
+	stagememory = {}
+	for stage in profile['stages']:
+		timings[stage['stage']] = timings.get(stage['stage'], 0) + stage['seconds']
+		stagememory[stage['stage']] = stage['peak_memory_kb']
+	return {'timings': timings, 'stage_peak_memory_kb': stagememory, 'peak_memory_kb': profile['peak_memory_kb'], 'seconds': elapsed}
+
+# Runs every mode on every data set size, each in a fresh process, and collects the results
+def runStageBenchmark(args):
+	rowcounts = [parseRows(rows) for rows in args.rows.split(',')]
+	modes = [mode.strip() for mode in args.modes.split(',')]
+	for mode in modes:
+		if mode not in STAGE_MODES:
+			parser.error("Unknown mode '" + mode + "', should be one of " + ', '.join(STAGE_MODES))
+
+	results = []
+	for rows in rowcounts:
+		dataFile = generateCase(args, rows)
+		with tempfile.TemporaryDirectory() as workDir:
+			modelFile = os.path.join(workDir, 'model.pkl')
+			for mode in modes:
+				# predict and refresh need a model, which isn't timed if model isn't one of the modes.
+				# The model hasn't been refreshed before, so refresh times reading every row.
+				if mode in ('predict', 'refresh') and not os.path.exists(modelFile):
+					runStageCase('model', dataFile, modelFile, workDir)
+				if mode == 'refresh':
+					shutil.copyfile(modelFile, os.path.join(workDir, 'refreshed.pkl'))
+
+				print("Running " + mode + " with " + str(rows) + " rows...")
+				result = runStageCase(mode, dataFile, modelFile, workDir)
+				result.update({'rows': rows, 'makes': args.makes, 'market_categories': args.market_categories, 'mode': mode})
+				results.append(result)
+				print("    " + ', '.join(stage + ' ' + '{0:.3f}'.format(seconds) + 's' for stage, seconds in result['timings'].items()) + ', peak memory ' + '{0:.1f}'.format(result['peak_memory_kb'] / 1024) + ' MB')
+
+	return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+			'python': sys.version,
+			'platform': platform.platform(),
+			'cpus': os.cpu_count(),
+			'settings': {'makes': args.makes, 'market_categories': args.market_categories, 'seed': args.seed}},
+		'results': results}
+
+# Compares two sets of stage results, printing every measurement that got worse by more than threshold.
+# Returns the number of regressions found.
+def compareResults(baseline, current, threshold, minSeconds):
+	baselinecases = {(result['rows'], result['makes'], result['market_categories'], result['mode']): result for result in baseline['results']}
+	regressions = 0
+
+	for result in current['results']:
+		key = (result['rows'], result['makes'], result['market_categories'], result['mode'])
+		if key not in baselinecases:
+			print("New case (no baseline): " + key[3] + ", " + str(key[0]) + " rows, " + str(key[1]) + " makes, " + str(key[2]) + " market categories")
+			continue
+		old = baselinecases[key]
+
+		measurements = [(stage, old['timings'].get(stage), seconds, 's') for stage, seconds in result['timings'].items()]
+		measurements.append(('peak_memory', old['peak_memory_kb'] / 1024, result['peak_memory_kb'] / 1024, 'MB'))
+		for name, before, after, unit in measurements:
+			if before is None:
+				continue
+			if unit == 's' and max(before, after) < minSeconds:
+				continue
+			change = (after - before) / before if before else 0
+			if change > threshold:
+				regressions += 1
+			print('{0:>10}  {1:<12} {2:>9} rows  {3:<14} {4:10.3f}{5} -> {6:10.3f}{5} ({7:+.1%})'.format('REGRESSION' if change > threshold else 'ok', key[3], key[0], name, before, unit, after, change))
+
+	return regressions
+
+# Reads a results json, bailing out if it can't be
+def readResults(resultsFile):
+	try:
+		with open(resultsFile, 'r', encoding='utf-8') as f:
+			return json.load(f)
+	except (OSError, ValueError) as e:
+		sys.exit("Unable to read results from " + resultsFile + ": " + str(e))
+
+# Turns the --budget arguments into a dict of mode to seconds, on top of the defaults
+def parseBudgets(budgetArguments):
+	budgets = dict(STARTUP_BUDGETS)
+	for budget in budgetArguments:
+		mode, separator, seconds = budget.partition('=')
+		if not separator or mode not in STARTUP_BUDGETS:
+			parser.error("--budget should be MODE=SECONDS, with MODE one of " + ', '.join(STARTUP_BUDGETS))
+		try:
+			budgets[mode] = float(seconds)
+		except ValueError:
+			parser.error("--budget seconds should be a number, got '" + seconds + "'")
+	return budgets
+
+# ============= EXECUTION =============
+def run():
+	args = parser.parse_args()
+
+	if args.command == 'modules':
+		sys.argv = [SCRIPT] + json.loads(args.arguments)
+		try:
+			runpy.run_path(SCRIPT, run_name='__main__')
+		except SystemExit:
+			pass
+		with open(args.save, 'w', encoding='utf-8') as f:
+			json.dump(sorted({name.split('.')[0] for name in sys.modules}), f)
+		return
+
+	if args.command == 'compare':
+		regressions = compareResults(readResults(args.baseline), readResults(args.current), args.threshold, args.min_seconds)
+		if regressions:
+			sys.exit(str(regressions) + " regressions found.")
+		print("No regressions found.")
+		return
+
+	if args.command == 'run':
+		results = runStageBenchmark(args)
+		outputFile = args.output or os.path.join("/tmp", "carMsrpAnalysis_benchmark_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+		with open(outputFile, 'w', encoding='utf-8') as f:
+			json.dump(results, f, indent=2)
+		print("Benchmark completed. Results saved to '" + outputFile + "'.")
+		if args.baseline:
+			regressions = compareResults(readResults(args.baseline), results, args.threshold, args.min_seconds)
+			if regressions:
+				sys.exit(str(regressions) + " regressions found.")
+			print("No regressions found.")
+		return
+
+	if args.command == 'load':
+		if args.clients < 1 or args.requests < 1 or args.rows < 1:
+			parser.error("--clients, --requests and --rows must be at least 1")
+		with tempfile.TemporaryDirectory() as workDir:
+			service = None
+			if args.server:
+				url = urllib.parse.urlsplit(args.server if '//' in args.server else 'http://' + args.server)
+			else:
+				modelFile = args.model_file
+				if not modelFile:
+					modelFile = os.path.join(workDir, 'model.pkl')
+					trainModel(modelFile)
+				port = freePort()
+				service = startService(args, modelFile, port)
+				url = urllib.parse.urlsplit('http://127.0.0.1:' + str(port))
+			try:
+				results, failures = runLoadBenchmark(args, url)
+			finally:
+				if service:
+					service.terminate()
+					service.wait()
+	else:
+		if args.repeats < 1:
+			parser.error("--repeats must be at least 1")
+		budgets = parseBudgets(args.budget)
+
+		with tempfile.TemporaryDirectory() as workDir:
+			results, failures = runStartupBenchmark(args, budgets, workDir)
+
+	if args.output:
+		with open(args.output, 'w', encoding='utf-8') as f:
+			json.dump(results, f, indent=2)
+		print("Results saved to " + args.output)
+	if args.command == 'load':
+		if failures:
+			sys.exit(str(failures) + " requests failed.")
+		return
+	if failures:
+		sys.exit(str(failures) + " modes over budget.")
+	print("All modes within budget.")
+
+def main():
+	try:
+		run()
+		sys.exit(0)
+	except KeyboardInterrupt:
+		sys.exit('\nUser canceled... Stopping\n')
+	except Exception as e:
+		print('An unexpected error occurred: %s' % str(e), file=sys.stderr)
+		print(traceback.format_exc(), file=sys.stderr)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
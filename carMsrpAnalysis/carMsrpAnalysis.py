@@ -5,40 +5,265 @@
 import sys
 import traceback
 import argparse
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import Ridge
-from sklearn.metrics import mean_squared_error, r2_score
-from sklearn.preprocessing import LabelEncoder
+import concurrent.futures
+import contextlib
+import csv
+import html
+import hashlib
+import http.server
+import importlib
+import io
+import json
+import pickle
+import platform
+import queue
+import statistics
+import threading
+import time
+import urllib.parse
 import os
 from time import gmtime, strftime
 from datetime import datetime
 
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# ============= LIBRARIES =============
+# The data and plotting libraries take seconds to import, and most modes only need some of them (--help none at all),
+# so each one is only imported the first time it's used.
+class LazyModule:
+	def __init__(self, name):
+		self.name = name
+		self.module = None
+
+	def __getattr__(self, attribute):
+		if self.module is None:
+			self.module = importlib.import_module(self.name)
+		return getattr(self.module, attribute)
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+plt = LazyModule('matplotlib.pyplot')
+sns = LazyModule('seaborn')
+sparse = LazyModule('scipy.sparse')
+sklearn = LazyModule('sklearn')
+
+# ============= PROFILING =============
+# With --profile, each stage of a run records how long it took and the peak memory use so far
+profile = {'enabled': False, 'started': None, 'stages': []}
+
+# Peak resident memory of this process (or any worker process it's waited for) so far, in KB
+def peakMemoryKb():
+	if resource is None:
+		return None
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	# macOS reports bytes rather than KB
+	return peak // 1024 if sys.platform == 'darwin' else peak
+
+@contextlib.contextmanager
+def profileStage(name):
+	if not profile['enabled']:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		profile['stages'].append({'stage': name, 'seconds': time.perf_counter() - start, 'peak_memory_kb': peakMemoryKb()})
+
+# Prints how long each stage took, and saves them as json to profileFile if it's passed
+def writeProfile(profileFile=None):
+	results = {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+			'arguments': sys.argv[1:],
+			'python': platform.python_version(),
+			'platform': platform.platform()},
+		'seconds': time.perf_counter() - profile['started'],
+		'peak_memory_kb': peakMemoryKb(),
+		'stages': profile['stages']}
+
+	print('{0:<16} {1:>10} {2:>16}'.format('Stage', 'Seconds', 'Peak memory MB'))
+	for stage in profile['stages']:
+		print('{0:<16} {1:>10.3f} {2:>16}'.format(stage['stage'], stage['seconds'], '{0:.1f}'.format(stage['peak_memory_kb'] / 1024) if stage['peak_memory_kb'] else '-'))
+	print('{0:<16} {1:>10.3f}'.format('Total', results['seconds']))
+
+	if profileFile:
+		try:
+			with open(profileFile, 'w', encoding='utf-8') as f:
+				json.dump(results, f, indent=2)
+		except OSError as e:
+			sys.exit("Unable to write profile: " + str(e))
+		print("Profile saved to " + profileFile)
+
 # ============= ARGUMENTS =============
+# What the exploratory summary is grouped by, summarizes and works out by default, shared with exploreCarData so
+# calling it gives the same report as the command line
+SUMMARY_GROUP_BY = ('Make',)
+SUMMARY_COLUMNS = ('MSRP', 'highway MPG', 'Engine HP')
+SUMMARY_AGGREGATIONS = ('count', 'mean', 'std', 'min', 'p25', 'median', 'p75', 'max')
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--exploratory','-e', help='Runs the exploratory analyis, generating plots and summary info about data.', action="store_true", required=False, default=False)
-parser.add_argument('--model','-m', help='Generate and test a model.', action="store_true", required=False, default=False)
-parser.add_argument('--predict','-p', help='Prompt the user for input to generate a prediction.', action="store_true", required=False, default=False)
+parser.add_argument('--model','-m', help='Generate and test a model, and save it to --model_file.', action="store_true", required=False, default=False)
+parser.add_argument('--predict','-p', help='Predict the MSRP of every row in --predict_file with the model saved in --model_file, and save them to --predictions.', action="store_true", required=False, default=False)
+parser.add_argument('--tune','-t', help='Cross validate the model over every combination of --alphas and --feature_sets, and save the best one to --model_file.', action="store_true", required=False, default=False)
+parser.add_argument('--alphas', help='Ridge alphas to try with --tune. Default is 0.01 0.1 0.5 1 5 10 50.', nargs='+', type=float, required=False, default=[0.01, 0.1, 0.5, 1, 5, 10, 50])
+parser.add_argument('--feature_sets', help='Feature sets to try with --tune, each a comma separated list of columns. \'default\' stands for the columns --model uses. Default is \'default\' and \'default,Engine HP,Engine Cylinders,Engine Fuel Type\'.', nargs='+', required=False, default=['default', 'default,Engine HP,Engine Cylinders,Engine Fuel Type'])
+parser.add_argument('--folds', help='Number of cross validation folds for --tune. Default is 5.', type=int, required=False, default=5)
+parser.add_argument('--tune_results', help='Path to save the score and timing of every --tune combination to, as json.', required=False)
+parser.add_argument('--stream_train', help='Train a model on --data a chunk of --chunk_size rows at a time, for data sets too big to load at once, and save it to --model_file.', action="store_true", required=False, default=False)
+parser.add_argument('--holdout', help='Fraction of rows held out from --stream_train to score the model with. Default is 0.1.', type=float, required=False, default=0.1)
+parser.add_argument('--epochs', help='Number of passes --stream_train makes over the data. Default is 1.', type=int, required=False, default=1)
+parser.add_argument('--sgd_alpha', help='Regularization strength for --stream_train. Default is 0.0001.', type=float, required=False, default=0.0001)
+parser.add_argument('--refresh', help='Update the model in --model_file with just the rows appended to --data since it was last refreshed, and save it back. The first refresh of a model reads every row.', action="store_true", required=False, default=False)
+parser.add_argument('--verify_refresh', help='With --refresh, also refit on every row of --data and check the refreshed model matches.', action="store_true", required=False, default=False)
+parser.add_argument('--data', help='CSV of cars to analyse and train on. Defaults to car-features-msrp.csv next to this script.', required=False, default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "car-features-msrp.csv"))
+parser.add_argument('--model_file', help='Path the model is saved to by --model, --tune or --stream_train, updated by --refresh, and loaded from by --predict and --serve. Defaults to msrp-model.pkl next to this script.', required=False, default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "msrp-model.pkl"))
+parser.add_argument('--predict_file', help='CSV of cars to predict the MSRP of, with the same columns as car-features-msrp.csv (MSRP can be left empty). Defaults to predict-me.csv next to this script.', required=False, default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "predict-me.csv"))
+parser.add_argument('--predictions', help='Path to save the predictions to, as a csv of Make, Model, Year and Predicted MSRP. Defaults to a timestamped file in /tmp/.', required=False)
+parser.add_argument('--chunk_size', help='Number of rows read at a time by --predict, --stream_train and --refresh. Default is 100000.', type=int, required=False, default=100000)
+parser.add_argument('--serve', help='Load the model saved in --model_file and predict the MSRP of cars posted to http://127.0.0.1:PORT/predict (as a csv like --predict_file) until stopped. GET /stats reports latency and throughput.', action="store_true", required=False, default=False)
+parser.add_argument('--port', help='Port for --serve to listen on, on 127.0.0.1. Default is 8760.', type=int, required=False, default=8760)
+parser.add_argument('--batch_size', help='Most rows --serve predicts in one batch. Default is 256.', type=int, required=False, default=256)
+parser.add_argument('--batch_wait', help='Milliseconds --serve waits for more requests to batch with the first one. Default is 2.', type=float, required=False, default=2.0)
+parser.add_argument('--profile', help='Print how long each stage of the run took and the peak memory use after it. If a FILE is passed, the timings are also saved to it as json.', nargs='?', const='', metavar='FILE', required=False)
 parser.add_argument('--verbose','-v', help='For debugging', action="store_true", required=False, default=False)
+parser.add_argument('--group_by', help='Columns to group the exploratory summary statistics by. Defaults to Make.', nargs='+', required=False, default=list(SUMMARY_GROUP_BY))
+parser.add_argument('--summary_columns', help='Columns to summarize for each group in the exploratory analysis. Defaults to MSRP, highway MPG and Engine HP.', nargs='+', required=False, default=list(SUMMARY_COLUMNS))
+parser.add_argument('--statistics', help='Statistics to calculate for each group: count, sum, mean, std, min, median, max, or a percentile like p25. Defaults to the same as pandas describe().', nargs='+', required=False, default=list(SUMMARY_AGGREGATIONS))
+parser.add_argument('--report', help='Path to save the grouped summary statistics from the exploratory analysis to, as .csv, .json or .md (markdown). If not passed, they\'re printed.', required=False)
+parser.add_argument('--charts', help='Directory to save the charts to as files (with an index.html showing them all), instead of showing them. Works without a display.', required=False)
+parser.add_argument('--chart_format', help='File formats to save --charts as. Default is png.', nargs='+', choices=['png', 'svg'], required=False, default=['png'])
+parser.add_argument('--workers','-j', help='Number of processes rendering --charts or cross validating with --tune at once. Defaults to the number of CPUs.', type=int, required=False, default=os.cpu_count())
+parser.add_argument('--max_points', help='Largest number of rows plotted as individual points in the strip and scatter plots saved with --charts. Bigger data sets are randomly sampled down to it. 0 plots every row. Default is 5000. The charts shown on screen always plot every row.', type=int, required=False, default=5000)
+parser.add_argument('--cache_dir', help='Directory to keep the compact binary copy of the data set in, so it doesn\'t have to be parsed from csv every run. Defaults to ~/.cache/carMsrpAnalysis.', required=False, default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "carMsrpAnalysis"))
+parser.add_argument('--no_cache', help='Always parse the data set from the csv, without reading or writing the cache.', action="store_true", required=False, default=False)
 
 # ============= FILE INTERACTION =============
-def loadCsv():
-	filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"car-features-msrp.csv")
-	df = pd.read_csv(filepath)
+# String columns are kept as categoricals, which the cache stores as integer codes plus the list of values
+CATEGORICAL_COLUMNS = ['Make', 'Model', 'Engine Fuel Type', 'Transmission Type', 'Driven_Wheels', 'Market Category', 'Vehicle Size', 'Vehicle Style']
+DATASET_CACHE_FORMAT = 1
 
-	# Make sure thevalues are of expected types
-	df['MSRP'] = df['MSRP'].astype(int)
-	if not isinstance(df['Market Category'], list):
-		df['Market Category'] = df['Market Category'].str.split(',')
-	df['Engine Fuel Type'] = df['Engine Fuel Type'].astype(str)
+# Loads the data set. Market Category is left as the comma separated combination of categories for each row.
+# If cacheDir is passed, a compact binary copy of it is kept there and used instead of the csv
+# for as long as the csv hasn't changed.
+def loadCsv(filepath=None, cacheDir=None):
+	if filepath is None:
+		filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"car-features-msrp.csv")
 
+	df = loadDatasetCache(filepath, cacheDir) if cacheDir else None
+	if df is None:
+		df = pd.read_csv(filepath, dtype={column: 'category' for column in CATEGORICAL_COLUMNS if column != 'Engine Fuel Type'})
+
+		# Make sure thevalues are of expected types
+		df['MSRP'] = df['MSRP'].astype(int)
+		df['Engine Fuel Type'] = df['Engine Fuel Type'].astype(str).astype('category')
+		df = compactColumns(df)
+
+		if cacheDir:
+			writeDatasetCache(df, filepath, cacheDir)
+
+	return df
+
+# Downcasts the numeric columns to the smallest types that hold their values
+def compactColumns(df):
+	for column in df.columns:
+		if pd.api.types.is_integer_dtype(df[column].dtype):
+			df[column] = pd.to_numeric(df[column], downcast='integer')
+		elif pd.api.types.is_float_dtype(df[column].dtype):
+			df[column] = pd.to_numeric(df[column], downcast='float')
 	return df
 
+def datasetCachePaths(filepath, cacheDir):
+	name = hashlib.sha256(os.path.realpath(filepath).encode('utf-8')).hexdigest()[:32]
+	return os.path.join(cacheDir, name + '.npz'), os.path.join(cacheDir, name + '.json')
+
+def fileHash(filepath):
+	digest = hashlib.sha256()
+	with open(filepath, 'rb') as f:
+		for block in iter(lambda: f.read(1024 * 1024), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+# Loads the cached copy of a csv, or returns None if there isn't one or the csv has changed since it was made.
+# A csv with a new modified time is only treated as changed if its contents hash differently.
+def loadDatasetCache(filepath, cacheDir):
+	cachefile, metafile = datasetCachePaths(filepath, cacheDir)
+	try:
+		with open(metafile, 'r', encoding='utf-8') as f:
+			meta = json.load(f)
+		stat = os.stat(filepath)
+	except (OSError, ValueError):
+		verboseprint("No cached copy of " + filepath)
+		return None
+
+	if meta.get('format') != DATASET_CACHE_FORMAT or meta['size'] != stat.st_size:
+		verboseprint("Cached copy of " + filepath + " is out of date")
+		return None
+	if meta['mtime'] != stat.st_mtime_ns:
+		if meta['sha256'] != fileHash(filepath):
+			verboseprint("Cached copy of " + filepath + " is out of date")
+			return None
+		meta['mtime'] = stat.st_mtime_ns
+		try:
+			writeDatasetCacheMeta(metafile, meta)
+		except OSError:
+			pass
+
+	try:
+		with np.load(cachefile, allow_pickle=False) as cache:
+			columns = {}
+			for index, column in enumerate(meta['columns']):
+				if column['categorical']:
+					columns[column['name']] = pd.Categorical.from_codes(cache[str(index) + '_codes'], cache[str(index) + '_categories'])
+				else:
+					columns[column['name']] = cache[str(index)]
+	except (OSError, ValueError, KeyError) as e:
+		verboseprint("Unable to read cached copy of " + filepath + ": " + str(e))
+		return None
+
+	verboseprint("Loaded cached copy of " + filepath)
+	return pd.DataFrame(columns)
+
+# Saves a compact copy of the data set (before the market categories are split) as a numpy archive, with a json file
+# next to it recording which version of the csv it came from
+def writeDatasetCache(df, filepath, cacheDir):
+	cachefile, metafile = datasetCachePaths(filepath, cacheDir)
+	arrays = {}
+	columns = []
+	for index, column in enumerate(df.columns):
+		categorical = isinstance(df[column].dtype, pd.CategoricalDtype)
+		if categorical:
+			arrays[str(index) + '_codes'] = df[column].cat.codes.to_numpy()
+			arrays[str(index) + '_categories'] = df[column].cat.categories.to_numpy(dtype=str)
+		else:
+			arrays[str(index)] = df[column].to_numpy()
+		columns.append({'name': column, 'categorical': categorical})
+
+	stat = os.stat(filepath)
+	meta = {'format': DATASET_CACHE_FORMAT, 'source': os.path.realpath(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': fileHash(filepath), 'columns': columns}
+	try:
+		os.makedirs(cacheDir, exist_ok=True)
+		with open(cachefile + '.tmp', 'wb') as f:
+			np.savez(f, **arrays)
+		os.replace(cachefile + '.tmp', cachefile)
+		writeDatasetCacheMeta(metafile, meta)
+		verboseprint("Saved cached copy of " + filepath + " to " + cachefile)
+	except OSError as e:
+		# the cache is only there to save time, so carry on without it
+		print("Unable to write to the cache: " + str(e))
+
+def writeDatasetCacheMeta(metafile, meta):
+	with open(metafile + '.tmp', 'w', encoding='utf-8') as f:
+		json.dump(meta, f)
+	os.replace(metafile + '.tmp', metafile)
+
 # ============= EXPLORATION =============
-def exploreCarData(df):
+# Statistics that pandas can work out for every group at once. Percentiles (e.g. p25) are also accepted.
+GROUP_STATISTICS = ('count', 'sum', 'mean', 'std', 'min', 'median', 'max')
+
+def exploreCarData(df, groupBy=SUMMARY_GROUP_BY, columns=SUMMARY_COLUMNS, aggregations=SUMMARY_AGGREGATIONS, reportFile=None):
 	verboseprint("Commencing exploring!")
 
 	print("\n\nData set head:")
@@ -50,101 +275,321 @@ def exploreCarData(df):
 	print("\n\nSummary statistics for each column of data:")
 	print(df.describe().apply(lambda x: x.apply('{0:.5f}'.format)))
 
-	print("\n\nSummary statistics for MSRP, MPG, and Horsepower by Make:")
-	for make in df['Make'].unique():
-
-		print("========  " + make + "  ========")
-		for column in ['MSRP','highway MPG','Engine HP']:
-			print("*** " + column + " ***")
-			print(df[df['Make'] == make][column].describe())
-			print()
+	summary = groupedStatistics(df, groupBy, columns, aggregations)
+	if reportFile:
+		writeReport(summary, reportFile)
+		print("\n\nSummary statistics for " + ", ".join(columns) + " by " + ", ".join(groupBy) + " saved to " + reportFile)
+	else:
+		print("\n\nSummary statistics for " + ", ".join(columns) + " by " + ", ".join(groupBy) + ":")
+		with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+			print(summary)
 
 	verboseprint("Exploring complete...")
 
-def visualizeCarData(df):
-	verboseprint("Commencing visualizations!")
+# Works out the aggregations (statistics) for each column within each group, with one grouping of the data for all of them.
+# Returns a frame with a row per group and a '<column> <statistic>' column for each combination.
+def groupedStatistics(df, groupBy, columns, aggregations):
+	for column in list(groupBy) + list(columns):
+		if column not in df.columns:
+			sys.exit("Column '" + column + "' isn't in the data set.")
 
-	sns.set(rc = {'figure.figsize':(20,5)})
+	percentiles = {}
+	pandasstatistics = []
+	for statistic in aggregations:
+		if statistic in GROUP_STATISTICS:
+			pandasstatistics.append(statistic)
+		elif statistic[:1] == 'p' and statistic[1:].replace('.', '', 1).isdigit() and 0 <= float(statistic[1:]) <= 100:
+			percentiles[statistic] = float(statistic[1:]) / 100
+		else:
+			sys.exit("Unknown statistic '" + statistic + "', expected one of " + ", ".join(GROUP_STATISTICS) + " or a percentile like p25.")
+
+	grouped = df.groupby(list(groupBy), observed=True, sort=True)[list(columns)]
+	aggregated = grouped.agg(list(dict.fromkeys(pandasstatistics))) if pandasstatistics else None
+	# quantile() works out every percentile of every group in one go, the percentile ends up as the last index level
+	quantiles = grouped.quantile(sorted(set(percentiles.values()))).unstack(-1) if percentiles else None
 
-	sns.boxplot(x='MSRP', data=df)
-	sns.stripplot(x='MSRP', data=df, jitter=True)
+	# keep the columns in the order they were asked for
+	summary = pd.DataFrame({column + ' ' + statistic: quantiles[(column, percentiles[statistic])] if statistic in percentiles else aggregated[(column, statistic)] for column in columns for statistic in aggregations})
+	return summary.reset_index()
+
+# Writes a summary frame as csv, json (a list of rows) or markdown, going by the file extension
+def writeReport(summary, reportFile):
+	extension = os.path.splitext(reportFile)[1].lower()
+	try:
+		if extension == '.csv':
+			summary.to_csv(reportFile, index=False)
+		elif extension == '.json':
+			summary.to_json(reportFile, orient='records', indent=2)
+		elif extension in ('.md', '.markdown'):
+			with open(reportFile, 'w', encoding='utf-8') as f:
+				f.write(markdownTable(summary))
+		else:
+			sys.exit("Report file should end in .csv, .json or .md")
+	except OSError as e:
+		sys.exit("Unable to write report: " + str(e))
+
+def markdownTable(summary):
+	def cell(value):
+		if isinstance(value, float):
+			return '' if np.isnan(value) else '{0:.5f}'.format(value).rstrip('0').rstrip('.')
+		return str(value).replace('|', '\\|')
+
+	lines = ['| ' + ' | '.join(cell(column) for column in summary.columns) + ' |']
+	lines.append('|' + '---|' * len(summary.columns))
+	for row in summary.itertuples(index=False):
+		lines.append('| ' + ' | '.join(cell(value) for value in row) + ' |')
+	return '\n'.join(lines) + '\n'
+
+
+# ============= VISUALIZATION =============
+# Columns the charts use, so only those are handed to the processes rendering them
+CHART_COLUMNS = ['MSRP', 'Make', 'Engine Fuel Type', 'Engine HP', 'highway MPG', 'Engine Cylinders', 'Year']
+
+# Each chart draws onto the current figure from the chart data put together by chartData
+def drawMsrpBoxPlot(data):
+	sns.boxplot(x='MSRP', data=data['df'])
+	sns.stripplot(x='MSRP', data=data['sample'], jitter=True)
 	plt.xlabel("MSRP ($, millions)")
 	plt.title("Box Plot of All MSRPs in Data Set")
-	plt.show()
 
-	plot = sns.violinplot(x='Make', y='MSRP', data=df)
+def drawMsrpByMake(data):
+	plot = sns.violinplot(x='Make', y='MSRP', data=data['df'])
 	plot.set_xticklabels(plot.get_xticklabels(), rotation=90)
 	plt.ylabel("MSRP ($, millions)")
 	plt.title("Violin Plot of MSRP by Make")
-	plt.show()
 
-	plot = sns.violinplot(x='Engine Fuel Type', y='MSRP', data=df)
+def drawMsrpByFuelType(data):
+	plot = sns.violinplot(x='Engine Fuel Type', y='MSRP', data=data['df'])
 	plot.set_xticklabels(plot.get_xticklabels(), rotation=90)
 	plt.ylabel("MSRP ($, millions)")
-	plt.show()
 
-	sns.lmplot(x='Engine HP', y='MSRP', data=df, fit_reg=True,line_kws={'color': 'red'})
+def drawMsrpByHorsepower(data):
+	sns.lmplot(x='Engine HP', y='MSRP', data=data['sample'], fit_reg=True,line_kws={'color': 'red'})
 	plt.ylabel("MSRP ($, millions)")
 	plt.title("MSRP by Engine HP")
-	plt.show()
 
-	df.plot(y='MSRP', x='highway MPG', kind='scatter')
+def drawMsrpByHighwayMpg(data):
+	data['sample'].plot(y='MSRP', x='highway MPG', kind='scatter')
 	plt.ylabel("MSRP ($, millions)")
 	plt.title("MSRP by highway MPG")
-	plt.show()
 
-	sns.violinplot(y='MSRP', x='Engine Cylinders', data=df)
+def drawMsrpByCylinders(data):
+	sns.violinplot(y='MSRP', x='Engine Cylinders', data=data['df'])
 	plt.ylabel("MSRP ($, millions)")
 	plt.title("MSRP by Engine Cylinders")
-	plt.show()
 
-	ax = df.groupby(df['Year'])["MSRP"].mean().plot(kind="line",rot=25)
-	ax = df.groupby(df['Year'])["MSRP"].median().plot(kind="line",rot=25)
+def drawMsrpByYear(data):
+	ax = data['yearly']['mean'].plot(kind="line",rot=25)
+	ax = data['yearly']['median'].plot(kind="line",rot=25)
 	plt.xlabel("Year")
 	plt.ylabel("Average MSRP ($)")
 	plt.legend(["Mean", "Median"])
 	plt.title("Average and Median MSRP by Year")
-	plt.show()
 
-	sns.histplot(df['MSRP' ],bins=100)
+def drawMsrpDistribution(data):
+	sns.histplot(data['df']['MSRP' ],bins=100)
 	plt.xlabel("Averarge MSRP ($, millions)")
 	plt.ylabel("Count")
 	plt.title("Distribution of MSRP")
-	plt.show()
+
+# name (used for the file names), title and drawing function of each chart, in the order they're shown
+CAR_CHARTS = [
+	('msrp-box', "Box Plot of All MSRPs in Data Set", drawMsrpBoxPlot),
+	('msrp-by-make', "Violin Plot of MSRP by Make", drawMsrpByMake),
+	('msrp-by-fuel-type', "Violin Plot of MSRP by Engine Fuel Type", drawMsrpByFuelType),
+	('msrp-by-horsepower', "MSRP by Engine HP", drawMsrpByHorsepower),
+	('msrp-by-highway-mpg', "MSRP by highway MPG", drawMsrpByHighwayMpg),
+	('msrp-by-cylinders', "MSRP by Engine Cylinders", drawMsrpByCylinders),
+	('msrp-by-year', "Average and Median MSRP by Year", drawMsrpByYear),
+	('msrp-distribution', "Distribution of MSRP", drawMsrpDistribution)]
+
+# Puts together what the charts are drawn from: the columns they use, a random sample of at most maxPoints rows
+# for the charts that plot every point (all of them if maxPoints is 0), and the yearly averages
+def chartData(df, maxPoints):
+	chartdf = df[CHART_COLUMNS]
+	sample = chartdf.sample(maxPoints, random_state=42).sort_index() if maxPoints and len(chartdf) > maxPoints else chartdf
+	yearly = chartdf.groupby('Year')['MSRP'].agg(['mean', 'median'])
+	return {'df': chartdf, 'sample': sample, 'yearly': yearly}
+
+# Shows the charts or, if chartDir is passed, saves them there (see renderCharts).
+# Returns the charts saved, or True if they were shown.
+def visualizeCarData(df, chartDir=None, chartFormats=['png'], workers=1, maxPoints=0, verbose=False):
+	verboseprint("Commencing visualizations!")
+
+	data = chartData(df, maxPoints)
+	if len(data['sample']) < len(df):
+		verboseprint("Plotting a sample of " + str(len(data['sample'])) + " of " + str(len(df)) + " rows in the strip and scatter plots")
+
+	if chartDir:
+		rendered = renderCharts(CAR_CHARTS, data, chartDir, chartFormats, workers, verbose)
+		verboseprint("Visualizations complete!")
+		return rendered
+
+	sns.set(rc = {'figure.figsize':(20,5)})
+	for name, title, draw in CAR_CHARTS:
+		draw(data)
+		plt.show()
 
 	verboseprint("Visualizations complete!")
 	return True
 
+# Sets up a process to render charts without a display. The chart data is handed over once per process.
+def chartWorkerSetup(data, verbosestate):
+	global verboseprint, chartdata
+	verboseprint = verbosePrintSetup(verbosestate)
+	chartdata = data
+	import matplotlib
+	matplotlib.use('Agg')
+	sns.set(rc = {'figure.figsize':(20,5)})
+
+# Renders one chart from the chart data in this process to a file for each format.
+# Returns the names of the files written.
+def renderChart(chart):
+	name, title, draw, chartDir, chartFormats = chart
+	verboseprint("Rendering " + name)
+	plt.figure()
+	draw(chartdata)
+	files = []
+	for chartFormat in chartFormats:
+		files.append(name + '.' + chartFormat)
+		plt.gcf().savefig(os.path.join(chartDir, files[-1]), bbox_inches='tight')
+	plt.close('all')
+	return files
+
+# Renders charts to files in chartDir without a display, spread across a pool of worker processes.
+# Returns a list of (name, title, files) for each chart, in the same order as charts.
+def renderCharts(charts, data, chartDir, chartFormats, workers, verbose=False):
+	try:
+		os.makedirs(chartDir, exist_ok=True)
+	except OSError as e:
+		sys.exit("Unable to create chart directory: " + str(e))
+
+	jobs = [(name, title, draw, chartDir, chartFormats) for name, title, draw in charts]
+	if workers == 1 or len(jobs) == 1:
+		chartWorkerSetup(data, verbose)
+		files = [renderChart(job) for job in jobs]
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=chartWorkerSetup, initargs=(data, verbose)) as executor:
+			files = list(executor.map(renderChart, jobs))
+
+	return [(name, title, chartfiles) for (name, title, draw), chartfiles in zip(charts, files)]
+
+# Writes an index.html to chartDir showing every chart rendered, with links to each of its files
+def writeChartIndex(chartDir, rendered):
+	lines = ['<!DOCTYPE html>', '<html>', '<head><meta charset="utf-8"><title>Car MSRP Analysis</title></head>', '<body>', '<h1>Car MSRP Analysis</h1>',
+		'<p>Generated ' + html.escape(datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + '</p>']
+	for name, title, files in rendered:
+		lines.append('<h2>' + html.escape(title) + '</h2>')
+		lines.append('<p><img src="' + html.escape(files[0]) + '" alt="' + html.escape(title) + '" style="max-width: 100%"></p>')
+		lines.append('<p>' + ' | '.join('<a href="' + html.escape(filename) + '">' + html.escape(filename) + '</a>' for filename in files) + '</p>')
+	lines += ['</body>', '</html>']
+
+	indexfile = os.path.join(chartDir, 'index.html')
+	try:
+		with open(indexfile, 'w', encoding='utf-8') as f:
+			f.write('\n'.join(lines) + '\n')
+	except OSError as e:
+		sys.exit("Unable to write chart index: " + str(e))
+	return indexfile
+
 # ============= MODELLING =============
-def preprocessCarData(df):
-	# add an index column
-	df.insert(0, 'index', value=range(len(df)))
+# Columns used as features. Each categorical value and each market category gets its own indicator column.
+NUMERIC_FEATURES = ['Year', 'Number of Doors', 'highway MPG', 'city mpg', 'Popularity']
+CATEGORICAL_FEATURES = ['Make', 'Transmission Type', 'Driven_Wheels', 'Vehicle Size', 'Vehicle Style']
 
-	# Encode string values in data
-	le = LabelEncoder()
-	df['Transmission Type'] = le.fit_transform(df['Transmission Type'])
-	df['Driven_Wheels'] = le.fit_transform(df['Driven_Wheels'])
-	df['Vehicle Size'] = le.fit_transform(df['Vehicle Size'])
-	df['Vehicle Style'] = le.fit_transform(df['Vehicle Style'])
-	df['Engine Fuel Type'] = le.fit_transform(df['Engine Fuel Type'])
-	df['Make'] = le.fit_transform(df['Make'])
+# Learns what's needed to turn the data set into features: the values to fill in for missing numbers,
+# the values seen in each categorical column, and every market category.
+# The encoder is a plain dict so it can be saved alongside a model and reused on new data.
+def fitFeatureEncoder(df, numericColumns=NUMERIC_FEATURES, categoricalColumns=CATEGORICAL_FEATURES, marketCategories=True):
+	encoder = {'numeric': list(numericColumns), 'fill': {}, 'categorical': {}, 'market_categories': None}
 
-	# Create a new DataFrame with boolean columns for each market category
-	df = pd.get_dummies(df.join(pd.Series(df['Market Category'].apply(pd.Series).stack().reset_index(1, drop=True),name='Category1')).drop('Market Category', axis=1).rename(columns={'Category1': 'Market Category'}),columns=['Market Category']).groupby('index', as_index=False).sum()
+	for column in numericColumns:
+		# Assume vehicles with no door count have 4 doors, anything else missing gets the median
+		encoder['fill'][column] = 4.0 if column == 'Number of Doors' else float(df[column].median())
 
-	# Assume vehicles with no door count have 4 doors
-	df['Number of Doors'] = df['Number of Doors'].fillna(4)
+	for column in categoricalColumns:
+		encoder['categorical'][column] = sorted(str(value) for value in df[column].dropna().unique())
 
-	return df
+	if marketCategories:
+		combinations = df['Market Category'].astype('category').cat.categories
+		encoder['market_categories'] = sorted({category for combination in combinations for category in str(combination).split(',')})
+
+	return encoder
+
+# Names of the columns buildFeatureMatrix makes with an encoder, named the same way pandas.get_dummies would
+def featureNames(encoder):
+	names = list(encoder['numeric'])
+	for column, values in encoder['categorical'].items():
+		names += [column + '_' + value for value in values]
+	if encoder['market_categories'] is not None:
+		names += ['Market Category_' + category for category in encoder['market_categories']]
+	return names
+
+# Builds the sparse design matrix for a data frame with a fitted encoder.
+# Values the encoder hasn't seen don't set any indicator.
+def buildFeatureMatrix(df, encoder):
+	rows = len(df)
+	blocks = []
+
+	if encoder['numeric']:
+		numeric = np.column_stack([df[column].fillna(encoder['fill'][column]).to_numpy(dtype=np.float64) for column in encoder['numeric']])
+		# encoders for models trained by gradient descent also scale the numbers to a mean of 0 and standard deviation of 1
+		if encoder.get('standardize'):
+			numeric = (numeric - [encoder['standardize'][column][0] for column in encoder['numeric']]) / [encoder['standardize'][column][1] for column in encoder['numeric']]
+		blocks.append(sparse.csr_matrix(numeric))
+
+	for column, values in encoder['categorical'].items():
+		# values the encoder hasn't seen (and missing ones) get -1
+		codes = pd.Index(values).get_indexer(df[column].astype(str).where(df[column].notna()))
+		blocks.append(indicatorMatrix(codes, len(values)))
+
+	if encoder['market_categories'] is not None:
+		blocks.append(marketCategoryMatrix(df['Market Category'], encoder['market_categories']))
+
+	if not blocks:
+		return sparse.csr_matrix((rows, 0))
+	return sparse.hstack(blocks, format='csr')
 
-def createMsrpModel(df):
-	x = df.drop(['MSRP','Model','Engine Fuel Type','Engine HP','Engine Cylinders','Engine Fuel Type'], axis=1)
-	y = df['MSRP']
+# One hot encodes integer codes (-1 being none of them) straight into a sparse matrix
+def indicatorMatrix(codes, width):
+	rows = np.flatnonzero(codes >= 0)
+	return sparse.csr_matrix((np.ones(len(rows)), (rows, codes[rows])), shape=(len(codes), width))
+
+# Market Category holds several categories per row. Each distinct combination is split once into its indicator
+# columns, and every row picks up the row of its combination
+def marketCategoryMatrix(column, vocabulary):
+	combinations = column.astype('category')
+	position = {category: index for index, category in enumerate(vocabulary)}
+	indicators = [[position[category] for category in str(combination).split(',') if category in position] for combination in combinations.cat.categories]
+
+	# the extra last row is for rows without a market category
+	indptr = np.cumsum([0] + [len(columns) for columns in indicators] + [0])
+	indices = np.array([index for columns in indicators for index in columns], dtype=np.int32)
+	combinationmatrix = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(indicators) + 1, len(vocabulary)))
+
+	codes = combinations.cat.codes.to_numpy()
+	return combinationmatrix[np.where(codes < 0, len(indicators), codes)]
+
+# Turns the data set into the design matrix and MSRPs for the model.
+# An encoder from an earlier fit can be passed to encode new data the same way, otherwise one is fitted to df.
+def preprocessCarData(df, encoder=None):
+	if encoder is None:
+		encoder = fitFeatureEncoder(df)
+	x = buildFeatureMatrix(df, encoder)
+	y = df['MSRP'].to_numpy() if 'MSRP' in df.columns else None
+	return x, y, encoder
+
+# Shows a chart of the predicted MSRPs against the actual ones, unless showChart is False
+def createMsrpModel(x, y, showChart=True):
+	from sklearn.model_selection import train_test_split
+	from sklearn.linear_model import Ridge
+	from sklearn.metrics import mean_squared_error, r2_score
 
 	x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
 
 	rdg = Ridge(alpha = 0.5)
-	rdg.fit(x_train, y_train)
+	with profileStage('fit'):
+		rdg.fit(x_train, y_train)
 	y_pred = rdg.predict(x_test)
 
 	print(rdg.get_params(deep=False))
@@ -155,17 +600,740 @@ def createMsrpModel(df):
 	print("Out of Sample R-squared:", r2)
 
 
-	sns.histplot(y_test,bins=30)
-	sns.histplot(y_pred,bins=30)
+	if showChart:
+		with profileStage('plot'):
+			drawPredictedVsActual({'actual': y_test, 'predicted': y_pred})
+			plt.show()
+
+
+	return rdg, x_test, y_test
+
+
+
+def drawPredictedVsActual(data):
+	sns.histplot(data['actual'],bins=30)
+	sns.histplot(data['predicted'],bins=30)
 	plt.xlabel("MSRP ($, millions)")
 	plt.ylabel("Count")
 	plt.title("Predicted MSRPs vs Actual MSRP for Out of Sample Test Data")
-	plt.show()
 
+# ============= TUNING =============
+# Columns in the 'default' feature set, the same ones --model uses
+DEFAULT_FEATURE_SET = NUMERIC_FEATURES + CATEGORICAL_FEATURES + ['Market Category']
 
-	return rdg, x_test, y_test
+# Turns a feature set like 'default,Engine HP' into an encoder for just those columns, fitted to df
+def featureSetEncoder(df, featureSet):
+	columns = []
+	for column in featureSet.split(','):
+		column = column.strip()
+		for expanded in (DEFAULT_FEATURE_SET if column == 'default' else [column]):
+			if expanded not in df.columns or expanded == 'MSRP':
+				sys.exit("Feature set '" + featureSet + "' has a column that isn't a feature in the data set: '" + expanded + "'")
+			if expanded not in columns:
+				columns.append(expanded)
+
+	numeric = [column for column in columns if column != 'Market Category' and pd.api.types.is_numeric_dtype(df[column].dtype)]
+	categorical = [column for column in columns if column != 'Market Category' and column not in numeric]
+	return fitFeatureEncoder(df, numeric, categorical, 'Market Category' in columns)
+
+# Sets up a tuning worker process. The design matrix for every feature set is built once in the main process and handed
+# over here, so the folds only slice rows out of it.
+def tuningWorkerSetup(matrices, y, folds):
+	global tuningdata
+	tuningdata = {'matrices': matrices, 'y': y, 'folds': folds}
+
+# Trains and scores one alpha and feature set on one fold. Returns the job with its r2, rmse and training time added.
+def scoreTuningJob(job):
+	from sklearn.linear_model import Ridge
+	from sklearn.metrics import mean_squared_error, r2_score
+
+	alpha, featureSet, fold = job
+	x = tuningdata['matrices'][featureSet]
+	y = tuningdata['y']
+	trainrows, testrows = tuningdata['folds'][fold]
+
+	start = time.perf_counter()
+	rdg = Ridge(alpha=alpha).fit(x[trainrows], y[trainrows])
+	seconds = time.perf_counter() - start
+	y_pred = rdg.predict(x[testrows])
+	return {'alpha': alpha, 'feature_set': featureSet, 'fold': fold, 'r2': float(r2_score(y[testrows], y_pred)), 'rmse': float(np.sqrt(mean_squared_error(y[testrows], y_pred))), 'fit_seconds': seconds}
+
+# Runs k-fold cross validation of Ridge over every combination of alphas and feature sets, spread across a pool of
+# worker processes. Prints the mean score and time of each combination, then trains the best one on all of the data.
+# Returns the best model, its encoder, and the results (the scores of every combination and the best one).
+def tuneMsrpModel(df, alphas, featureSets, foldCount, workers):
+	from sklearn.linear_model import Ridge
+	from sklearn.model_selection import KFold
+
+	y = df['MSRP'].to_numpy(dtype=np.float64)
+	encoders = {}
+	matrices = {}
+	for featureSet in featureSets:
+		encoders[featureSet] = featureSetEncoder(df, featureSet)
+		matrices[featureSet] = buildFeatureMatrix(df, encoders[featureSet])
+		verboseprint("Feature set '" + featureSet + "' has " + str(matrices[featureSet].shape[1]) + " features")
+	folds = list(KFold(n_splits=foldCount, shuffle=True, random_state=42).split(np.zeros(len(y))))
+
+	jobs = [(alpha, featureSet, fold) for alpha in alphas for featureSet in featureSets for fold in range(foldCount)]
+	start = time.perf_counter()
+	if workers == 1:
+		tuningWorkerSetup(matrices, y, folds)
+		scores = [scoreTuningJob(job) for job in jobs]
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=tuningWorkerSetup, initargs=(matrices, y, folds)) as executor:
+			scores = list(executor.map(scoreTuningJob, jobs))
+	verboseprint("Cross validation took " + '{0:.2f}'.format(time.perf_counter() - start) + " seconds")
+
+	configurations = []
+	for alpha in alphas:
+		for featureSet in featureSets:
+			foldscores = [score for score in scores if score['alpha'] == alpha and score['feature_set'] == featureSet]
+			configurations.append({'alpha': alpha, 'feature_set': featureSet, 'features': matrices[featureSet].shape[1],
+				'mean_r2': float(np.mean([score['r2'] for score in foldscores])),
+				'std_r2': float(np.std([score['r2'] for score in foldscores])),
+				'mean_rmse': float(np.mean([score['rmse'] for score in foldscores])),
+				'fit_seconds': float(sum(score['fit_seconds'] for score in foldscores)),
+				'folds': foldscores})
+
+	print("\n" + '{0:>10}  {1:>8}  {2:>9}  {3:>8}  {4:>12}  {5:>9}  {6}'.format('alpha', 'features', 'mean r2', 'std r2', 'mean rmse', 'fit time', 'feature set'))
+	for configuration in sorted(configurations, key=lambda configuration: -configuration['mean_r2']):
+		print('{0:>10g}  {1:>8}  {2:>9.5f}  {3:>8.5f}  {4:>12.2f}  {5:>8.2f}s  {6}'.format(configuration['alpha'], configuration['features'], configuration['mean_r2'], configuration['std_r2'], configuration['mean_rmse'], configuration['fit_seconds'], configuration['feature_set']))
+
+	best = max(configurations, key=lambda configuration: configuration['mean_r2'])
+	print("\nBest: alpha " + '{0:g}'.format(best['alpha']) + " with feature set '" + best['feature_set'] + "', mean r2 " + '{0:.5f}'.format(best['mean_r2']))
+	model = Ridge(alpha=best['alpha']).fit(matrices[best['feature_set']], y)
+
+	return model, encoders[best['feature_set']], {'folds': foldCount, 'configurations': configurations, 'best': {key: best[key] for key in ('alpha', 'feature_set', 'mean_r2', 'std_r2', 'mean_rmse')}}
+
+# ============= STREAMING TRAINING =============
+# For data sets too big to load at once. Everything is done a chunk of rows at a time: one pass over the csv learns the
+# encoder, then each epoch trains an SGDRegressor on the chunks with partial_fit, and a last pass scores the held out rows.
+
+# Reads the columns needed for the default features (and MSRP) from a csv a chunk at a time
+def readTrainingChunks(filepath, chunkSize):
+	usecols = DEFAULT_FEATURE_SET + ['MSRP']
+	try:
+		for chunk in pd.read_csv(filepath, usecols=usecols, dtype={column: str for column in CATEGORICAL_COLUMNS if column in usecols}, chunksize=chunkSize):
+			yield chunk.dropna(subset=['MSRP'])
+	except FileNotFoundError:
+		sys.exit("Data file '" + filepath + "' not found.")
+	except ValueError as e:
+		sys.exit("Unable to read data file: " + str(e))
+
+# Picks the rows held out from training by their position in the file, the same ones every pass
+def heldOutRows(firstRow, count, holdout):
+	rownumbers = np.arange(firstRow, firstRow + count, dtype=np.uint64)
+	return (rownumbers * np.uint64(2654435761) % np.uint64(2 ** 32)) < np.uint64(holdout * 2 ** 32)
+
+# Learns the encoder from one pass over the csv, keeping only running totals and the distinct values of each column.
+# Missing numbers are filled with the mean rather than the median, which would need every value at once.
+# Returns the encoder and the mean and standard deviation of MSRP.
+def fitStreamingEncoder(filepath, chunkSize):
+	totals = {column: [0, 0.0, 0.0] for column in NUMERIC_FEATURES + ['MSRP']}
+	values = {column: set() for column in CATEGORICAL_FEATURES}
+	marketcategories = set()
+
+	for chunk in readTrainingChunks(filepath, chunkSize):
+		for column, total in totals.items():
+			present = chunk[column].dropna().to_numpy(dtype=np.float64)
+			total[0] += len(present)
+			total[1] += present.sum()
+			total[2] += (present ** 2).sum()
+		for column, seen in values.items():
+			seen.update(chunk[column].dropna().unique())
+		for combination in chunk['Market Category'].dropna().unique():
+			marketcategories.update(combination.split(','))
+
+	if not totals['MSRP'][0]:
+		sys.exit("Data file '" + filepath + "' doesn't have any rows with an MSRP.")
+	standardize = {}
+	for column, (count, total, squares) in totals.items():
+		mean = total / count if count else 0.0
+		std = np.sqrt(max(squares / count - mean ** 2, 0.0)) if count else 0.0
+		standardize[column] = [float(mean), float(std) or 1.0]
+
+	encoder = {'numeric': list(NUMERIC_FEATURES), 'fill': {}, 'categorical': {}, 'market_categories': sorted(marketcategories),
+		'standardize': {column: standardize[column] for column in NUMERIC_FEATURES}}
+	for column in NUMERIC_FEATURES:
+		encoder['fill'][column] = 4.0 if column == 'Number of Doors' else standardize[column][0]
+	for column in CATEGORICAL_FEATURES:
+		encoder['categorical'][column] = sorted(values[column])
+	return encoder, standardize['MSRP']
+
+# Running totals for r2 and rmse, so they can be worked out over more rows than fit in memory
+def addPredictionErrors(errors, actual, predicted):
+	errors['rows'] += len(actual)
+	errors['squared_error'] += float(((actual - predicted) ** 2).sum())
+	errors['sum'] += float(actual.sum())
+	errors['squares'] += float((actual ** 2).sum())
+
+def predictionMetrics(errors):
+	if not errors['rows']:
+		return {'rows': 0, 'r2': None, 'rmse': None}
+	variance = errors['squares'] - errors['sum'] ** 2 / errors['rows']
+	return {'rows': errors['rows'], 'r2': 1 - errors['squared_error'] / variance if variance else None, 'rmse': float(np.sqrt(errors['squared_error'] / errors['rows']))}
+
+# Trains a linear model on a csv of any size, only ever holding chunkSize rows at once.
+# A holdout fraction of the rows is never trained on. While training, each chunk's held out rows are scored before the
+# model learns from the rest of the chunk, and once it's done they're all scored again with the final model.
+# Returns the model, its encoder, its coefficients and intercept in dollars, and the held out metrics.
+def streamTrainMsrpModel(filepath, chunkSize, holdout, epochs, alpha):
+	from sklearn.linear_model import SGDRegressor
+
+	verboseprint("Learning the encoder from " + filepath)
+	encoder, (msrpmean, msrpstd) = fitStreamingEncoder(filepath, chunkSize)
+	verboseprint("Encoder has " + str(len(featureNames(encoder))) + " features")
+
+	# MSRP is scaled the same way as the numeric features, so the default learning rate suits it
+	model = SGDRegressor(alpha=alpha, random_state=42)
+	rng = np.random.default_rng(42)
+	trainedrows = 0
+	for epoch in range(epochs):
+		progressive = {'rows': 0, 'squared_error': 0.0, 'sum': 0.0, 'squares': 0.0}
+		firstrow = 0
+		for chunk in readTrainingChunks(filepath, chunkSize):
+			heldout = heldOutRows(firstrow, len(chunk), holdout)
+			firstrow += len(chunk)
+			x = buildFeatureMatrix(chunk, encoder)
+			y = (chunk['MSRP'].to_numpy(dtype=np.float64) - msrpmean) / msrpstd
+
+			if heldout.any() and hasattr(model, 'coef_'):
+				addPredictionErrors(progressive, y[heldout] * msrpstd + msrpmean, model.predict(x[heldout]) * msrpstd + msrpmean)
+			# csv files are often sorted (this one is by make), so at least mix up the rows within each chunk
+			trainrows = rng.permutation(np.flatnonzero(~heldout))
+			if len(trainrows):
+				model.partial_fit(x[trainrows], y[trainrows])
+			if epoch == 0:
+				trainedrows += len(trainrows)
+
+			metrics = predictionMetrics(progressive)
+			verboseprint("Epoch " + str(epoch + 1) + ", " + str(firstrow) + " rows read" + (", held out r2 so far " + '{0:.5f}'.format(metrics['r2']) if metrics['r2'] is not None else ""))
+
+	final = {'rows': 0, 'squared_error': 0.0, 'sum': 0.0, 'squares': 0.0}
+	firstrow = 0
+	for chunk in readTrainingChunks(filepath, chunkSize):
+		heldout = heldOutRows(firstrow, len(chunk), holdout)
+		firstrow += len(chunk)
+		if heldout.any():
+			addPredictionErrors(final, chunk['MSRP'].to_numpy(dtype=np.float64)[heldout], model.predict(buildFeatureMatrix(chunk[heldout], encoder)) * msrpstd + msrpmean)
+
+	metrics = predictionMetrics(final)
+	metrics.update({'training_rows': trainedrows, 'epochs': epochs, 'alpha': alpha})
+	print("Trained on " + str(trainedrows) + " rows over " + str(epochs) + " epochs")
+	if metrics['r2'] is not None:
+		print("Held out R-squared (" + str(metrics['rows']) + " rows): " + str(metrics['r2']))
+		print("Held out RMSE: " + str(metrics['rmse']))
+
+	return model, encoder, model.coef_ * msrpstd, float(model.intercept_[0]) * msrpstd + msrpmean, metrics
+
+# ============= INCREMENTAL REFRESH =============
+# Keeps a Ridge model up to date as rows are appended to the data set, without refitting on the whole history.
+# Ridge only depends on the data through X^T X, X^T y and the column sums, so those are saved with the model and
+# only the new rows are added to them. Solving for the coefficients again then costs the same however many rows there are.
+
+# How much of the end of the already read part of the file is hashed to check nothing before it has changed
+REFRESH_TAIL_BYTES = 65536
+
+# Hash of the header and the bytes just before offset, to tell whether the file has only been appended to since
+def refreshFileHash(filepath, offset):
+	digest = hashlib.sha256()
+	with open(filepath, 'rb') as f:
+		digest.update(f.readline())
+		start = max(offset - REFRESH_TAIL_BYTES, f.tell())
+		f.seek(start)
+		digest.update(f.read(max(offset - start, 0)))
+	return digest.hexdigest()
+
+# How much of the file is scanned at a time looking for the end of the last complete row
+REFRESH_BLOCK_BYTES = 1 << 20
+
+# Offset just past the last complete row of f after offset (which has to be the start of a row), i.e. after the last
+# line break that isn't inside a quoted field. Scanned a block at a time so the file never has to fit in memory.
+def completeRowsEnd(f, offset):
+	f.seek(offset)
+	end = position = offset
+	quoted = False
+	while True:
+		block = f.read(REFRESH_BLOCK_BYTES)
+		if not block:
+			return end
+		# every other piece between quotes is inside a quoted field ("" inside one flips twice, so it evens out)
+		for index, piece in enumerate(block.split(b'"')):
+			if index:
+				quoted = not quoted
+				position += 1
+			if not quoted:
+				linebreak = piece.rfind(b'\n')
+				if linebreak >= 0:
+					end = position + linebreak + 1
+			position += len(piece)
+
+# A file that reads as if it ended at end, so pandas stops at the last complete row
+class BoundedReader:
+	def __init__(self, f, end):
+		self.f = f
+		self.end = end
+
+	def read(self, size=-1):
+		remaining = max(self.end - self.f.tell(), 0)
+		return self.f.read(remaining if size is None or size < 0 else min(size, remaining))
+
+	def __iter__(self):
+		return iter(lambda: self.read(REFRESH_BLOCK_BYTES), b'')
+
+# Reads the rows of filepath between byte offsets start and end, a chunk at a time, straight from the file
+def readRowChunks(filepath, start, end, names, usecols, chunkSize):
+	with open(filepath, 'rb') as f:
+		f.seek(start)
+		chunks = pd.read_csv(BoundedReader(f, end), header=None, names=names, usecols=usecols, dtype={column: str for column in CATEGORICAL_COLUMNS if column in usecols}, chunksize=chunkSize)
+		for chunk in chunks:
+			yield chunk.dropna(subset=['MSRP'])
+
+# Reads the rows of filepath after byte offset, a chunk at a time. A half written last row is left for next time.
+# Returns the chunks and the offset to start from next time.
+def readAppendedRows(filepath, offset, columns, chunkSize):
+	with open(filepath, 'rb') as f:
+		names = next(csv.reader([f.readline().decode('utf-8')]), [])
+		offset = max(offset, f.tell())
+		end = completeRowsEnd(f, offset)
+	missing = [column for column in columns + ['MSRP'] if column not in names]
+	if missing:
+		raise ValueError("missing columns " + ", ".join(missing))
+	if end == offset:
+		return iter(()), offset
+	return readRowChunks(filepath, offset, end, names, columns + ['MSRP'], chunkSize), end
+
+# Empty sufficient statistics for a number of features
+def emptyRefreshStatistics(width):
+	return {'rows': 0, 'xsum': np.zeros(width), 'ysum': 0.0, 'yty': 0.0, 'xtx': np.zeros((width, width)), 'xty': np.zeros(width)}
+
+# Adds the values the encoder hasn't seen in rows to the end of its vocabularies, so the existing features keep their
+# meaning. Returns the number of features added.
+def extendFeatureEncoder(encoder, rows):
+	added = 0
+	for column, values in encoder['categorical'].items():
+		unseen = sorted(set(str(value) for value in rows[column].dropna().unique()) - set(values))
+		values += unseen
+		added += len(unseen)
+	if encoder['market_categories'] is not None:
+		seen = {category for combination in rows['Market Category'].dropna().unique() for category in str(combination).split(',')}
+		unseen = sorted(seen - set(encoder['market_categories']))
+		encoder['market_categories'] += unseen
+		added += len(unseen)
+	return added
+
+# Moves the statistics over to a new feature layout. Features that weren't in the old one start at zero, which is
+# what every earlier row would have had for them.
+def remapRefreshStatistics(stats, oldNames, newNames):
+	positions = {name: index for index, name in enumerate(newNames)}
+	old = [positions[name] for name in oldNames]
+	remapped = emptyRefreshStatistics(len(newNames))
+	remapped.update({'rows': stats['rows'], 'ysum': stats['ysum'], 'yty': stats['yty']})
+	remapped['xsum'][old] = stats['xsum']
+	remapped['xty'][old] = stats['xty']
+	remapped['xtx'][np.ix_(old, old)] = stats['xtx']
+	return remapped
+
+def addRefreshStatistics(stats, x, y):
+	stats['rows'] += x.shape[0]
+	stats['xsum'] += np.asarray(x.sum(axis=0)).ravel()
+	stats['ysum'] += float(y.sum())
+	stats['yty'] += float(y @ y)
+	stats['xtx'] += (x.T @ x).toarray()
+	stats['xty'] += x.T @ y
+
+# Solves for the Ridge coefficients and intercept from the statistics, centering them the same way Ridge centers the
+# data when fitting an intercept. Returns them along with the R-squared over every row.
+def solveRidge(stats, alpha):
+	rows = stats['rows']
+	xmean = stats['xsum'] / rows
+	ymean = stats['ysum'] / rows
+	gram = stats['xtx'] - rows * np.outer(xmean, xmean)
+	cross = stats['xty'] - rows * xmean * ymean
+	coefficients = np.linalg.solve(gram + alpha * np.eye(len(gram)), cross)
+	intercept = ymean - xmean @ coefficients
+
+	# sum of (y - x.b - c)^2 expanded in terms of the statistics
+	squarederror = stats['yty'] - 2 * coefficients @ stats['xty'] - 2 * intercept * stats['ysum'] + coefficients @ stats['xtx'] @ coefficients + 2 * intercept * coefficients @ stats['xsum'] + rows * intercept ** 2
+	total = stats['yty'] - rows * ymean ** 2
+	return coefficients, float(intercept), 1 - squarederror / total if total else None
+
+# Updates a saved Ridge model with the rows appended to filepath since it was last refreshed. The first refresh of a
+# model (or one after the file was changed rather than appended to) reads every row.
+# Returns the refitted model, its encoder, metrics and refresh state for saveModel.
+def refreshMsrpModel(artifact, filepath, chunkSize):
+	from sklearn.linear_model import Ridge
+
+	model = modelFromArtifact(artifact)
+	if not isinstance(model, Ridge) or artifact['encoder'].get('standardize'):
+		sys.exit("--refresh needs a model saved by --model or --tune.")
+	encoder = artifact['encoder']
+	filepath = os.path.realpath(filepath)
+	if not os.path.exists(filepath):
+		sys.exit("Data file '" + filepath + "' not found.")
+
+	state = artifact.get('refresh')
+	if state is not None and state['data'] == filepath and os.path.getsize(filepath) >= state['offset'] and refreshFileHash(filepath, state['offset']) == state['hash']:
+		verboseprint("Reading rows appended to " + filepath + " after byte " + str(state['offset']))
+	else:
+		if state is not None:
+			print(filepath + " has changed since the model was last refreshed (not just had rows added), reading every row")
+		else:
+			print("First refresh of this model, reading every row of " + filepath)
+		state = {'data': filepath, 'offset': 0, 'alpha': float(model.alpha), 'statistics': emptyRefreshStatistics(len(featureNames(encoder)))}
+
+	columns = encoder['numeric'] + list(encoder['categorical']) + (['Market Category'] if encoder['market_categories'] is not None else [])
+	newrows = 0
+	newfeatures = 0
+	try:
+		chunks, offset = readAppendedRows(filepath, state['offset'], columns, chunkSize)
+		for chunk in chunks:
+			names = featureNames(encoder)
+			added = extendFeatureEncoder(encoder, chunk)
+			if added:
+				state['statistics'] = remapRefreshStatistics(state['statistics'], names, featureNames(encoder))
+				newfeatures += added
+			addRefreshStatistics(state['statistics'], buildFeatureMatrix(chunk, encoder), chunk['MSRP'].to_numpy(dtype=np.float64))
+			newrows += len(chunk)
+	except ValueError as e:
+		sys.exit("Unable to read data file: " + str(e))
+	state['offset'] = offset
+	state['hash'] = refreshFileHash(filepath, offset)
+
+	if not state['statistics']['rows']:
+		sys.exit("Data file '" + filepath + "' doesn't have any rows with an MSRP.")
+	coefficients, intercept, r2 = solveRidge(state['statistics'], state['alpha'])
+	refreshed = Ridge(alpha=state['alpha'])
+	refreshed.coef_ = coefficients
+	refreshed.intercept_ = intercept
+	refreshed.n_features_in_ = len(coefficients)
+
+	print("Added " + str(newrows) + " rows and " + str(newfeatures) + " features, the model is now fitted on " + str(state['statistics']['rows']) + " rows")
+	print("Training R-squared: " + str(r2))
+	return refreshed, encoder, {'training_rows': state['statistics']['rows'], 'training_r2': r2, 'refreshed_rows': newrows}, state
+
+# Refits Ridge from scratch on every row the refresh has read, with the refreshed model's encoder and alpha, and checks
+# the refreshed model's predictions are within tolerance (as a fraction of the mean MSRP) of the refitted one's
+def verifyRefresh(model, encoder, refresh, chunkSize, tolerance=1e-6):
+	from sklearn.linear_model import Ridge
+
+	columns = encoder['numeric'] + list(encoder['categorical']) + (['Market Category'] if encoder['market_categories'] is not None else [])
+	chunks, offset = readAppendedRows(refresh['data'], 0, columns, chunkSize)
+	df = pd.concat(list(chunks), ignore_index=True)
+	# the same rows as the refresh, if more have been added since
+	df = df.iloc[:refresh['statistics']['rows']]
+	x = buildFeatureMatrix(df, encoder).toarray()
+	y = df['MSRP'].to_numpy(dtype=np.float64)
+	full = Ridge(alpha=model.alpha, solver='cholesky').fit(x, y)
+	difference = float(np.abs(model.predict(x) - full.predict(x)).max() / np.abs(y).mean())
+	print("Largest difference from refitting on every row: " + '{0:.3g}'.format(difference) + " of the mean MSRP")
+	if difference > tolerance:
+		sys.exit("Refreshed model doesn't match refitting on every row.")
+
+# ============= PREDICTION =============
+# Bumped whenever what's saved in a model file changes, so older files are rejected rather than misread
+MODEL_FORMAT = 2
+
+# Saves a fitted model along with the encoder and feature layout needed to use it on new data.
+# The model's coefficients are saved on their own too, so predicting doesn't have to import scikit-learn (which takes
+# longer than loading everything else); the model itself is kept pickled inside the file for anything that needs it.
+# coefficients and intercept can be passed if they're not the model's own (e.g. it was trained on a scaled MSRP).
+# refresh is the state --refresh keeps to update the model with new rows, if it has any.
+def saveModel(modelFile, model, encoder, metrics, coefficients=None, intercept=None, refresh=None):
+	artifact = {
+		'format': MODEL_FORMAT,
+		'created': datetime.now().isoformat(timespec='seconds'),
+		'versions': {'python': platform.python_version(), 'sklearn': sklearn.__version__, 'pandas': pd.__version__, 'numpy': np.__version__},
+		'model': pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL),
+		'coefficients': np.asarray(model.coef_ if coefficients is None else coefficients, dtype=np.float64),
+		'intercept': float(np.ravel(model.intercept_)[0] if intercept is None else intercept),
+		'encoder': encoder,
+		'features': featureNames(encoder),
+		'metrics': metrics}
+	if refresh is not None:
+		artifact['refresh'] = refresh
+	try:
+		with open(modelFile + '.tmp', 'wb') as f:
+			pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(modelFile + '.tmp', modelFile)
+	except OSError as e:
+		sys.exit("Unable to save model: " + str(e))
+	print("Model saved to " + modelFile)
+
+# Loads a model file saved by saveModel, bailing out if it's missing or from a different version of this script
+def loadModel(modelFile):
+	try:
+		with open(modelFile, 'rb') as f:
+			artifact = pickle.load(f)
+	except FileNotFoundError:
+		sys.exit("Model file '" + modelFile + "' not found, run with --model first.")
+	except (OSError, pickle.UnpicklingError, EOFError) as e:
+		sys.exit("Unable to load model: " + str(e))
+
+	if not isinstance(artifact, dict) or artifact.get('format') != MODEL_FORMAT:
+		sys.exit("Model file '" + modelFile + "' was saved by a different version of this script, run with --model again.")
+	if artifact['features'] != featureNames(artifact['encoder']) or len(artifact['features']) != len(artifact['coefficients']):
+		sys.exit("Model file '" + modelFile + "' doesn't match its own feature layout, run with --model again.")
+
+	verboseprint("Loaded model saved " + artifact['created'] + " with " + str(len(artifact['features'])) + " features")
+	return artifact
+
+# Unpickles the scikit-learn model saved in a model file
+def modelFromArtifact(artifact):
+	if artifact['versions']['sklearn'] != sklearn.__version__:
+		print("Warning: model was saved with scikit-learn " + artifact['versions']['sklearn'] + ", running " + sklearn.__version__)
+	return pickle.loads(artifact['model'])
+
+# Same as the saved model's predict(), straight from its coefficients
+def predictFromArtifact(artifact, x):
+	return x @ artifact['coefficients'] + artifact['intercept']
+
+# Columns from the input copied to the predictions, to tell the cars apart. Writing every column back out takes
+# far longer than the predictions themselves.
+PREDICTION_ID_COLUMNS = ['Make', 'Model', 'Year']
+
+# The columns read from a csv of cars to predict, and their types. Only the columns the model and output use are parsed,
+# and the string columns are read as strings so pandas doesn't guess their types for every chunk.
+def predictionColumns(encoder, idColumns=PREDICTION_ID_COLUMNS):
+	usecols = list(idColumns) + [column for column in encoder['numeric'] + list(encoder['categorical']) if column not in idColumns]
+	if encoder['market_categories'] is not None:
+		usecols.append('Market Category')
+	return usecols, {column: str for column in CATEGORICAL_COLUMNS if column in usecols}
+
+# Predicts the MSRP of every row in inputFile, a chunk at a time so the input can be any size.
+# The output has a row for each input row, in the same order. Returns the number of rows predicted.
+def predictMsrp(artifact, inputFile, outputFile, chunkSize):
+	encoder = artifact['encoder']
+	usecols, dtypes = predictionColumns(encoder)
+	rows = 0
+	try:
+		chunks = pd.read_csv(inputFile, usecols=usecols, dtype=dtypes, chunksize=chunkSize)
+		with open(outputFile, 'w', encoding='utf-8', newline='') as f:
+			for chunk in chunks:
+				predictions = chunk[PREDICTION_ID_COLUMNS].copy()
+				predictions['Predicted MSRP'] = predictFromArtifact(artifact, buildFeatureMatrix(chunk, encoder)).round(2)
+				predictions.to_csv(f, index=False, header=(rows == 0))
+				rows += len(chunk)
+				verboseprint("Predicted " + str(rows) + " rows")
+	except FileNotFoundError:
+		sys.exit("Prediction file '" + inputFile + "' not found.")
+	except ValueError as e:
+		# e.g. a column the model needs is missing, or has values that aren't numbers
+		sys.exit("Unable to read prediction file: " + str(e))
+	except OSError as e:
+		sys.exit("Unable to write predictions: " + str(e))
+	return rows
+
+# ============= SERVING =============
+# Keeps a model loaded and predicts the MSRP of cars posted to a local HTTP endpoint. Requests that arrive together are
+# queued up and predicted as one batch by a single thread, since building the features and predicting costs about
+# the same for a few rows as for one.
+
+# State shared by the request handlers and the batching thread
+service = {'artifact': None, 'queue': queue.Queue(), 'lock': threading.Lock(), 'started': None,
+	'stats': {'requests': 0, 'errors': 0, 'rows': 0, 'batches': 0, 'seconds': 0.0, 'latencies': []}}
+
+# Reads the cars posted in a request, a csv with a header row and the same columns as predict-me.csv.
+# Requests are small, so they're read with the csv module into rows of the columns the model uses, in the order
+# predictionColumns() gives them; pandas only gets involved once the whole batch is put together.
+def parseCars(body, encoder):
+	usecols, dtypes = predictionColumns(encoder, idColumns=[])
+	reader = csv.reader(io.StringIO(body.decode('utf-8')))
+	header = next(reader, [])
+	missing = [column for column in usecols if column not in header]
+	if missing:
+		raise ValueError("missing columns " + ', '.join(missing))
+	positions = [(header.index(column), column in dtypes) for column in usecols]
+
+	cars = []
+	for line, row in enumerate(reader, 2):
+		if not row:
+			continue
+		if len(row) != len(header):
+			raise ValueError("line " + str(line) + " has " + str(len(row)) + " fields, expected " + str(len(header)))
+		car = []
+		for position, isString in positions:
+			value = row[position]
+			if value == '':
+				car.append(None)
+			elif isString:
+				car.append(value)
+			else:
+				try:
+					car.append(float(value))
+				except ValueError:
+					raise ValueError("line " + str(line) + " has '" + value + "' for " + header[position] + ", expected a number")
+		cars.append(car)
+	return cars
+
+# Predicts the MSRP of some parsed cars, rounded to the cent
+def predictCars(artifact, usecols, cars):
+	cars = pd.DataFrame(cars, columns=usecols)
+	return predictFromArtifact(artifact, buildFeatureMatrix(cars, artifact['encoder'])).round(2).tolist()
 
+# Logs an error the service ran into. Clients only get a general message, the details are kept here.
+def logServiceError(message):
+	print(message + ":\n" + traceback.format_exc(), file=sys.stderr)
 
+# Takes requests off the queue and predicts them. After the first request comes in, it waits up to batchWait seconds
+# for more, until the batch has batchSize rows; then they're all predicted at once and their handlers woken up.
+# If the batch fails, each request in it is predicted on its own, so only the ones that fail by themselves get an error.
+def batchPredictions(batchSize, batchWait):
+	artifact = service['artifact']
+	usecols = predictionColumns(artifact['encoder'], idColumns=[])[0]
+	while True:
+		batch = [service['queue'].get()]
+		rows = len(batch[0]['cars'])
+		deadline = time.perf_counter() + batchWait
+		while rows < batchSize:
+			try:
+				request = service['queue'].get(timeout=max(deadline - time.perf_counter(), 0))
+			except queue.Empty:
+				break
+			batch.append(request)
+			rows += len(request['cars'])
+
+		try:
+			predictions = predictCars(artifact, usecols, [car for request in batch for car in request['cars']])
+			start = 0
+			for request in batch:
+				request['predictions'] = predictions[start:start + len(request['cars'])]
+				start += len(request['cars'])
+		except Exception:
+			if len(batch) == 1:
+				logServiceError("Unable to predict a request")
+				batch[0]['error'] = "Unable to predict the cars"
+			else:
+				verboseprint("Batch of " + str(len(batch)) + " requests failed, predicting them one at a time")
+				for request in batch:
+					try:
+						request['predictions'] = predictCars(artifact, usecols, request['cars'])
+					except Exception:
+						logServiceError("Unable to predict a request")
+						request['error'] = "Unable to predict the cars"
+
+		with service['lock']:
+			service['stats']['batches'] += 1
+		verboseprint("Predicted a batch of " + str(len(batch)) + " requests, " + str(rows) + " rows")
+		for request in batch:
+			request['done'].set()
+
+# Adds one request to the stats. Only the last 10000 latencies are kept for the percentiles.
+def recordPrediction(seconds, rows, failed):
+	with service['lock']:
+		stats = service['stats']
+		stats['requests'] += 1
+		stats['errors'] += failed
+		stats['rows'] += rows
+		stats['seconds'] += seconds
+		stats['latencies'].append(seconds)
+		if len(stats['latencies']) > 10000:
+			del stats['latencies'][:1000]
+
+# Summarizes the request stats for GET /stats
+def predictionStats():
+	uptime = time.time() - service['started']
+	with service['lock']:
+		stats = dict(service['stats'])
+		latencies = sorted(stats['latencies'])
+	percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+	return {'uptime_seconds': round(uptime, 3),
+		'model': {'created': service['artifact']['created'], 'features': len(service['artifact']['features'])},
+		'requests': stats['requests'],
+		'errors': stats['errors'],
+		'rows': stats['rows'],
+		'batches': stats['batches'],
+		'rows_per_batch': round(stats['rows'] / stats['batches'], 3) if stats['batches'] else None,
+		'requests_per_second': round(stats['requests'] / uptime, 3),
+		'rows_per_second': round(stats['rows'] / uptime, 3),
+		'latency_ms': {'mean': round(stats['seconds'] / stats['requests'] * 1000, 3) if stats['requests'] else None,
+			'p50': round(percentiles[49] * 1000, 3) if percentiles else None,
+			'p99': round(percentiles[98] * 1000, 3) if percentiles else None,
+			'max': round(latencies[-1] * 1000, 3) if latencies else None}}
+
+# Handles requests to the service:
+#    POST /predict with a csv of cars as the body, answered with json holding their predicted MSRPs in the same order
+#    GET /stats for the request counters, latency percentiles and throughput
+class PredictionRequestHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if urllib.parse.urlsplit(self.path).path != '/stats':
+			return self.sendJson(404, {'error': 'Not found'})
+		self.sendJson(200, predictionStats())
+
+	def do_POST(self):
+		start = time.perf_counter()
+		length = self.headers.get('Content-Length')
+		if length is None:
+			self.close_connection = True
+			return self.sendJson(411, {'error': 'Content-Length is required'})
+		if not length.strip().isdigit():
+			self.close_connection = True
+			return self.sendJson(400, {'error': 'Content-Length must be a number of bytes'})
+		body = self.rfile.read(int(length))
+		if urllib.parse.urlsplit(self.path).path != '/predict':
+			return self.sendJson(404, {'error': 'Not found'})
+
+		# parseCars' own errors say what's wrong with the client's csv, anything else stays in the log
+		try:
+			request = {'cars': parseCars(body, service['artifact']['encoder']), 'done': threading.Event()}
+			error = None
+		except UnicodeDecodeError:
+			error = "Unable to read the cars: the csv must be UTF-8"
+		except ValueError as e:
+			error = "Unable to read the cars: " + str(e)
+		except Exception:
+			logServiceError("Unable to read a request")
+			error = "Unable to read the cars"
+		if error is not None:
+			recordPrediction(time.perf_counter() - start, 0, True)
+			return self.sendJson(400, {'error': error})
+		if len(request['cars']):
+			service['queue'].put(request)
+			request['done'].wait()
+		else:
+			request['predictions'] = []
+
+		seconds = time.perf_counter() - start
+		if 'error' in request:
+			recordPrediction(seconds, 0, True)
+			return self.sendJson(500, {'error': request['error']})
+		recordPrediction(seconds, len(request['cars']), False)
+		self.sendJson(200, {'predictions': request['predictions'], 'seconds': seconds})
+
+	def sendJson(self, status, content):
+		body = json.dumps(content).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		verboseprint(self.address_string() + ' - ' + format % args)
+
+# The default backlog of 5 connections turns clients away when a lot of requests come in at once
+class PredictionHTTPServer(http.server.ThreadingHTTPServer):
+	request_queue_size = 128
+
+# Loads the model and serves predictions until stopped, then prints the stats
+def runPredictionService(artifact, port, batchSize, batchWait):
+	service['artifact'] = artifact
+	# predicting a blank car first imports the libraries, so the first request isn't slowed down by it
+	usecols = predictionColumns(artifact['encoder'], idColumns=[])[0]
+	predictFromArtifact(artifact, buildFeatureMatrix(pd.DataFrame([[None] * len(usecols)], columns=usecols), artifact['encoder']))
+	service['started'] = time.time()
+	threading.Thread(target=batchPredictions, args=(batchSize, batchWait), daemon=True).start()
+
+	try:
+		server = PredictionHTTPServer(('127.0.0.1', port), PredictionRequestHandler)
+	except OSError as e:
+		sys.exit("Unable to listen on port " + str(port) + ": " + str(e))
+	print("Serving predictions on http://127.0.0.1:" + str(port) + "/predict", flush=True)
+	try:
+		with server:
+			server.serve_forever()
+	finally:
+		print(json.dumps(predictionStats(), indent=2))
 
 # ============= EXECUTION =============
 def verbosePrintSetup(verbosestate):
@@ -187,22 +1355,93 @@ def run():
 	# Establish arguments and verbose print if user passed -v
 	args = parser.parse_args()
 	verboseprint = verbosePrintSetup(args.verbose)
+	profile['enabled'] = args.profile is not None
+	profile['started'] = time.perf_counter()
 
-	df = loadCsv()
+	if args.chunk_size < 1:
+		parser.error("--chunk_size must be at least 1")
+	if args.workers < 1:
+		parser.error("--workers must be at least 1")
+	if args.max_points < 0:
+		parser.error("--max_points can't be negative")
+	if args.folds < 2:
+		parser.error("--folds must be at least 2")
+	if not 0 <= args.holdout < 1:
+		parser.error("--holdout must be at least 0 and less than 1")
+	if args.epochs < 1:
+		parser.error("--epochs must be at least 1")
+	if args.batch_size < 1:
+		parser.error("--batch_size must be at least 1")
+	if args.batch_wait < 0:
+		parser.error("--batch_wait can't be negative")
+	rendered = []
+
+	# predicting only needs the saved model, not the training data
+	if args.exploratory or args.model or args.tune:
+		with profileStage('load_csv'):
+			df = loadCsv(args.data, cacheDir=None if args.no_cache else args.cache_dir)
 
 	# Runs the exporatory analysis, generating some charts and summary information about the raw data
 	if args.exploratory:
-		exploreCarData(df)
-		visualizeCarData(df)
+		with profileStage('explore'):
+			exploreCarData(df, args.group_by, args.summary_columns, args.statistics, args.report)
+		with profileStage('charts'):
+			charts = visualizeCarData(df, args.charts, args.chart_format, args.workers, args.max_points if args.charts else 0, args.verbose)
+		if args.charts:
+			rendered += charts
 
 	if args.model:
-		df = preprocessCarData(df)
-		msrpmodel, x_test, y_test = createMsrpModel(df)
+		with profileStage('preprocess'):
+			x, y, encoder = preprocessCarData(df)
+		verboseprint("Built a " + str(x.shape[0]) + " x " + str(x.shape[1]) + " design matrix with " + str(x.nnz) + " non-zero entries")
+		msrpmodel, x_test, y_test = createMsrpModel(x, y, showChart=not args.charts)
+		if args.charts:
+			with profileStage('plot'):
+				rendered += renderCharts([('predicted-vs-actual', "Predicted MSRPs vs Actual MSRP for Out of Sample Test Data", drawPredictedVsActual)], {'actual': y_test, 'predicted': msrpmodel.predict(x_test)}, args.charts, args.chart_format, 1, args.verbose)
+		with profileStage('save_model'):
+			saveModel(args.model_file, msrpmodel, encoder, {'test_r2': float(msrpmodel.score(x_test, y_test)), 'training_rows': int(x.shape[0])})
+
+	if args.tune:
+		with profileStage('tune'):
+			msrpmodel, encoder, results = tuneMsrpModel(df, args.alphas, args.feature_sets, args.folds, args.workers)
+		saveModel(args.model_file, msrpmodel, encoder, dict(results['best'], training_rows=len(df)))
+		if args.tune_results:
+			try:
+				with open(args.tune_results, 'w', encoding='utf-8') as f:
+					json.dump(results, f, indent=2)
+			except OSError as e:
+				sys.exit("Unable to write tuning results: " + str(e))
+			print("Tuning results saved to " + args.tune_results)
+
+	if args.stream_train:
+		with profileStage('stream_train'):
+			msrpmodel, encoder, coefficients, intercept, metrics = streamTrainMsrpModel(args.data, args.chunk_size, args.holdout, args.epochs, args.sgd_alpha)
+		saveModel(args.model_file, msrpmodel, encoder, metrics, coefficients, intercept)
+
+	if args.refresh:
+		with profileStage('refresh'):
+			msrpmodel, encoder, metrics, refresh = refreshMsrpModel(loadModel(args.model_file), args.data, args.chunk_size)
+		if args.verify_refresh:
+			with profileStage('verify_refresh'):
+				verifyRefresh(msrpmodel, encoder, refresh, args.chunk_size)
+		saveModel(args.model_file, msrpmodel, encoder, metrics, refresh=refresh)
+
+	if rendered:
+		print("Charts saved to " + writeChartIndex(args.charts, rendered))
 
 	if args.predict:
-		# TODO
-		print("Thanks for trying to predict!")
-		print("This hasn't been written yet...")
+		with profileStage('load_model'):
+			artifact = loadModel(args.model_file)
+		predictionsFile = args.predictions or os.path.join("/tmp", "msrp_predictions_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".csv")
+		with profileStage('predict'):
+			rows = predictMsrp(artifact, args.predict_file, predictionsFile, args.chunk_size)
+		print("Predicted the MSRP of " + str(rows) + " cars. Predictions saved to " + predictionsFile)
+
+	if profile['enabled']:
+		writeProfile(args.profile)
+
+	if args.serve:
+		runPredictionService(loadModel(args.model_file), args.port, args.batch_size, args.batch_wait / 1000)
 
 
 def main():
@@ -0,0 +1,173 @@
+import csv
+import os
+import pickle
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import carMsrpAnalysis
+
+@pytest.fixture(autouse=True)
+def quiet():
+	carMsrpAnalysis.verboseprint = carMsrpAnalysis.verbosePrintSetup(False)
+
+@pytest.fixture(scope='module')
+def cars():
+	carMsrpAnalysis.verboseprint = carMsrpAnalysis.verbosePrintSetup(False)
+	return carMsrpAnalysis.loadCsv()
+
+# ============= FEATURES (user-012) =============
+
+# The features the straightforward way, a dense frame from pandas.get_dummies, for the sparse encoder to match
+def denseFeatures(df, encoder):
+	frame = pd.DataFrame({column: df[column].fillna(encoder['fill'][column]).astype(float) for column in encoder['numeric']})
+	for column in encoder['categorical']:
+		frame = frame.join(pd.get_dummies(df[column].astype(str).where(df[column].notna()), prefix=column, dtype=float))
+	frame = frame.join(df['Market Category'].astype(str).where(df['Market Category'].notna()).str.get_dummies(',').add_prefix('Market Category_').astype(float))
+	return frame.reindex(columns=carMsrpAnalysis.featureNames(encoder), fill_value=0.0).to_numpy()
+
+def test_sparse_features_match_get_dummies(cars):
+	encoder = carMsrpAnalysis.fitFeatureEncoder(cars)
+	x = carMsrpAnalysis.buildFeatureMatrix(cars, encoder)
+	assert x.shape == (len(cars), len(carMsrpAnalysis.featureNames(encoder)))
+	np.testing.assert_array_equal(x.toarray(), denseFeatures(cars, encoder))
+
+def test_unseen_values_set_no_indicator(cars):
+	encoder = carMsrpAnalysis.fitFeatureEncoder(cars.iloc[:100])
+	unseen = cars.iloc[[-1]].copy()
+	unseen['Make'] = 'Not A Make'
+	unseen['Market Category'] = 'Not A Category'
+	x = carMsrpAnalysis.buildFeatureMatrix(unseen, encoder).toarray()[0]
+	names = carMsrpAnalysis.featureNames(encoder)
+	assert not any(x[index] for index, name in enumerate(names) if name.startswith('Make_') or name.startswith('Market Category_'))
+
+# ============= GROUPED STATISTICS (user-013) =============
+
+def test_grouped_statistics_match_describe(cars):
+	columns = ['MSRP', 'Engine HP']
+	summary = carMsrpAnalysis.groupedStatistics(cars, ['Make'], columns, carMsrpAnalysis.SUMMARY_AGGREGATIONS).set_index('Make')
+	described = {'count': 'count', 'mean': 'mean', 'std': 'std', 'min': 'min', 'p25': '25%', 'median': '50%', 'p75': '75%', 'max': 'max'}
+	for column in columns:
+		expected = cars.groupby('Make', observed=True)[column].describe()
+		for statistic, name in described.items():
+			np.testing.assert_allclose(summary[column + ' ' + statistic].to_numpy(dtype=float), expected[name].reindex(summary.index).to_numpy(dtype=float), rtol=1e-6)
+
+# ============= MODEL ARTIFACTS (user-014) =============
+
+def fitRidge(cars, alpha=0.5):
+	from sklearn.linear_model import Ridge
+	x, y, encoder = carMsrpAnalysis.preprocessCarData(cars)
+	return Ridge(alpha=alpha).fit(x, y), x, encoder
+
+def test_saved_model_predicts_the_same_as_the_fitted_one(cars, tmp_path):
+	model, x, encoder = fitRidge(cars)
+	modelfile = str(tmp_path / "model.pkl")
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, {})
+	artifact = carMsrpAnalysis.loadModel(modelfile)
+	assert artifact['features'] == carMsrpAnalysis.featureNames(encoder)
+	np.testing.assert_allclose(carMsrpAnalysis.predictFromArtifact(artifact, x), model.predict(x))
+	np.testing.assert_allclose(carMsrpAnalysis.modelFromArtifact(artifact).predict(x), model.predict(x))
+
+def test_batch_predictions_match_the_model(cars, tmp_path):
+	model, x, encoder = fitRidge(cars)
+	modelfile = str(tmp_path / "model.pkl")
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, {})
+	inputfile = tmp_path / "cars.csv"
+	cars.drop(columns=['MSRP']).to_csv(inputfile, index=False)
+	outputfile = str(tmp_path / "predictions.csv")
+	assert carMsrpAnalysis.predictMsrp(carMsrpAnalysis.loadModel(modelfile), str(inputfile), outputfile, 1000) == len(cars)
+	predictions = pd.read_csv(outputfile)
+	assert list(predictions.columns) == carMsrpAnalysis.PREDICTION_ID_COLUMNS + ['Predicted MSRP']
+	np.testing.assert_allclose(predictions['Predicted MSRP'], model.predict(x).round(2), atol=0.006)
+
+def test_model_from_another_format_is_rejected(cars, tmp_path):
+	model, x, encoder = fitRidge(cars.iloc[:200])
+	modelfile = str(tmp_path / "model.pkl")
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, {})
+	artifact = carMsrpAnalysis.loadModel(modelfile)
+	artifact['format'] = carMsrpAnalysis.MODEL_FORMAT - 1
+	with open(modelfile, 'wb') as f:
+		pickle.dump(artifact, f)
+	with pytest.raises(SystemExit):
+		carMsrpAnalysis.loadModel(modelfile)
+
+# ============= INCREMENTAL REFRESH (user-020) =============
+
+def writeCarRows(path, header, rows, mode='w', tail=''):
+	with open(path, mode, encoding='utf-8', newline='') as f:
+		writer = csv.writer(f, lineterminator='\n')
+		if header:
+			writer.writerow(header)
+		writer.writerows(rows)
+		f.write(tail)
+
+def refreshAndSave(modelfile, datafile):
+	model, encoder, metrics, state = carMsrpAnalysis.refreshMsrpModel(carMsrpAnalysis.loadModel(modelfile), datafile, 700)
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, metrics, refresh=state)
+	return model, encoder, metrics
+
+def test_refresh_matches_refitting_on_every_row(cars, tmp_path):
+	from sklearn.linear_model import Ridge
+
+	with open(os.path.join(os.path.dirname(os.path.realpath(carMsrpAnalysis.__file__)), "car-features-msrp.csv"), encoding='utf-8', newline='') as f:
+		rows = list(csv.reader(f))
+	header, rows = rows[0], rows[1:]
+	# a quoted line break has to be read as part of its row, not split it
+	rows[4500][header.index('Model')] = 'Multi\nLine'
+	datafile = str(tmp_path / "cars.csv")
+	modelfile = str(tmp_path / "model.pkl")
+
+	writeCarRows(datafile, header, rows[:4000])
+	model, x, encoder = fitRidge(carMsrpAnalysis.loadCsv(datafile))
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, {})
+	assert refreshAndSave(modelfile, datafile)[2]['refreshed_rows'] == 4000
+
+	# the half written last row is left for the next refresh
+	writeCarRows(datafile, None, rows[4000:9000], 'a', 'Toyota,"Half\nwritten')
+	assert refreshAndSave(modelfile, datafile)[2]['refreshed_rows'] == 5000
+	# finishing it off writes the same bytes up to where the last refresh stopped, so only the rest is read
+	writeCarRows(datafile, header, rows)
+	refreshed, encoder, metrics = refreshAndSave(modelfile, datafile)
+	assert metrics['refreshed_rows'] == len(rows) - 9000
+	assert metrics['training_rows'] == len(rows)
+
+	df = pd.read_csv(datafile, dtype={column: str for column in carMsrpAnalysis.CATEGORICAL_COLUMNS})
+	x = carMsrpAnalysis.buildFeatureMatrix(df, encoder).toarray()
+	y = df['MSRP'].to_numpy(dtype=float)
+	full = Ridge(alpha=refreshed.alpha, solver='cholesky').fit(x, y)
+	assert np.abs(refreshed.predict(x) - full.predict(x)).max() < 1e-6 * np.abs(y).mean()
+
+# ============= SERVING (user-019) =============
+
+def test_a_failing_request_doesnt_fail_the_rest_of_its_batch(cars, tmp_path, monkeypatch):
+	model, x, encoder = fitRidge(cars)
+	modelfile = str(tmp_path / "model.pkl")
+	carMsrpAnalysis.saveModel(modelfile, model, encoder, {})
+	monkeypatch.setitem(carMsrpAnalysis.service, 'artifact', carMsrpAnalysis.loadModel(modelfile))
+	monkeypatch.setitem(carMsrpAnalysis.service, 'queue', queue.Queue())
+
+	# any batch holding a car from 1900 fails
+	buildFeatureMatrix = carMsrpAnalysis.buildFeatureMatrix
+	def failOn1900(df, encoder):
+		if (df['Year'] == 1900).any():
+			raise RuntimeError("internal details")
+		return buildFeatureMatrix(df, encoder)
+	monkeypatch.setattr(carMsrpAnalysis, 'buildFeatureMatrix', failOn1900)
+
+	body = cars.drop(columns=['MSRP']).iloc[:3].to_csv(index=False).encode('utf-8')
+	requests = [{'cars': carMsrpAnalysis.parseCars(body, encoder), 'done': threading.Event()} for _ in range(4)]
+	requests[1]['cars'][0][carMsrpAnalysis.predictionColumns(encoder, idColumns=[])[0].index('Year')] = 1900.0
+	for request in requests:
+		carMsrpAnalysis.service['queue'].put(request)
+	threading.Thread(target=carMsrpAnalysis.batchPredictions, args=(1000, 0.5), daemon=True).start()
+	for request in requests:
+		assert request['done'].wait(10)
+
+	expected = model.predict(x[:3]).round(2)
+	assert requests[1]['error'] == "Unable to predict the cars"
+	for request in requests[:1] + requests[2:]:
+		assert 'error' not in request
+		np.testing.assert_allclose(request['predictions'], expected, atol=0.006)
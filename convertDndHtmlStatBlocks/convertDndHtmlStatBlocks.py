@@ -3,23 +3,71 @@ import traceback
 import os
 import re
 import argparse
+import hashlib
+import json
 import uuid
 import time
 import csv
-import xml.etree.ElementTree as ET
+import multiprocessing
+from xml.sax.saxutils import quoteattr
 from subprocess import Popen, PIPE
+try:
+	import xml.etree.cElementTree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
 
 reload(sys)
 sys.setdefaultencoding("utf-8")
 
 # ============= PATTERNS =============
-CREATURE_PATTERN = re.compile(r'(?P<name>.+?)\n+(?P<metadata>.+?)\n+Armor Class (?P<ac>.+)\n+Hit Points (?P<hp>.+)\n+Speed (?P<speed>.+)\n+STR\n+(?P<strength>[0-9]+).+\n+DEX\n+(?P<dexterity>[0-9]+).+\n+CON\n(?P<constitution>[0-9]+).+\n+INT\n+(?P<intelligence>[0-9]+).+\n+WIS\n+(?P<wisdom>[0-9]+).+\n+CHA\n+(?P<charisma>[0-9]+).+\n+(Saving Throws (?P<savingthrows>.+)\n+)?(Skills (?P<skills>.+)\n+)?(Damage Vulnerabilities (?P<damagevulnerabilities>.+)\n+)?(Damage Resistances (?P<damageresistances>.+)\n+)?(Damage Immunities (?P<damageimmunities>.+)\n+)?(Condition Immunities (?P<conditionimmunities>.+)\n+)?(Senses (?P<senses>.+)\n+)?(Languages (?P<languages>.+)\n+)?(Challenge (?P<challenge>.+)\n+)?(?P<attributes>[\S\s]+?)??Actions(.+)??\n+(?P<actions>[\S\s]+?)(\n+Reactions\n+(?P<reactions>[\S\s]+?))?(\n+Legendary Actions\n+(?P<legendaryactions>[\S\s]+?))?(\n+Mythic Actions\n+(?P<mythicactions>[\S\s]+?))?\n{2}', re.MULTILINE)
 ITEM_PATTERN = re.compile(r'^(?P<itemtitle>.{0,45})\. (?P<itemdescription>[\S\s]+?(?=^.{0,45}\.|\Z))', re.MULTILINE)
 METADATA_PATTERN = re.compile(r'(?P<size>Tiny|Small|Medium|Large|Huge|Gargantuan) (?P<type>.+), (?P<alignment>.+)$', re.MULTILINE)
 CRUFT_PATTERN = re.compile(r'<.+?>', re.MULTILINE)
-KEEP_PATTERN = re.compile(r'((.+)?\n){3}Armor Class[\S\s]+?([\s]+?\n){8}', re.MULTILINE)
+# special html characters that will break the xml and csv output, and what they're replaced with
+HTML_ENTITIES = {"&minus;":"-", "&mdash;":"-", "&ndash;":"-", "&rsquo;":"'", "&nbsp;":" ", "&ldquo;":'"', "&rdquo;":'"', "&times;":'x', "&frac12;":'.5', "\r\n":"\n"}
+# everything preprocessHtml takes out or replaces, so it's all done in one pass: a line break followed by a
+# non-breaking space (even with tags between them), the html tags, and the entities
+HTML_DECODE_PATTERN = re.compile(r'\r?\n(?:<[^>\n]+>)*&nbsp;|' + CRUFT_PATTERN.pattern + '|' + '|'.join(re.escape(entity) for entity in HTML_ENTITIES))
 RATING_PATTERN = re.compile(r'[0-9]+(\/[0-9]+)?(?= \()', re.MULTILINE)
 TEST_PATTERN = re.compile(r'\nArmor Class (?P<ac>.+)\n.+', re.MULTILINE)
+# what's left out of a name when comparing slugs, so "Goblin Boss", "goblin-boss" and "Goblin  boss" are all the same monster
+SLUG_SEPARATOR_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+# Monster ids are made from this and the monster's slug, so the same monster gets the same id every time it's converted
+MONSTER_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/geoff-codes-things/scripts/convertDndHtmlStatBlocks")
+
+# Stat blocks are parsed a line at a time (see parseStatBlocks), so none of these can match more than one line.
+# The lines every stat block starts with after its name and metadata, in order, and the key each one's value goes in
+BLOCK_LINE_PATTERNS = [
+	(re.compile(r'Armor Class (?P<value>.+)'), 'ac'),
+	(re.compile(r'Hit Points (?P<value>.+)'), 'hp'),
+	(re.compile(r'Speed (?P<value>.+)'), 'speed'),
+	(re.compile(r'STR$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'strength'),
+	(re.compile(r'DEX$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'dexterity'),
+	(re.compile(r'CON$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'constitution'),
+	(re.compile(r'INT$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'intelligence'),
+	(re.compile(r'WIS$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'wisdom'),
+	(re.compile(r'CHA$'), None),
+	(re.compile(r'(?P<value>[0-9]+).+'), 'charisma')]
+# The lines that can come after the ability scores. Each is optional, but they're always in this order
+HEADER_LINE_PATTERNS = [
+	(re.compile(r'Saving Throws (?P<value>.+)'), 'savingthrows'),
+	(re.compile(r'Skills (?P<value>.+)'), 'skills'),
+	(re.compile(r'Damage Vulnerabilities (?P<value>.+)'), 'damagevulnerabilities'),
+	(re.compile(r'Damage Resistances (?P<value>.+)'), 'damageresistances'),
+	(re.compile(r'Damage Immunities (?P<value>.+)'), 'damageimmunities'),
+	(re.compile(r'Condition Immunities (?P<value>.+)'), 'conditionimmunities'),
+	(re.compile(r'Senses (?P<value>.+)'), 'senses'),
+	(re.compile(r'Languages (?P<value>.+)'), 'languages'),
+	(re.compile(r'Challenge (?P<value>.+)'), 'challenge')]
+# Headings of the sections that can come after Actions, also optional and always in this order
+SECTION_HEADINGS = [('Reactions', 'reactions'), ('Legendary Actions', 'legendaryactions'), ('Mythic Actions', 'mythicactions')]
+CREATURE_KEYS = ['name', 'metadata'] + [key for pattern, key in BLOCK_LINE_PATTERNS if key] + [key for pattern, key in HEADER_LINE_PATTERNS] + ['attributes', 'actions'] + [key for heading, key in SECTION_HEADINGS]
 
 
 # ============= ARGUMENTS =============
@@ -27,50 +75,176 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--files','-f', help='Files to process, string of paths separated by spaces. Spaces in path or file names should be escaped. eg "/tmp/Animals.txt,/tmp/Beasts\ large.txt,/tmp/Creatures.txt" Note: commas in the file names or paths will break things...', type=str, required=True)
 parser.add_argument('--output','-o', help='Specify type of output - console, csv, xml, or txt. Note: XML is formatted for use as a compendium with Encounter Plus.', choices=["console","csv","xml","txt"], required=False, default='console')
 parser.add_argument('--xmlinclude','-x', help='Path to an existing xml compendium for EncounterPlus, will keep anything in the existing compendium and add to it.', type=str, required=False)
+parser.add_argument('--workers','-j', help='Number of files to read and parse at once. Defaults to the number of CPUs.', type=int, required=False, default=multiprocessing.cpu_count())
+parser.add_argument('--cache_dir', help='Directory to keep the creatures read from each file in, so files that haven\'t changed don\'t have to be parsed again. Defaults to ~/.cache/convertDndHtmlStatBlocks.', type=str, required=False, default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "convertDndHtmlStatBlocks"))
+parser.add_argument('--cache_size', help='Largest size the cache can grow to in MB, the least recently used files are dropped past it. Default is 100.', type=float, required=False, default=100)
+parser.add_argument('--no_cache', help='Always parse every file, without reading or writing the cache.', action="store_true", required=False, default=False)
 parser.add_argument('--verbose','-v', help='For debugging', action="store_true", required=False, default=False)
 
 # ============= PROCESSING =============
 
-# preprocessHtml reads content from files and prepares them for processing
-# Removes a bunch of unused stuff from the files for efficiency, and subs for special chars that break things that aren't html
-# Returns one string with the processed content from the files
-def preprocessHtml(files):
-	results = "" # used to store results across multiple files
-
+# Splits the --files argument into the paths of the files
+def listFiles(files):
 	files = files.replace("\ ","&nbsp;") # super hacky. should do this right with a regex.
-
-	for file in files.split(" "):
-
-		file = file.replace("&nbsp;", " ") # like i said... super hacky.
-
-		verboseprint("processing " + str(file))
-		processedfile = "" # used to store reuslts for one particular file at a time
+	return [file.replace("&nbsp;", " ") for file in files.split(" ")] # like i said... super hacky.
+
+# Replaces each match of HTML_DECODE_PATTERN with what it should be. Tags, and line breaks followed by a non-breaking
+# space (for some reason there's somtimes one of those. Get ridda that...) are taken out.
+def decodeHtmlMatch(match):
+	return HTML_ENTITIES.get(match.group(), "")
+
+# preprocessHtml reads content from a file and prepares it for processing
+# Removes all the <span>'s and <div>'s and html we don't care about, and subs for special chars that break things that aren't html
+# The content can be passed if the file's already been read
+# Returns a string with the processed content from the file
+def preprocessHtml(file, processedfile=None):
+	verboseprint("processing " + str(file))
+	if processedfile is None:
 		reader = open(file, "r")
-
-		for line in reader:
-			processedfile += str(line)
-
-		# ditch all the <span>'s and <div>'s and html we don't care about
-		processedfile = re.sub(CRUFT_PATTERN, '', processedfile)
-
-		# just keep the body of the page where the stack blocks live, not necessary but more efficient
-		processedfile = re.search(KEEP_PATTERN, processedfile).group()
-
-		# for some reason there's somtimes a line break and a non-breaking space. Get ridda that...
-		processedfile = processedfile.replace("\n&nbsp;","")
-
-		# a bunch of special html characters that will break the xml and csv output
-		replacements = {"&minus;":"-", "&mdash;":"-", "&ndash;":"-", "&rsquo;":"'", "&nbsp;":" ", "&ldquo;":'"', "&rdquo;":'"', "&times;":'x', "&frac12;":'.5', "\r\n":"\n"}
-		for badstr, goodstr in replacements.iteritems():
-			verboseprint("Replacing " + badstr + " with " + goodstr)
-			processedfile = processedfile.replace(badstr, goodstr)
-
-		# done, add it to the complete results for all files
-		results += processedfile
-
-	verboseprint("Combined output after substitutions / removals: " + results)
-
-	return results
+		processedfile = reader.read()
+		reader.close()
+
+	processedfile = HTML_DECODE_PATTERN.sub(decodeHtmlMatch, processedfile)
+
+	verboseprint("Output after substitutions / removals for " + str(file) + ": " + processedfile)
+
+	return processedfile
+
+# Reads the creatures from one file, in a worker process when there's more than one
+# They come from the cache if the file's been parsed before (and cachedirectory is set)
+# Returns the creatures and whether they came from the cache
+def readCreaturesFromFile(file):
+	if not cachedirectory:
+		return createDictFromData(preprocessHtml(file), file), False
+
+	reader = open(file, "r")
+	content = reader.read()
+	reader.close()
+
+	key = cacheKey(content)
+	creatures = readCachedCreatures(cachedirectory, key)
+	if creatures is not None:
+		verboseprint("using cached creatures for " + str(file))
+		return creatures, True
+
+	creatures = createDictFromData(preprocessHtml(file, content), file)
+	writeCachedCreatures(cachedirectory, key, creatures)
+	return creatures, False
+
+def readerWorkerSetup(verbosestate, cachedir):
+	global verboseprint, cachedirectory
+	verboseprint = getverbosefunc(verbosestate)
+	cachedirectory = cachedir
+
+# Reads the creatures from every file, using a pool of worker processes to read and parse several files at once.
+# Each file's creatures are passed on as soon as it's been parsed (but in the order of the files) rather than
+# putting the text of every file together first.
+# Returns them all sorted by name
+def readCreatures(files, workers, verbosestate, cachedir=None, cachesize=None):
+	creatures = []
+	cachehits = 0
+	if workers < 2 or len(files) < 2:
+		readerWorkerSetup(verbosestate, cachedir)
+		for file in files:
+			filecreatures, cached = readCreaturesFromFile(file)
+			creatures += filecreatures
+			cachehits += cached
+	else:
+		pool = multiprocessing.Pool(min(workers, len(files)), readerWorkerSetup, (verbosestate, cachedir))
+		try:
+			for file, (filecreatures, cached) in zip(files, pool.imap(readCreaturesFromFile, files)):
+				verboseprint(str(len(filecreatures)) + " creatures read from " + file)
+				creatures += filecreatures
+				cachehits += cached
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+
+	if cachedir:
+		evicted, entries, cachebytes = evictCache(cachedir, cachesize)
+		verboseprint("Cache: " + str(cachehits) + " hits, " + str(len(files) - cachehits) + " misses, " + str(evicted) + " evicted, " + str(entries) + " files' creatures in " + str(round(cachebytes / 1024.0 / 1024.0, 2)) + " MB at " + cachedir)
+
+	return sorted(creatures, key=lambda k: k['name'])
+
+# ============= CACHE =============
+# The creatures read from each file are kept in cachedirectory as json, named by a hash of the file's content, so
+# when a file hasn't changed it doesn't have to be parsed again.
+cachedirectory = None
+
+# Bumped whenever a change to preprocessHtml or the parsing would change the creatures read from a file, so files
+# parsed by an older version are parsed again
+PARSER_VERSION = 1
+
+def cacheKey(content):
+	return hashlib.sha256(str(PARSER_VERSION) + "\0" + content).hexdigest()
+
+# json gives back unicode strings, the rest of the script expects them like they are when they're parsed
+def encodeStrings(value):
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	if isinstance(value, list):
+		return [encodeStrings(item) for item in value]
+	if isinstance(value, dict):
+		return dict((encodeStrings(key), encodeStrings(item)) for key, item in value.items())
+	return value
+
+# Returns the cached creatures for a key, or None if there aren't any (or they can't be read)
+def readCachedCreatures(cachedir, key):
+	cachefile = os.path.join(cachedir, key + ".json")
+	try:
+		reader = open(cachefile, "r")
+		try:
+			creatures = json.load(reader)
+		finally:
+			reader.close()
+		# marks it as recently used, so it's among the last to be evicted
+		os.utime(cachefile, None)
+	except (IOError, OSError, ValueError):
+		return None
+	return encodeStrings(creatures)
+
+# Saves the creatures for a key. The cache is only there to save time, so if it can't be written it's skipped.
+def writeCachedCreatures(cachedir, key, creatures):
+	cachefile = os.path.join(cachedir, key + ".json")
+	try:
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir)
+		# written under a name of its own and renamed, so a reader never sees half of it
+		tempfile = cachefile + "." + str(os.getpid()) + ".tmp"
+		writer = open(tempfile, "w")
+		json.dump(creatures, writer)
+		writer.close()
+		os.rename(tempfile, cachefile)
+	except (IOError, OSError) as e:
+		verboseprint("Unable to write cache file " + cachefile + ": " + str(e))
+
+# Deletes the least recently used cache files until the cache is under maxmegabytes
+# Returns the number of files deleted, and the number of files and bytes left
+def evictCache(cachedir, maxmegabytes):
+	entries = []
+	try:
+		for name in os.listdir(cachedir):
+			if name.endswith(".json"):
+				stat = os.stat(os.path.join(cachedir, name))
+				entries.append((stat.st_mtime, stat.st_size, name))
+	except OSError:
+		return 0, 0, 0
+
+	entries.sort()
+	cachebytes = sum(size for mtime, size, name in entries)
+	evicted = 0
+	while entries and cachebytes > maxmegabytes * 1024 * 1024:
+		mtime, size, name = entries.pop(0)
+		try:
+			os.remove(os.path.join(cachedir, name))
+		except OSError:
+			continue
+		cachebytes -= size
+		evicted += 1
+	return evicted, len(entries), cachebytes
 
 # For lists that have headings (eg actions, reactions, etc)
 # Breaks them up in separate items
@@ -85,13 +259,117 @@ def createItemList(originalstring):
 
 	return arrayOfItems
 
-# Takes a processed string based on the html file(s)
+# Reads the stat blocks out of a processed string based on the html file(s) in one pass over its lines.
+# A block starts with an Armor Class line, with its name and metadata on the two lines before it, and ends with a blank
+# line once its actions (and any reactions, legendary actions and mythic actions) have started.
+# Blocks that stop making sense partway through are reported and skipped, and parsing picks up again at the next one.
+# Yields a dict for each block with the text of each section, keyed the same as CREATURE_KEYS.
+# source is the file the text came from, to say where problems are.
+def parseStatBlocks(incomingdata, source=None):
+	where = source + ", line " if source else "line "
+	recent = [] # the last two lines with anything on them, to take a block's name and metadata from
+	creature = None # the block being parsed
+	startline = None # where it started, for reporting problems with it
+	state = None # which part of the block is next: 'lines', 'headers', 'attributes', 'section' or 'ending'
+
+	for number, line in enumerate(incomingdata.split("\n"), 1):
+		problem = None
+		consumed = True
+
+		if creature is None:
+			consumed = False
+
+		elif state == 'lines':
+			if line:
+				pattern, key = BLOCK_LINE_PATTERNS[position]
+				match = pattern.match(line)
+				if match is None:
+					problem = "expected a line like '" + pattern.pattern.replace('(?P<value>', '(').rstrip('$') + "' but found '" + line + "'"
+				else:
+					if key:
+						creature[key] = match.group('value')
+					position += 1
+					if position == len(BLOCK_LINE_PATTERNS):
+						state, position = 'headers', 0
+
+		elif state == 'headers':
+			if BLOCK_LINE_PATTERNS[0][0].match(line):
+				problem = "no Actions before the next stat block"
+			elif line:
+				for index in range(position, len(HEADER_LINE_PATTERNS)):
+					match = HEADER_LINE_PATTERNS[index][0].match(line)
+					if match:
+						creature[HEADER_LINE_PATTERNS[index][1]] = match.group('value')
+						position = index + 1
+						break
+				else:
+					if line.startswith("Actions"):
+						state, section, sectionlines, position = 'section', 'actions', [], 0
+					else:
+						state, sectionlines = 'attributes', [line]
+
+		elif state == 'attributes':
+			if line.startswith("Actions"):
+				creature['attributes'] = "".join(attribute + "\n" for attribute in sectionlines)
+				state, section, sectionlines, position = 'section', 'actions', [], 0
+			elif BLOCK_LINE_PATTERNS[0][0].match(line):
+				problem = "no Actions before the next stat block"
+			else:
+				sectionlines.append(line)
+
+		elif state in ('section', 'ending'):
+			headings = [heading for heading, key in SECTION_HEADINGS[position:]]
+			if line in headings and sectionlines:
+				creature[section] = "\n".join(sectionlines)
+				index = position + headings.index(line)
+				state, section, sectionlines, position = 'section', SECTION_HEADINGS[index][1], [], index + 1
+			elif not line:
+				if sectionlines:
+					state = 'ending'
+			elif state == 'ending':
+				# the blank line before this was the end of the block
+				creature[section] = "\n".join(sectionlines)
+				yield creature
+				creature, recent, consumed = None, [], False
+			elif BLOCK_LINE_PATTERNS[0][0].match(line) and len(sectionlines) > 2 and sectionlines[-2:] == recent:
+				# no blank line between this block and the next, whose name and metadata ended up in this one
+				creature[section] = "\n".join(sectionlines[:-2])
+				yield creature
+				creature, consumed = None, False
+			else:
+				sectionlines.append(line)
+
+		# the line might be the start of the next block
+		if problem:
+			print >> sys.stderr, "Skipping malformed stat block '" + creature['name'] + "' (" + where + str(startline) + "): " + problem
+			creature, consumed = None, False
+
+		if creature is None and not consumed:
+			match = BLOCK_LINE_PATTERNS[0][0].match(line)
+			if match and len(recent) < 2:
+				print >> sys.stderr, "Skipping malformed stat block (" + where + str(number) + "): no name and metadata before '" + line + "'"
+			elif match and not METADATA_PATTERN.match(recent[1]):
+				print >> sys.stderr, "Skipping malformed stat block '" + recent[0] + "' (" + where + str(number) + "): can't read the size, type and alignment from '" + recent[1] + "'"
+			elif match:
+				creature = dict.fromkeys(CREATURE_KEYS)
+				creature.update({'name': recent[0], 'metadata': recent[1], 'ac': match.group('value')})
+				state, position, startline = 'lines', 1, number
+
+		if line:
+			recent = recent[-1:] + [line]
+
+	if creature is not None:
+		if state in ('section', 'ending') and sectionlines:
+			creature[section] = "\n".join(sectionlines)
+			yield creature
+		else:
+			print >> sys.stderr, "Skipping malformed stat block '" + creature['name'] + "' (" + where + str(startline) + "): the file ended partway through it"
+
+# Takes a processed string based on the html file(s), and the file it's from if there's one
 # Turns it into a array of dictionaries with the values from the stat blocks
-def createDictFromData(incomingdata):
-	verboseprint("Applying match pattern for creature stat blocks")
-	verboseprint(str(CREATURE_PATTERN.pattern))
-	matches = [m.groupdict() for m in CREATURE_PATTERN.finditer(incomingdata)]
-	#matches = re.findall(TEST_PATTERN, incomingdata)
+def createDictFromData(incomingdata, source=None):
+	verboseprint("Parsing creature stat blocks")
+	matches = list(parseStatBlocks(incomingdata, source))
 	verboseprint("Matches found:" + str(len(matches)))
 
 	# create arrays of actions / attributes / etc
@@ -107,11 +385,9 @@ def createDictFromData(incomingdata):
 		if match['mythicactions'] != None:
 			match['mythicactionsarray'] = createItemList(match['mythicactions'])
 
-		if match['metadata'] != None:
-			metadamatch = re.match(METADATA_PATTERN, match['metadata'])
-			metadatadictraw = metadamatch.groupdict()
-			metadatadict = {'size' : metadatadictraw['size'], 'sizeabbreviated' : metadatadictraw['size'][0].upper(), 'type' : metadatadictraw['type'], 'alignment' : metadatadictraw['alignment']}
-			match['metadatadict'] = metadatadict
+		metadatadictraw = re.match(METADATA_PATTERN, match['metadata']).groupdict()
+		metadatadict = {'size' : metadatadictraw['size'], 'sizeabbreviated' : metadatadictraw['size'][0].upper(), 'type' : metadatadictraw['type'], 'alignment' : metadatadictraw['alignment']}
+		match['metadatadict'] = metadatadict
 
 	matches = sorted(matches, key=lambda k: k['name'])
 	return matches
@@ -174,8 +450,8 @@ def makeMonsterforEncounterPlus(creature):
 	# time to start creating some XML!
 	xmlmonster = ET.Element('monster')
 
-	# encounter plus wants a UUID for "id" of each monster
-	xmlmonster.set('id', str(uuid.uuid4(	)))
+	# encounter plus wants a UUID for "id" of each monster. It's based on the name, so re-importing a monster doesn't change it
+	xmlmonster.set('id', str(uuid.uuid5(MONSTER_ID_NAMESPACE, normalizeSlug(creature['name']).encode("utf-8"))))
 
 	# add all the stuff that's simple to correlate from above
 	for key in data_for_ep_monster.keys():
@@ -202,25 +478,55 @@ def makeMonsterforEncounterPlus(creature):
 
 	return xmlmonster
 
+# Lower case, with anything that isn't a letter or number squashed to a single hyphen
+# Used to tell whether two monsters are the same, however their names or slugs were written
+def normalizeSlug(name):
+	if not isinstance(name, unicode):
+		name = name.decode("utf-8")
+	return SLUG_SEPARATOR_PATTERN.sub("-", name.lower()).strip("-")
+
+# Generates the compendium XML a piece at a time, so it can be written out as it goes
+# With a startingxml, everything in it is streamed through (a top level element at a time, so the whole thing is
+# never in memory), then the creatures that aren't already in it are added at the end
 def generateXMLforEncounterPlus(creatures, startingxml):
 	verboseprint("converting " + str(len(creatures)) + " creatures to XML.")
-	namesalreadyincompendium = []
+	slugsincompendium = set()
 
 	if startingxml:
-		basexml = ET.parse(startingxml)
-		compendiumxml = basexml.getroot()
-		for monster in compendiumxml.iter('monster'):
-			namesalreadyincompendium.append(monster.get('slug'))
+		depth = 0
+		for event, element in ET.iterparse(startingxml, events=("start", "end")):
+			if event == "start":
+				depth += 1
+				if depth == 1:
+					compendiumxml = element
+					yield "<" + element.tag + "".join(" " + key + "=" + quoteattr(value) for key, value in sorted(element.items())) + ">"
+				continue
+
+			depth -= 1
+			if depth == 1:
+				if element.tag == 'monster':
+					slug = element.findtext('slug') or element.get('slug') or element.findtext('name')
+					if slug:
+						slugsincompendium.add(normalizeSlug(slug))
+				yield ET.tostring(element)
+				# done with it, so let it go
+				compendiumxml.clear()
+		verboseprint(str(len(slugsincompendium)) + " monsters already in " + startingxml)
+		compendiumtag = compendiumxml.tag
 	else:
-		compendiumxml = ET.Element('compendium')
+		compendiumtag = 'compendium'
+		yield "<" + compendiumtag + ">"
+
 	for creature in creatures:
-		if creature['name'] not in namesalreadyincompendium:
+		slug = normalizeSlug(creature['name'])
+		if slug not in slugsincompendium:
 			verboseprint(creature['name'] + " added to compendium xml.")
-			compendiumxml.append(makeMonsterforEncounterPlus(creature))
+			slugsincompendium.add(slug)
+			yield ET.tostring(makeMonsterforEncounterPlus(creature))
 		else:
 			verboseprint(creature['name'] + " already in compendium xml, appears to be duplicate, skipping.")
 
-	return compendiumxml
+	yield "</" + compendiumtag + ">"
 
 def generateCSV(creatures):
 	columns = ['name','size','type','alignment','ac','speed','strength','dexterity','constitution','intelligence','wisdom','charisma','savingthrows','skills','damagevulnerabilities','damageresistances','damageimmunities','conditionimmunities','senses','languages','challenge','attributes','actions','reactions','legendaryactions','mythicactions']
@@ -286,9 +592,9 @@ def writeXMLToFile(outputcontent):
 	newfilepath = newfileprefix + ".xml"
 
 	verboseprint("Creating XML file " + newfilepath)
-	tree = ET.ElementTree(outputcontent)
 	outputfile = open(newfilepath, "wb")
-	tree.write(outputfile)
+	for content in outputcontent:
+		outputfile.write(content)
 	outputfile.close()
 
 	formattedfilepath = newfileprefix + "-formatted.xml"
@@ -338,9 +644,12 @@ def run():
 
 	verboseprint = getverbosefunc(args.verbose)
 
-	dnddata = preprocessHtml(args.files)
+	if args.workers < 1:
+		parser.error("--workers must be at least 1")
+	if args.cache_size < 0:
+		parser.error("--cache_size can't be negative")
 
-	dnddata = createDictFromData(dnddata)
+	dnddata = readCreatures(listFiles(args.files), args.workers, args.verbose, None if args.no_cache else args.cache_dir, args.cache_size)
 
 	if args.output == 'xml':
 		outputcontent = generateXMLforEncounterPlus(dnddata, args.xmlinclude)
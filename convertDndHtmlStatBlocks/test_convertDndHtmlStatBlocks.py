@@ -0,0 +1,156 @@
+import os
+import random
+import re
+import sys
+import uuid
+
+import pytest
+
+if sys.version_info[0] >= 3:
+	pytest.skip("convertDndHtmlStatBlocks is a python 2 script", allow_module_level=True)
+
+import convertDndHtmlStatBlocks
+from convertDndHtmlStatBlocks import ET
+
+convertDndHtmlStatBlocks.verboseprint = convertDndHtmlStatBlocks.getverbosefunc(False)
+
+# Stat blocks like the ones in the html files once they've been through preprocessHtml, with a random mix of the
+# optional lines and sections
+def statBlock(name, rng):
+	lines = [name]
+	lines.append(rng.choice(['Tiny', 'Small', 'Medium', 'Large', 'Huge', 'Gargantuan']) + " " + rng.choice(['humanoid (goblinoid)', 'beast', 'dragon']) + ", " + rng.choice(['neutral evil', 'chaotic good', 'unaligned']))
+	lines.append("Armor Class %d (natural armor)" % rng.randint(10, 20))
+	lines.append("Hit Points %d (%dd8)" % (rng.randint(5, 300), rng.randint(1, 30)))
+	lines.append("Speed 30 ft., fly 60 ft.")
+	for ability in ['STR', 'DEX', 'CON', 'INT', 'WIS', 'CHA']:
+		lines += [ability, "%d (+%d)" % (rng.randint(3, 30), rng.randint(0, 9))]
+	for header in ['Saving Throws Dex +5', 'Skills Stealth +6', 'Damage Vulnerabilities fire', 'Damage Resistances cold', 'Damage Immunities poison', 'Condition Immunities charmed', 'Senses darkvision 60 ft., passive Perception 9', 'Languages Common, Goblin', 'Challenge ' + rng.choice(['1/4', '1/2', '3', '17']) + ' (50 XP)']:
+		if rng.random() < 0.6:
+			lines.append(header)
+	for trait in range(rng.randint(0, 3)):
+		lines.append("Trait %d. Something happens with this creature and it lasts a while." % trait)
+		if rng.random() < 0.3:
+			lines.append("A second paragraph of the trait.")
+	lines.append("Actions")
+	for action in range(rng.randint(1, 3)):
+		lines.append("Attack %d. Melee Weapon Attack: +4 to hit, reach 5 ft., one target. Hit: 5 (1d6 + 2) slashing damage." % action)
+	if rng.random() < 0.4:
+		lines += [""] * rng.randint(0, 1) + ["Reactions", "Parry. The creature adds 2 to its AC."]
+	if rng.random() < 0.3:
+		lines += ["Legendary Actions", "The creature can take 3 legendary actions.", "Detect. The creature makes a Wisdom check."]
+	if rng.random() < 0.2:
+		lines += ["Mythic Actions", "Mythic Thing. It does something."]
+	return lines
+
+def statBlocks(seed, count, prefix="Creature"):
+	rng = random.Random(seed)
+	lines = ["Some page header", "junk line"]
+	for index in range(count):
+		lines += statBlock(prefix + " " + str(index), rng) + [""] * rng.randint(1, 3)
+		if rng.random() < 0.3:
+			lines += ["Some interstitial text", ""]
+	return "\n".join(lines) + "\n\n"
+
+# ============= PARSING (user-022) =============
+
+# The regex the stat blocks were matched with before parseStatBlocks, for it to match
+OLD_CREATURE_PATTERN = re.compile(r'(?P<name>.+?)\n+(?P<metadata>.+?)\n+Armor Class (?P<ac>.+)\n+Hit Points (?P<hp>.+)\n+Speed (?P<speed>.+)\n+STR\n+(?P<strength>[0-9]+).+\n+DEX\n+(?P<dexterity>[0-9]+).+\n+CON\n(?P<constitution>[0-9]+).+\n+INT\n+(?P<intelligence>[0-9]+).+\n+WIS\n+(?P<wisdom>[0-9]+).+\n+CHA\n+(?P<charisma>[0-9]+).+\n+(Saving Throws (?P<savingthrows>.+)\n+)?(Skills (?P<skills>.+)\n+)?(Damage Vulnerabilities (?P<damagevulnerabilities>.+)\n+)?(Damage Resistances (?P<damageresistances>.+)\n+)?(Damage Immunities (?P<damageimmunities>.+)\n+)?(Condition Immunities (?P<conditionimmunities>.+)\n+)?(Senses (?P<senses>.+)\n+)?(Languages (?P<languages>.+)\n+)?(Challenge (?P<challenge>.+)\n+)?(?P<attributes>[\S\s]+?)??Actions(.+)??\n+(?P<actions>[\S\s]+?)(\n+Reactions\n+(?P<reactions>[\S\s]+?))?(\n+Legendary Actions\n+(?P<legendaryactions>[\S\s]+?))?(\n+Mythic Actions\n+(?P<mythicactions>[\S\s]+?))?\n{2}', re.MULTILINE)
+
+def test_parser_matches_the_old_regex():
+	for seed in range(20):
+		text = statBlocks(seed, 25)
+		expected = [match.groupdict() for match in OLD_CREATURE_PATTERN.finditer(text)]
+		creatures = list(convertDndHtmlStatBlocks.parseStatBlocks(text))
+		assert len(creatures) == 25
+		assert creatures == expected
+
+def test_parser_skips_a_malformed_block_and_reads_the_next():
+	rng = random.Random(1)
+	broken = statBlock("Broken", rng)
+	broken.remove([line for line in broken if line.startswith("Hit Points")][0])
+	text = "\n".join(statBlock("First", rng) + [""] + broken + [""] + statBlock("Last", rng)) + "\n\n"
+	assert [creature['name'] for creature in convertDndHtmlStatBlocks.parseStatBlocks(text, "test.html")] == ["First", "Last"]
+
+# ============= CACHE (user-024) =============
+
+def writeHtml(directory, name, text):
+	path = os.path.join(str(directory), name)
+	writer = open(path, "w")
+	writer.write("<html><body>\n" + "".join(('<p><span class="x">' + line + "</span></p>" if line else line) + "\n" for line in text.split("\n")) + "</body></html>\n")
+	writer.close()
+	return path
+
+def cacheFiles(cachedir):
+	return sorted(name for name in os.listdir(cachedir) if name.endswith(".json"))
+
+def test_cached_creatures_match_parsing(tmpdir):
+	files = [writeHtml(tmpdir, "a.html", statBlocks(1, 10, "A")), writeHtml(tmpdir, "b.html", statBlocks(2, 10, "B"))]
+	cachedir = os.path.join(str(tmpdir), "cache")
+	parsed = convertDndHtmlStatBlocks.readCreatures(files, 1, False)
+	assert len(parsed) == 20
+
+	assert convertDndHtmlStatBlocks.readCreatures(files, 1, False, cachedir, 100) == parsed
+	assert len(cacheFiles(cachedir)) == 2
+	assert convertDndHtmlStatBlocks.readCreatures(files, 1, False, cachedir, 100) == parsed
+	convertDndHtmlStatBlocks.readerWorkerSetup(False, cachedir)
+	assert convertDndHtmlStatBlocks.readCreaturesFromFile(files[0])[1]
+	convertDndHtmlStatBlocks.readerWorkerSetup(False, None)
+
+def test_a_changed_file_is_parsed_again(tmpdir):
+	cachedir = os.path.join(str(tmpdir), "cache")
+	path = writeHtml(tmpdir, "a.html", statBlocks(1, 5, "Old"))
+	convertDndHtmlStatBlocks.readCreatures([path], 1, False, cachedir, 100)
+
+	writeHtml(tmpdir, "a.html", statBlocks(1, 5, "New"))
+	convertDndHtmlStatBlocks.readerWorkerSetup(False, cachedir)
+	creatures, cached = convertDndHtmlStatBlocks.readCreaturesFromFile(path)
+	assert not cached
+	assert creatures == convertDndHtmlStatBlocks.createDictFromData(convertDndHtmlStatBlocks.preprocessHtml(path), path)
+	assert [creature['name'] for creature in creatures] == ["New " + str(index) for index in range(5)]
+	assert len(cacheFiles(cachedir)) == 2
+	convertDndHtmlStatBlocks.readerWorkerSetup(False, None)
+
+def test_eviction_drops_the_least_recently_used(tmpdir):
+	cachedir = str(tmpdir)
+	creatures = convertDndHtmlStatBlocks.createDictFromData(statBlocks(1, 3))
+	for modified, key in enumerate(["a", "b", "c"]):
+		convertDndHtmlStatBlocks.writeCachedCreatures(cachedir, key, creatures)
+		os.utime(os.path.join(cachedir, key + ".json"), (1000 + modified, 1000 + modified))
+	size = os.path.getsize(os.path.join(cachedir, "a.json"))
+
+	# reading it makes it the most recently used
+	assert convertDndHtmlStatBlocks.readCachedCreatures(cachedir, "a") == creatures
+	assert convertDndHtmlStatBlocks.evictCache(cachedir, size * 2 / 1024.0 / 1024.0) == (1, 2, size * 2)
+	assert cacheFiles(cachedir) == ["a.json", "c.json"]
+	assert convertDndHtmlStatBlocks.evictCache(cachedir, 0) == (2, 0, 0)
+
+# ============= COMPENDIUM MERGE (user-025) =============
+
+def writeCompendium(directory, content):
+	path = os.path.join(str(directory), "compendium.xml")
+	writer = open(path, "wb")
+	writer.write(content)
+	writer.close()
+	return path
+
+def test_reimporting_the_same_creatures_gives_the_same_compendium(tmpdir):
+	creatures = convertDndHtmlStatBlocks.createDictFromData(statBlocks(3, 10))
+	compendium = "".join(convertDndHtmlStatBlocks.generateXMLforEncounterPlus(creatures, None))
+	assert len(ET.fromstring(compendium).findall('monster')) == 10
+	assert "".join(convertDndHtmlStatBlocks.generateXMLforEncounterPlus(creatures, writeCompendium(tmpdir, compendium))) == compendium
+
+def test_merge_skips_monsters_already_there_by_slug(tmpdir):
+	existing = '<compendium version="5" auto_indent="NO"><item><name>Rope</name></item><monster><name>Kept</name><slug>creature_0</slug></monster><monster slug="CREATURE 1!"><name>Other</name></monster><monster><name>Creature  2</name></monster></compendium>'
+	creatures = convertDndHtmlStatBlocks.createDictFromData(statBlocks(3, 5))
+	merged = ET.fromstring("".join(convertDndHtmlStatBlocks.generateXMLforEncounterPlus(creatures, writeCompendium(tmpdir, existing))))
+	assert merged.items() == ET.fromstring(existing).items()
+	assert merged.findtext('item/name') == "Rope"
+	assert [monster.findtext('name') for monster in merged.findall('monster')] == ["Kept", "Other", "Creature  2", "Creature 3", "Creature 4"]
+
+def test_monster_ids_only_depend_on_the_slug():
+	creature = convertDndHtmlStatBlocks.createDictFromData(statBlocks(3, 1))[0]
+	renamed = dict(creature, name="CREATURE-0")
+	monster = convertDndHtmlStatBlocks.makeMonsterforEncounterPlus(creature)
+	assert monster.get('id') == str(uuid.uuid5(convertDndHtmlStatBlocks.MONSTER_ID_NAMESPACE, "creature-0"))
+	assert convertDndHtmlStatBlocks.makeMonsterforEncounterPlus(renamed).get('id') == monster.get('id')
+	assert convertDndHtmlStatBlocks.makeMonsterforEncounterPlus(dict(creature, name="Creature 1")).get('id') != monster.get('id')
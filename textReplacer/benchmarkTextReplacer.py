@@ -0,0 +1,286 @@
+# benchmarkTextReplacer
+#
+# This script is intended to:
+#    - Generate synthetic text and replacement csv files across a grid of sizes
+#    - Time each stage of textReplacer (reading the csv, replacing with and without close match warnings, writing the output)
+#      and record peak memory, saving the results as json
+#    - Compare two sets of results and flag anything that got slower or hungrier
+#
+# Each grid point runs in its own process so peak memory is measured per run rather than for the whole benchmark.
+#
+# Written by Geoff Kottmeier, 2025
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+
+import textReplacer
+
+# ============= ARGUMENTS =============
+parser = argparse.ArgumentParser(description="Benchmark textReplacer across a grid of text sizes and mapping counts.")
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+runparser = subparsers.add_parser("run", help="Generate the corpora and time textReplacer on them.")
+runparser.add_argument("-s", "--sizes", default="10KB,1MB,10MB", help="(Optional) Comma separated text sizes to generate, e.g. '10KB,1MB,1GB'. Default is 10KB,1MB,10MB.")
+runparser.add_argument("-m", "--mappings", default="10,1000,10000", help="(Optional) Comma separated numbers of mappings to generate, e.g. '10,1000,100000'. Default is 10,1000,10000.")
+runparser.add_argument("--wildcard_ratio", type=float, default=0.2, help="(Optional) Fraction of mappings that are '*' wildcard entries rather than whole words. Default is 0.2.")
+runparser.add_argument("--hit_ratio", type=float, default=0.1, help="(Optional) Fraction of words in the text that are taken from the mappings. Default is 0.1.")
+runparser.add_argument("--case_mix", default="70,20,7,3", help="(Optional) Relative weights of lower, Capitalized, UPPER and mIxEd case words in the text. Default is 70,20,7,3.")
+runparser.add_argument("--close_match_max_size", default="10MB", help="(Optional) Largest text size to also time with --close_match_warning. Default is 10MB.")
+runparser.add_argument("--stream", action="store_true", help="(Optional) Also time --stream mode for each grid point.")
+runparser.add_argument("--seed", type=int, default=1, help="(Optional) Random seed for the generated files. Default is 1.")
+runparser.add_argument("--work_dir", default=os.path.join("/tmp", "textReplacerBenchmark"), help="(Optional) Where generated files are kept. They're reused between runs with the same settings. Default is /tmp/textReplacerBenchmark.")
+runparser.add_argument("-o", "--output", help="(Optional) Path to save the results json to. If not passed, it's saved to /tmp/ with a timestamp.")
+
+compareparser = subparsers.add_parser("compare", help="Compare two results files and flag regressions.")
+compareparser.add_argument("baseline", help="Results json to compare against.")
+compareparser.add_argument("current", help="Results json to check.")
+compareparser.add_argument("-t", "--threshold", type=float, default=0.1, help="(Optional) How much slower or bigger (as a fraction) a measurement can get before it's flagged. Default is 0.1.")
+compareparser.add_argument("--min_seconds", type=float, default=0.05, help="(Optional) Timings under this many seconds in both runs are too noisy to flag. Default is 0.05.")
+
+# used internally, runs a single grid point so its memory use can be measured on its own
+caseparser = subparsers.add_parser("case")
+caseparser.add_argument("--text", required=True)
+caseparser.add_argument("--csv", required=True)
+caseparser.add_argument("--mode", choices=["replace", "close_match", "stream"], required=True)
+
+# ============= GENERATION =============
+
+# Turns a size like '10KB' or '1.5GB' into a number of bytes
+def parseSize(size):
+    units = {'GB': 1024 ** 3, 'MB': 1024 ** 2, 'KB': 1024, 'B': 1}
+    size = size.strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(size)
+
+# Makes up a word that looks vaguely like a real one
+def randomWord(rng, minlength=3, maxlength=12):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(minlength, maxlength)))
+
+# Changes the case of a word to one of lower, Capitalized, UPPER or mIxEd, picked by the casemix weights
+def applyCase(rng, word, casemix):
+    case = rng.choices(('lower', 'capitalized', 'upper', 'mixed'), weights=casemix)[0]
+    if case == 'capitalized':
+        return word.capitalize()
+    if case == 'upper':
+        return word.upper()
+    if case == 'mixed':
+        return ''.join(char.upper() if rng.random() < 0.5 else char for char in word)
+    return word
+
+# Writes a replacement csv with count mappings, some of them wildcards
+# Returns the words the mappings replace so the text can be made to include them
+def generateCsv(path, count, wildcardratio, rng):
+    beforewords = set()
+    while len(beforewords) < count:
+        beforewords.add(randomWord(rng, 4))
+    beforewords = sorted(beforewords)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('beforeReplacement,afterReplacement\n')
+        for word in beforewords:
+            if rng.random() < wildcardratio:
+                f.write(f'{word}*,{randomWord(rng)}*\n')
+            else:
+                f.write(f'{word},{randomWord(rng)}\n')
+    return beforewords
+
+# Writes roughly size bytes of text made of filler words and words from the mappings, a chunk at a time so
+# gigabyte sized files don't need gigabytes of memory.
+def generateText(path, size, mappingwords, hitratio, casemix, rng):
+    filler = [randomWord(rng) for _ in range(5000)]
+    # wildcard entries should be found inside longer words too
+    suffixes = ['', '', '', 's', 'ed', 'ing']
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            words = []
+            for _ in range(10000):
+                if rng.random() < hitratio:
+                    word = rng.choice(mappingwords) + rng.choice(suffixes)
+                else:
+                    word = rng.choice(filler)
+                words.append(applyCase(rng, word, casemix))
+                words.append(rng.choices((' ', ', ', '. ', '\n'), weights=(85, 7, 6, 2))[0])
+            chunk = ''.join(words)[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+# Generates (or reuses) the text and csv for a grid point, returning their paths
+def generateCase(args, size, mappingcount):
+    casemix = [float(weight) for weight in args.case_mix.split(',')]
+    settings = f'seed{args.seed}-wild{args.wildcard_ratio}-hit{args.hit_ratio}-case{"_".join(args.case_mix.split(","))}'
+    os.makedirs(args.work_dir, exist_ok=True)
+    csvpath = os.path.join(args.work_dir, f'mappings-{mappingcount}-{settings}.csv')
+    textpath = os.path.join(args.work_dir, f'text-{size}-{mappingcount}-{settings}.txt')
+
+    rng = random.Random(f'{args.seed}-{mappingcount}')
+    mappingwords = generateCsv(csvpath, mappingcount, args.wildcard_ratio, rng) if not os.path.exists(csvpath) else None
+    if not os.path.exists(textpath):
+        if mappingwords is None:
+            mappingwords = [before.rstrip('*') for before in textReplacer.readCsvFile(csvpath, False)]
+        verboseprint(f'Generating {textpath}')
+        generateText(textpath + '.tmp', size, mappingwords, args.hit_ratio, casemix, random.Random(f'{args.seed}-{size}-{mappingcount}'))
+        os.replace(textpath + '.tmp', textpath)
+
+    return textpath, csvpath
+
+# ============= MEASUREMENT =============
+
+# Peak resident memory of this process so far, in KB
+def peakMemory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes rather than KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+# Times one grid point in this process. Returns a dict of stage timings in seconds plus peak memory.
+def runCase(textpath, csvpath, mode):
+    timings = {}
+    outputpath = textpath + f'.{mode}.out'
+
+    start = time.perf_counter()
+    replacements = textReplacer.readCsvFile(csvpath, False)
+    timings['read_csv'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = textReplacer.buildMatcher(replacements)
+    timings['compile'] = time.perf_counter() - start
+
+    if mode == 'stream':
+        start = time.perf_counter()
+        with open(textpath, 'r', encoding='utf-8') as infile, open(outputpath, 'w', encoding='utf-8') as outfile:
+            textReplacer.replaceStreamSinglePass(infile, outfile, matcher, {}, 1024 * 1024)
+        timings['stream'] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        text = textReplacer.readTextFile(textpath)
+        timings['read_text'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            replacedtext = textReplacer.replaceStrings(text, replacements, False, mode == 'close_match', matcher=matcher)
+        timings['replace'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        textReplacer.writeOutputFile(outputpath, replacedtext)
+        timings['write_output'] = time.perf_counter() - start
+
+    os.remove(outputpath)
+    return {'timings': timings, 'peak_memory_kb': peakMemory()}
+
+# Runs every grid point in a fresh process and collects the results
+def runBenchmark(args):
+    sizes = [parseSize(size) for size in args.sizes.split(',')]
+    mappingcounts = [int(count) for count in args.mappings.split(',')]
+    closematchmax = parseSize(args.close_match_max_size)
+
+    results = []
+    for mappingcount in mappingcounts:
+        for size in sizes:
+            textpath, csvpath = generateCase(args, size, mappingcount)
+            modes = ['replace']
+            if size <= closematchmax:
+                modes.append('close_match')
+            if args.stream:
+                modes.append('stream')
+
+            for mode in modes:
+                print(f'Running {mode} with {size} bytes of text and {mappingcount} mappings...')
+                proc = subprocess.run([sys.executable, os.path.realpath(__file__), 'case', '--text', textpath, '--csv', csvpath, '--mode', mode], stdout=subprocess.PIPE, text=True)
+                if proc.returncode != 0:
+                    sys.exit(f'Benchmark case failed: {mode}, {size} bytes, {mappingcount} mappings')
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                result.update({'text_bytes': size, 'mappings': mappingcount, 'mode': mode})
+                results.append(result)
+                print(f"    {', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in result['timings'].items())}, peak memory {result['peak_memory_kb'] / 1024:.1f} MB")
+
+    return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'settings': {'wildcard_ratio': args.wildcard_ratio, 'hit_ratio': args.hit_ratio, 'case_mix': args.case_mix, 'seed': args.seed}},
+        'results': results}
+
+# ============= COMPARISON =============
+
+# Compares two sets of results, printing every measurement that got worse by more than threshold.
+# Returns the number of regressions found.
+def compareResults(baseline, current, threshold, minseconds):
+    baselinecases = {(result['text_bytes'], result['mappings'], result['mode']): result for result in baseline['results']}
+    regressions = 0
+
+    for result in current['results']:
+        key = (result['text_bytes'], result['mappings'], result['mode'])
+        if key not in baselinecases:
+            print(f'New case (no baseline): {key[2]}, {key[0]} bytes, {key[1]} mappings')
+            continue
+        old = baselinecases[key]
+
+        measurements = [(stage, old['timings'].get(stage), seconds, 's') for stage, seconds in result['timings'].items()]
+        measurements.append(('peak_memory', old['peak_memory_kb'] / 1024, result['peak_memory_kb'] / 1024, 'MB'))
+        for name, before, after, unit in measurements:
+            if before is None:
+                continue
+            if unit == 's' and max(before, after) < minseconds:
+                continue
+            change = (after - before) / before if before else 0
+            flag = 'REGRESSION' if change > threshold else 'ok'
+            if change > threshold:
+                regressions += 1
+            print(f'{flag:>10}  {key[2]:<11} {key[0]:>12} bytes {key[1]:>7} mappings  {name:<12} {before:10.3f}{unit} -> {after:10.3f}{unit} ({change:+.1%})')
+
+    return regressions
+
+# ============= CONSOLE OUTPUT =============
+verboseprint = textReplacer.verbosePrintSetup(False)
+textReplacer.verboseprint = verboseprint
+
+# ============= EXECUTION =============
+def run():
+    args = parser.parse_args()
+
+    if args.command == 'case':
+        print(json.dumps(runCase(args.text, args.csv, args.mode)))
+        return
+
+    if args.command == 'compare':
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        regressions = compareResults(baseline, current, args.threshold, args.min_seconds)
+        if regressions:
+            sys.exit(f'{regressions} regressions found.')
+        print('No regressions found.')
+        return
+
+    results = runBenchmark(args)
+    outputfile = args.output or os.path.join("/tmp", f"textReplacer_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(outputfile, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark completed. Results saved to '{outputfile}'.")
+
+def main():
+    try:
+        run()
+        sys.exit(0)
+    except KeyboardInterrupt:
+        sys.exit('\nUser canceled... Stopping\n')
+    except Exception as e:
+        print('An unexpected error occurred: %s' % str(e), file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import io
+import os
+import random
+import string
+
+import pytest
+
+import textReplacer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+SAMPLE_TEXT = os.path.join(HERE, "sample-text.txt")
+SAMPLE_CSV = os.path.join(HERE, "sample-replacements.csv")
+
+@pytest.fixture(autouse=True)
+def quiet():
+    textReplacer.verboseprint = textReplacer.verbosePrintSetup(False)
+    textReplacer.verbosematches = False
+
+# Mappings where no entry can be found inside another entry or any replacement, so the order the sequential mode
+# applies them in doesn't matter and it has to give the same output as the single pass
+def independentMappings(seed, count=200):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < count * 2:
+        words.add(''.join(rng.choice('bcdfghjklmnpqrstvwxz') for _ in range(rng.randint(3, 9))))
+    words = sorted(words)
+    keys = [word for word in words[:count] if not any(word != other and word in other for other in words)]
+    replacements = {}
+    for key in keys:
+        after = ''.join(rng.choice('aeiouy') for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.2:
+            replacements[key + '*'] = after
+        else:
+            replacements[key] = after
+    return replacements, words
+
+def randomText(rng, words, length):
+    pieces = []
+    for _ in range(length):
+        word = rng.choice(words)
+        pieces.append(rng.choice([word, word.upper(), word.capitalize(), word + rng.choice(['ing', 's', '_x'])]))
+        pieces.append(rng.choice([' ', ' ', ', ', '.\n', '\r\n', '-']))
+    return ''.join(pieces)
+
+# ============= SINGLE PASS (user-001) =============
+
+def test_single_pass_matches_sequential_on_sample():
+    replacements = textReplacer.readCsvFile(SAMPLE_CSV, False)
+    text = textReplacer.readTextFile(SAMPLE_TEXT)
+    sequentialcounts = {}
+    singlepasscounts = {}
+    sequential = textReplacer.replaceStringsSequential(text, replacements, sequentialcounts)
+    singlepass = textReplacer.replaceStringsSinglePass(text, textReplacer.buildMatcher(replacements), singlepasscounts)
+    assert singlepass == sequential
+    assert singlepasscounts == sequentialcounts
+    assert singlepass != text
+
+@pytest.mark.parametrize('seed', range(5))
+def test_single_pass_matches_sequential_on_independent_mappings(seed):
+    replacements, words = independentMappings(seed)
+    text = randomText(random.Random(seed), words, 3000)
+    sequentialcounts = {}
+    singlepasscounts = {}
+    sequential = textReplacer.replaceStringsSequential(text, replacements, sequentialcounts)
+    singlepass = textReplacer.replaceStringsSinglePass(text, textReplacer.buildMatcher(replacements), singlepasscounts)
+    assert singlepass == sequential
+    assert singlepasscounts == sequentialcounts
+
+def test_single_pass_prefers_the_longest_entry_and_keeps_case():
+    replacements = {'cat': 'dog', 'catalog': 'index', 'bird*': 'fish*'}
+    counts = {}
+    text = textReplacer.replaceStringsSinglePass("Cat catalog CATALOG category birdhouse", textReplacer.buildMatcher(replacements), counts)
+    assert text == "Dog index INDEX category fishhouse"
+    assert counts == {'cat': 1, 'catalog': 2, 'bird*': 1}
+
+def test_single_pass_never_rewrites_a_replacement():
+    replacements = {'apple': 'pear', 'pear': 'plum'}
+    assert textReplacer.replaceStringsSinglePass("apple pear", textReplacer.buildMatcher(replacements), {}) == "pear plum"
+
+# ============= STREAMING (user-002) =============
+
+@pytest.mark.parametrize('chunksize', [1, 2, 3, 7, 64, 4096])
+def test_stream_matches_in_memory(chunksize):
+    replacements, words = independentMappings(7)
+    replacements.update({'bcd fgh': 'spanning', 'zz*': 'w'})
+    text = randomText(random.Random(7), words + ['bcd fgh'], 2000)
+    matcher = textReplacer.buildMatcher(replacements)
+    inmemorycounts = {}
+    inmemory = textReplacer.replaceStringsSinglePass(text, matcher, inmemorycounts)
+
+    streamcounts = {}
+    outfile = io.StringIO()
+    length = textReplacer.replaceStreamSinglePass(io.StringIO(text), outfile, matcher, streamcounts, chunksize)
+    assert outfile.getvalue() == inmemory
+    assert streamcounts == inmemorycounts
+    assert length == len(text)
+
+def test_stream_file_matches_in_memory_on_sample(tmp_path):
+    replacements = textReplacer.readCsvFile(SAMPLE_CSV, False)
+    output = tmp_path / "out.txt"
+    counts = textReplacer.streamReplaceFile(SAMPLE_TEXT, str(output), replacements, False, 16)
+    expected = {}
+    text = textReplacer.replaceStrings(textReplacer.readTextFile(SAMPLE_TEXT), replacements, False, False, counts=expected)
+    assert textReplacer.readTextFile(str(output)) == text
+    assert counts == expected
+
+# ============= BATCH (user-004) =============
+
+def batchArgs(**overrides):
+    args = dict(workers=1, sequential=False, stream=False, chunk_size=64, stats=None, verbose=False)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+@pytest.mark.parametrize('overrides', [{}, {'stream': True}, {'sequential': True}, {'workers': 2}])
+def test_batch_skips_files_it_cant_decode(tmp_path, overrides):
+    source = tmp_path / "in"
+    (source / "sub").mkdir(parents=True)
+    (source / "a.txt").write_text("hello world", encoding='utf-8')
+    (source / "sub" / "b.txt").write_text("Hello again", encoding='utf-8')
+    (source / "bad.txt").write_bytes(b"hello \xff\xfe")
+    output = tmp_path / "out"
+
+    files, counts, stats, inputbytes, outputbytes, skipped = textReplacer.replaceBatch([str(source)], str(output), {'hello': 'bye'}, batchArgs(**overrides))
+    assert files == 2
+    assert counts == {'hello': 2}
+    assert [os.path.basename(path) for path, error in skipped] == ["bad.txt"]
+    assert (output / "a.txt").read_text(encoding='utf-8') == "bye world"
+    assert (output / "sub" / "b.txt").read_text(encoding='utf-8') == "Bye again"
+    assert not (output / "bad.txt").exists()
+    assert outputbytes == len("bye world") + len("Bye again")
+
+# ============= MAPPING CACHE (user-005) =============
+
+def test_cached_mappings_give_the_same_output(tmp_path):
+    cachedir = str(tmp_path / "cache")
+    text = textReplacer.readTextFile(SAMPLE_TEXT)
+    replacements, matcher = textReplacer.loadMappings(SAMPLE_CSV, False, cachedir, 10)
+    assert len(os.listdir(cachedir)) == 1
+    cachedreplacements, cachedmatcher = textReplacer.loadMappings(SAMPLE_CSV, False, cachedir, 10)
+    assert cachedreplacements == replacements
+    assert textReplacer.replaceStringsSinglePass(text, cachedmatcher, {}) == textReplacer.replaceStringsSinglePass(text, matcher, {})
+
+    # reversed mappings are cached separately
+    textReplacer.loadMappings(SAMPLE_CSV, True, cachedir, 10)
+    assert len(os.listdir(cachedir)) == 2
+
+def test_a_cached_program_that_doesnt_match_is_recompiled():
+    stored = textReplacer.storableMatcher(textReplacer.buildMatcher({'alpha': 'x', 'beta': 'y', 'gamma': 'z'}))
+    other = textReplacer.storableMatcher(textReplacer.buildMatcher({'delta': 'x', 'epsilon': 'y', 'zeta': 'z'}))
+    if stored['program'] is None:
+        pytest.skip("this python can't save compiled patterns")
+    mismatched = dict(stored, program=dict(other['program'], groupindex=stored['program']['groupindex']))
+    broken = dict(stored, program=dict(stored['program'], code=[0, 1, 2]))
+    for matcher in (mismatched, broken):
+        restored = textReplacer.restoreMatcher(matcher)
+        assert textReplacer.replaceStringsSinglePass("alpha delta Beta", restored, {}) == "x delta Y"
+
+# ============= JOURNAL (user-006) =============
+
+UNDO_TEXT = "Hello world,\r\nthe Cat sat on the catalog.\nnaïve HELLO café\r\n" * 50
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_undo_restores_the_input_exactly(tmp_path, stream):
+    source = tmp_path / "in.txt"
+    source.write_bytes(UNDO_TEXT.encode('utf-8'))
+    replaced = tmp_path / "replaced.txt"
+    restored = tmp_path / "restored.txt"
+    journal = str(tmp_path / "journal.jsonl")
+    replacements = {'hello': 'greetings', 'cat': 'dog', 'catalog': 'list', 'café': 'bar'}
+
+    if stream:
+        textReplacer.streamReplaceFile(str(source), str(replaced), replacements, False, 7, journalFile=journal)
+    else:
+        text = textReplacer.readTextFile(str(source), '')
+        opened = textReplacer.openJournal(journal)
+        output = textReplacer.replaceStrings(text, replacements, False, False, journal=opened)
+        textReplacer.closeJournal(opened, len(text))
+        textReplacer.writeOutputFile(str(replaced), output, '')
+
+    assert replaced.read_bytes() != source.read_bytes()
+    textReplacer.undoFromJournal(str(replaced), str(restored), journal, 5)
+    assert restored.read_bytes() == source.read_bytes()
+
+def test_undo_refuses_text_that_doesnt_match_the_journal(tmp_path):
+    source = tmp_path / "in.txt"
+    source.write_text("hello there", encoding='utf-8')
+    replaced = tmp_path / "replaced.txt"
+    journal = str(tmp_path / "journal.jsonl")
+    textReplacer.streamReplaceFile(str(source), str(replaced), {'hello': 'bye'}, False, 64, journalFile=journal)
+    replaced.write_text("howdy there", encoding='utf-8')
+    with pytest.raises(SystemExit):
+        textReplacer.undoFromJournal(str(replaced), str(tmp_path / "restored.txt"), journal, 64)
+
+# ============= WATCH (user-010) =============
+
+def test_watched_edits_give_the_same_output_as_a_full_replacement(monkeypatch):
+    monkeypatch.setattr(textReplacer, 'WATCH_SEGMENT_SIZE', 50)
+    replacements, words = independentMappings(3)
+    matcher = textReplacer.buildMatcher(replacements)
+    rng = random.Random(3)
+    text = randomText(rng, words, 400)
+    state = {}
+    textReplacer.updateWatchedFile(state, text, matcher, {})
+
+    for _ in range(40):
+        start = rng.randrange(len(text))
+        end = min(len(text), start + rng.randrange(30))
+        text = text[:start] + randomText(rng, words, rng.randrange(3)) + text[end:]
+        textReplacer.updateWatchedFile(state, text, matcher, {})
+        output = b''.join(segment[1] for segment in state['segments']).decode('utf-8').replace(os.linesep, '\n')
+        assert output == textReplacer.replaceStringsSinglePass(text, matcher, {}).replace(os.linesep, '\n')
@@ -6,35 +6,103 @@
 # It can also:
 #    - Warn the user if strings were encountered that closely match a string intended for replacement
 #    - Save the result to a user defined or default file path
+#    - Stream very large files (or stdin / stdout) through in chunks instead of reading them in all at once
+#    - Run the same replacements over whole directory trees in parallel
+#    - Cache the compiled replacement mappings on disk so big csv files don't have to be recompiled every run
+#    - Keep a journal of every replacement made, which can be used to exactly undo them later
+#    - Run as a local service that keeps replacement tables loaded, with a client mode that takes the usual arguments
+#    - Record per mapping and overall statistics for a run as json or csv
+#    - Watch files and keep their output up to date as they're edited, only redoing the parts that changed
 #
 # Written by Geoff Kottmeier, 2025
 
 import argparse
+import bisect
+import concurrent.futures
+import contextlib
 import csv
+import glob
+import hashlib
+import http.client
+import http.server
+import json
+import math
+import pickle
 import re
 import datetime
 import os
+import socket
+import socketserver
+import statistics
+import threading
+import time
+import urllib.parse
 from datetime import datetime
 import sys
 import traceback
 
+# The compiled form of a regex can only be saved in the mapping cache when python's regex internals are laid out
+# the way we expect (python 3.11+). Otherwise the cache still saves reading the csv, and the regex gets recompiled.
+try:
+    import _sre
+    from re import _compiler as srecompiler, _parser as sreparser
+except ImportError:
+    _sre = None
+
+# only used to report peak memory in --stats, which isn't available on windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # ============= ARGUMENTS =============
 parser = argparse.ArgumentParser(description="Replace strings in a text file.")
-parser.add_argument("-t","--text", help="Path to the input text file.", required=True)
-parser.add_argument("-c","--csv", help="Path to the CSV file containing replacement mappings. It should be two columns with the headings 'beforeReplacement' and 'afterReplacement'.\nNote: default is to match complete strings (e.g. replacing 'ant' with 'bug' would NOT replace the first part of 'anthill' or change 'ants' to 'bugs'. Adding a *, like 'ant*' would change all cases of the string, thus making it 'bughill' and 'bugs'. If you want this to be reversible, both columns should have a * at the end of the string.)", required=True)
-parser.add_argument("-o","--output", help="(Optional) Path to the output text file. If not passed, new file will be saved to /tmp/ with a timestamp.", required=False)
+inputgroup = parser.add_mutually_exclusive_group()
+inputgroup.add_argument("-t","--text", help="Path to the input text file. Use '-' to read from stdin.")
+inputgroup.add_argument("-b","--batch", nargs="+", help="Paths to files, directories (processed recursively) or globs (e.g. 'docs/**/*.txt', quoted) to run the replacements over. Output is written to a copy of the directory structure under --output.")
+parser.add_argument("-c","--csv", help="Path to the CSV file containing replacement mappings. It should be two columns with the headings 'beforeReplacement' and 'afterReplacement'.\nNote: default is to match complete strings (e.g. replacing 'ant' with 'bug' would NOT replace the first part of 'anthill' or change 'ants' to 'bugs'. Adding a *, like 'ant*' would change all cases of the string, thus making it 'bughill' and 'bugs'. If you want this to be reversible, both columns should have a * at the end of the string.) Not needed with --undo or --server.", required=False)
+parser.add_argument("-o","--output", help="(Optional) Path to the output text file, or the output directory in --batch mode. If not passed, new file will be saved to /tmp/ with a timestamp. Use '-' to write to stdout.", required=False)
+parser.add_argument("-j","--workers", type=int, default=os.cpu_count(), help="(Optional) Number of processes used to work through files in --batch mode. Defaults to the number of CPUs.", required=False)
 parser.add_argument("-v", "--verbose", action="store_true", help="(Optional) Enables verbose output to provide additional logging in the console.", required=False)
 parser.add_argument("-r", "--reverse", action="store_true", help="(Optional) Inverts the 'before' and 'after' columns to run the replacement in revers order.", required=False)
+parser.add_argument("--journal", help="(Optional) Path to write a journal of every replacement made to. Passing it to --undo along with the output restores the original text exactly, including anything --reverse couldn't (case changes, overlapping mappings). Line endings are left as they are in the input when a journal is kept.", required=False)
+parser.add_argument("-u", "--undo", help="(Optional) Path to a journal written by --journal. Undoes the replacements it recorded in --text (which should be the output of that run) and saves the original text to --output.", required=False)
+parser.add_argument("-s", "--sequential", action="store_true", help="(Optional) Runs each mapping over the whole text one after another, in csv order (the original behavior). Later mappings can then replace the output of earlier ones. By default all mappings are matched in a single pass, preferring the longest match.", required=False)
+parser.add_argument("--stream", action="store_true", help="(Optional) Reads the input and writes the output a chunk at a time, so memory use depends on the chunk size rather than the size of the file. Output is identical to a normal run. Can't be combined with --sequential or --close_match_warning.", required=False)
+parser.add_argument("--chunk_size", type=int, default=1024 * 1024, help="(Optional) Number of characters read at a time in --stream mode. Default is 1048576.", required=False)
+parser.add_argument("--cache_dir", default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "textReplacer"), help="(Optional) Directory to keep compiled replacement mappings in. Defaults to ~/.cache/textReplacer.", required=False)
+parser.add_argument("--cache_size", type=int, default=256, help="(Optional) Maximum size of the cache directory in MB. The least recently used mappings are removed first. Default is 256.", required=False)
+parser.add_argument("--no_cache", action="store_true", help="(Optional) Always reads and compiles the csv from scratch, without reading or writing the cache.", required=False)
+parser.add_argument("--clear_cache", action="store_true", help="(Optional) Empties the cache directory before running.", required=False)
+parser.add_argument("--serve", action="store_true", help="(Optional) Runs as a service that keeps the --table mappings loaded and answers replace requests over local HTTP (--port) or a unix socket (--socket), instead of replacing a file.", required=False)
+parser.add_argument("--table", action="append", help="(Optional) With --serve, a table to load as NAME=CSV_PATH (can be passed more than once, -c is loaded as 'default'). With --server, the NAME of the table to use (default is 'default').", required=False)
+parser.add_argument("--port", type=int, default=8750, help="(Optional) Port for --serve to listen on, on 127.0.0.1. Default is 8750.", required=False)
+parser.add_argument("--socket", help="(Optional) Path of a unix socket for --serve to listen on instead of a port.", required=False)
+parser.add_argument("--reload_interval", type=float, default=2.0, help="(Optional) How often (in seconds) --serve checks the table csv files for changes and reloads them, and --watch checks the input and csv files. Default is 2.", required=False)
+parser.add_argument("--server", help="(Optional) Sends the text to a running --serve service instead of replacing it here, e.g. 'http://127.0.0.1:8750' or 'unix:/tmp/textReplacer.sock'. Takes the same arguments as a normal run.", required=False)
+parser.add_argument("--watch", action="store_true", help="(Optional) Keeps running and updates the output whenever the --text file (or --batch files) or the csv changes. Only the part of the output around each edit is replaced again, the output is the same as a full run.", required=False)
+parser.add_argument("--stats", help="(Optional) Path to save statistics about the run to: for each mapping the number of matches, replacements, and time spent compiling and substituting, plus the overall bytes processed, time per stage, throughput and peak memory. Use '-' to print them. In single pass modes each mapping's substitution time is the time spent replacing its matches, the time spent scanning the text is shared and reported overall.", required=False)
+parser.add_argument("--stats_format", choices=["json", "csv"], help="(Optional) Format for --stats. Defaults to csv if the --stats path ends in .csv, otherwise json.", required=False)
 parser.add_argument("-w", "--close_match_warning", action="store_true", help="Enables close match warning mode. If a string closely matches one being replaced, displays a warning in the console with the close match and its context.", required=False)
+parser.add_argument("--close_match_threshold", type=float, default=0.7, help="(Optional) How similar a word has to be to a string being replaced to count as a close match in --close_match_warning mode, from 0 to 1. Similarity is 1 minus the edit distance divided by the length of the longer string. Default is 0.7.", required=False)
 
 # ============= FILE INTERACTION =============
 
+# Opens a text file for reading or writing, '-' being stdin or stdout
+# stdin / stdout are reopened as utf-8 so the result is the same as using a file
+# newline is passed on to open, '' leaves line endings untouched
+def openTextFile(textFile, mode, newline=None):
+    if textFile == '-':
+        stdstream = sys.__stdin__ if mode == 'r' else sys.__stdout__
+        return open(stdstream.fileno(), mode, encoding='utf-8', newline=newline, closefd=False)
+    return open(textFile, mode, encoding='utf-8', newline=newline)
+
 # Reads a text file in.
 # If file can't be found, bails the script with an error
-def readTextFile(textFile):
+def readTextFile(textFile, newline=None):
     verboseprint(f'Attempting to read {textFile}')
     try:
-        with open(textFile, 'r', encoding='utf-8') as f:
+        with openTextFile(textFile, 'r', newline) as f:
             return f.read()
     except FileNotFoundError:
         sys.exit(f"Text file '{textFile}' not found.")
@@ -61,9 +129,9 @@ def readCsvFile(csvFile, reverse):
 
 # Writes text to a file at a provided path
 # Bails out of the script if an issue occurs attempting to do so
-def writeOutputFile(outputFile, text):
+def writeOutputFile(outputFile, text, newline=None):
     try:
-        with open(outputFile, 'w', encoding='utf-8') as f:
+        with openTextFile(outputFile, 'w', newline) as f:
             f.write(text)
         return True
     except Exception as e:
@@ -74,21 +142,25 @@ def writeOutputFile(outputFile, text):
 # Replaces a specific string
 # Attempts to preserve case (i.e. 'lower', 'Capitalized', or 'ALLCAPS')
 # If the case is mixed, just sticks with 
+# This runs for every match, so the verbose messages are only put together when verbosematches is on
 def replaceMatch(match, after, count):
     original = match.group(0)
 
     if original.isupper(): 
         # if original is all caps
         result = after.upper()
-        verboseprint(f'Encountered ALL-CAPS case "{original}"", using "{result}"')
+        if verbosematches:
+            verboseprint(f'Encountered ALL-CAPS case "{original}"", using "{result}"')
     elif original.islower(): 
         # if original is all lower
         result = after.lower()
-        verboseprint(f'Encountered all-lower case "{original}"", using "{result}"')
+        if verbosematches:
+            verboseprint(f'Encountered all-lower case "{original}"", using "{result}"')
     elif original and original[0].isupper() and (len(original) == 1 or original[1:].islower()):
         # if first letter is capitalized and it's only one character or the rest of the string is lower case 
         result = after.capitalize()
-        verboseprint(f'Encountered Capitalized case "{original}"", using "{result}"')
+        if verbosematches:
+            verboseprint(f'Encountered Capitalized case "{original}"", using "{result}"')
     else:
         # For mixed case, respect the capitalization of the first letter from the text file.
         # The rest of the string will simply preserve capitilization from the csv.
@@ -96,56 +168,1149 @@ def replaceMatch(match, after, count):
             result = after[0].upper() + after[1:] if len(after) > 1 else after[0].upper()
         else:
             result = after[0].lower() + after[1:] if len(after) > 1 else after[0].lower()
-        verboseprint(f'Encountered mixed capitilization case "{original}", using "{result}" (preserving case of first letter)')
+        if verbosematches:
+            verboseprint(f'Encountered mixed capitilization case "{original}", using "{result}" (preserving case of first letter)')
 
     if result != original:
         count[0] += 1
     return result
 
-def replaceStrings(text, replacements, reverse, close_match_warning):
+# Builds a single matcher for every entry in the replacement mappings so the text only has to be scanned once.
+# Entries are folded into a trie (case-insensitively, same as the sequential mode) and turned into one regex.
+# At each position the longest entry wins, and scanning picks up after the end of the last match (leftmost-longest).
+# Word boundaries for the non-wildcard entries are checked at the end of each entry, since that's the only place
+# its length is known. Returns a dict with the compiled pattern, the entries it can match, and the longest entry length.
+def buildMatcher(replacements):
+    entries = []
+    trie = {}
+
+    for before, after in replacements.items():
+        wildcard = before.endswith("*")
+        key = before[:-1] if wildcard else before
+        if not key:
+            verboseprint(f'Skipping empty replacement "{before}"')
+            continue
+        if wildcard and after.endswith("*"):
+            after = after[:-1]
+
+        node = trie
+        for char in key:
+            folded = char.lower()
+            node = node.setdefault(folded if len(folded) == 1 else char, {})
+
+        # if two rows only differ by case, the first one in the csv wins
+        terminals = node.setdefault(None, {})
+        kind = 'wildcard' if wildcard else 'word'
+        if kind not in terminals:
+            terminals[kind] = len(entries)
+            entries.append({'before': before, 'after': after, 'key': key, 'wildcard': wildcard})
+
+    regex = trieToRegex(trie, entries) if entries else None
+    program = compileRegexProgram(regex, re.IGNORECASE) if entries else None
+    longest = max((len(entry['key']) for entry in entries), default=0)
+    return restoreMatcher({'regex': regex, 'program': program, 'entries': entries, 'longest': longest})
+
+# Compiles a regex down to the program python's regex engine runs, so it can be saved and loaded without recompiling.
+# Returns None if this version of python doesn't allow it.
+def compileRegexProgram(regex, flags):
+    if _sre is None:
+        return None
+    try:
+        parsed = sreparser.parse(regex, flags)
+        code = [int(op) for op in srecompiler._code(parsed, flags)]
+    except Exception:
+        return None
+    return {'flags': flags | parsed.state.flags, 'code': code, 'groups': parsed.state.groups, 'groupindex': dict(parsed.state.groupdict)}
+
+# Turns a program from compileRegexProgram back into a compiled regex, which is much faster than re.compile for big
+# patterns. The program is only as good as the python internals that made it, so the loaded pattern has to describe
+# the same regex and fully match each of probes (strings with one character either side of a match) before it's used.
+# Falls back on re.compile if there is no program, or python doesn't accept it or it fails those checks.
+def loadRegexProgram(regex, flags, program, probes=()):
+    if program is not None and _sre is not None:
+        try:
+            indexgroup = [None] * program['groups']
+            for name, index in program['groupindex'].items():
+                indexgroup[index] = name
+            pattern = _sre.compile(regex, program['flags'], program['code'], program['groups'] - 1, program['groupindex'], tuple(indexgroup))
+            if pattern.pattern == regex and pattern.groups == program['groups'] - 1 and dict(pattern.groupindex) == program['groupindex'] and all(matchesProbe(pattern, probe) for probe in probes):
+                return pattern
+            verboseprint("The compiled pattern doesn't match what it was compiled from, recompiling it")
+        except Exception:
+            verboseprint("Couldn't load the compiled pattern, recompiling it")
+    return re.compile(regex, flags)
+
+def matchesProbe(pattern, probe):
+    match = pattern.search(probe)
+    return match is not None and match.span() == (1, len(probe) - 1) and match.lastgroup is not None
+
+# A matcher without its compiled pattern, which is what gets pickled for the cache or to send to other processes.
+# (pickling a compiled regex saves the pattern string and recompiles it when it's loaded)
+def storableMatcher(matcher):
+    return {key: value for key, value in matcher.items() if key != 'pattern'}
+
+# Adds the compiled pattern back to a matcher from storableMatcher.
+# A few of the entries made of nothing but word characters are used to check a saved program still works.
+def restoreMatcher(stored):
+    pattern = None
+    if stored['regex'] is not None:
+        keys = [entry['key'] for entry in stored['entries'] if re.fullmatch(r'\w+', entry['key'])]
+        probes = [f' {key} ' for key in dict.fromkeys(keys[:1] + keys[len(keys) // 2:len(keys) // 2 + 1] + keys[-1:])]
+        pattern = loadRegexProgram(stored['regex'], re.IGNORECASE, stored['program'], probes)
+    return dict(stored, pattern=pattern)
+
+# Turns a trie node into a regex, longer continuations are tried before entries that end at this node
+def trieToRegex(node, entries):
+    branches = []
+    for char in sorted(k for k in node if k is not None):
+        branches.append(re.escape(char) + trieToRegex(node[char], entries))
+
+    terminals = node.get(None, {})
+    if 'word' in terminals:
+        index = terminals['word']
+        key = entries[index]['key']
+        # the equivalent of a \b at the start of the entry, looking back over the entry itself
+        startboundary = rf'(?<!\w[\s\S]{{{len(key)}}})' if re.match(r'\w', key[0]) else rf'(?<=\w[\s\S]{{{len(key)}}})'
+        branches.append(rf'\b{startboundary}(?P<e{index}>)')
+    if 'wildcard' in terminals:
+        branches.append(f'(?P<e{terminals["wildcard"]}>)')
+
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+# Runs every replacement in one pass over the text using a matcher from buildMatcher.
+# The text that has been replaced is never looked at again, so one mapping can't rewrite the output of another.
+# Adds the number of replacements made for each entry to counts, keyed by the 'beforeReplacement' value.
+# If a journal from openJournal is passed, every replacement is recorded in it.
+# If mappingstats is passed, the matches and time spent replacing them are added to it (see addMappingStats).
+def replaceStringsSinglePass(text, matcher, counts, journal=None, mappingstats=None):
+    if matcher['pattern'] is None:
+        return text
+
+    entries = matcher['entries']
+    entrycounts = [[0] for entry in entries]
+    entrystats = [[0, 0.0] for entry in entries] if mappingstats is not None else None
+
+    text = matcher['pattern'].sub(entryReplacer(entries, entrycounts, journal, entrystats), text)
+
+    addEntryCounts(entries, entrycounts, entrystats, counts, mappingstats)
+    return text
+
+# Makes the function that replaces each match in the single pass modes.
+# offset is where the text being searched starts in the whole input, for the journal.
+# Timing every match isn't free, so it's only done when entrystats ([matches, seconds] for each entry) is passed.
+def entryReplacer(entries, entrycounts, journal, entrystats):
+    def replaceEntry(match, offset=0):
+        index = int(match.lastgroup[1:])
+        result = replaceMatch(match, entries[index]['after'], entrycounts[index])
+        if journal is not None:
+            journalReplacement(journal, offset + match.start(), match.group(0), result)
+        return result
+
+    if entrystats is None:
+        return replaceEntry
+
+    def replaceEntryTimed(match, offset=0):
+        start = time.perf_counter()
+        result = replaceEntry(match, offset)
+        entrystat = entrystats[int(match.lastgroup[1:])]
+        entrystat[0] += 1
+        entrystat[1] += time.perf_counter() - start
+        return result
+    return replaceEntryTimed
+
+# Adds the counts (and stats, if they're being kept) for each matcher entry to the totals for each mapping
+def addEntryCounts(entries, entrycounts, entrystats, counts, mappingstats):
+    for index, entry in enumerate(entries):
+        counts[entry['before']] = counts.get(entry['before'], 0) + entrycounts[index][0]
+        if mappingstats is not None:
+            addMappingStats(mappingstats, entry['before'], entrystats[index][0], 0.0, entrystats[index][1])
+
+# Adds to the stats kept for a mapping in mappingstats, which is a dict of 'beforeReplacement' to
+# {'matches', 'compile_seconds', 'substitute_seconds'}
+def addMappingStats(mappingstats, before, matches, compileseconds, substituteseconds):
+    stats = mappingstats.setdefault(before, {'matches': 0, 'compile_seconds': 0.0, 'substitute_seconds': 0.0})
+    stats['matches'] += matches
+    stats['compile_seconds'] += compileseconds
+    stats['substitute_seconds'] += substituteseconds
+
+# Same as replaceStringsSinglePass, but reads from infile and writes to outfile a chunk at a time.
+# A match can't be trusted until the text after it has been read (it might become a longer match, or fail its
+# word boundary), so anything within one entry's length of the end of what's been read is held back for the next chunk.
+# The same amount of already written text is kept in front of it for the word boundary lookbehinds.
+# Returns the number of characters read.
+def replaceStreamSinglePass(infile, outfile, matcher, counts, chunksize, journal=None, mappingstats=None):
+    pattern = matcher['pattern']
+    entries = matcher['entries']
+    entrycounts = [[0] for entry in entries]
+    entrystats = [[0, 0.0] for entry in entries] if mappingstats is not None else None
+    replaceEntry = entryReplacer(entries, entrycounts, journal, entrystats)
+    overlap = matcher['longest'] + 1
+
+    buffer = ''
+    bufferstart = 0 # where buffer starts in the whole input
+    position = 0 # where the text that hasn't been written yet starts in buffer
+    final = False
+    while not final:
+        chunk = infile.read(chunksize)
+        final = not chunk
+        buffer += chunk
+        safe = len(buffer) if final else len(buffer) - overlap
+
+        pieces = []
+        while pattern:
+            match = pattern.search(buffer, position)
+            if match is None or match.start() >= safe:
+                break
+            pieces.append(buffer[position:match.start()])
+            pieces.append(replaceEntry(match, bufferstart))
+            position = match.end()
+
+        cut = max(position, safe)
+        pieces.append(buffer[position:cut])
+        outfile.write(''.join(pieces))
+
+        keepfrom = max(0, cut - overlap)
+        buffer = buffer[keepfrom:]
+        bufferstart += keepfrom
+        position = cut - keepfrom
+
+    addEntryCounts(entries, entrycounts, entrystats, counts, mappingstats)
+    return bufferstart + len(buffer)
+
+# Streams a text file through the single pass replacement, writing to outputFile as it goes.
+# Bails out of the script if either file can't be opened, same as readTextFile and writeOutputFile
+# If journalFile is passed, a journal of the replacements is written to it (and line endings are left alone)
+def streamReplaceFile(textFile, outputFile, replacements, reverse, chunksize, matcher=None, journalFile=None, mappingstats=None):
+    verboseprint(f'Attempting to stream {textFile} in chunks of {chunksize} characters')
+    replacement_counts = {}
+    if matcher is None:
+        matcher = buildMatcher(replacements)
+    newline = '' if journalFile else None
+    try:
+        with openTextFile(textFile, 'r', newline) as infile:
+            try:
+                with openTextFile(outputFile, 'w', newline) as outfile:
+                    journal = openJournal(journalFile) if journalFile else None
+                    length = replaceStreamSinglePass(infile, outfile, matcher, replacement_counts, chunksize, journal, mappingstats)
+                    if journal is not None:
+                        closeJournal(journal, length)
+            except OSError as e:
+                sys.exit(f"Error writing to output file: {e}")
+    except FileNotFoundError:
+        sys.exit(f"Text file '{textFile}' not found.")
+
+    verbosePrintCounts(replacements, replacement_counts, reverse)
+    return replacement_counts
+
+# ============= JOURNAL =============
+
+# A journal is a json lines file. The first line describes the journal, then there's one [offset, original, replacement]
+# line per replacement (offset being where the replacement starts in the output), and a last line with the lengths of
+# the input and output so an undo can tell if it was given the wrong file.
+JOURNAL_FORMAT = 1
+
+# Opens a journal file for writing and writes its header line.
+# Returns the journal, which keeps track of how far the output has drifted from the input so offsets can be worked out.
+def openJournal(journalFile):
+    verboseprint(f'Writing a journal of replacements to {journalFile}')
+    try:
+        f = open(journalFile, 'w', encoding='utf-8')
+    except OSError as e:
+        sys.exit(f"Error writing to journal file: {e}")
+    f.write(json.dumps({'journal': 'textReplacer', 'format': JOURNAL_FORMAT}) + '\n')
+    return {'file': f, 'shift': 0, 'replacements': 0}
+
+# Records one replacement, given where it was found in the input
+def journalReplacement(journal, inputoffset, original, replacement):
+    if original == replacement:
+        return
+    journal['file'].write(json.dumps([inputoffset + journal['shift'], original, replacement], ensure_ascii=False) + '\n')
+    journal['shift'] += len(replacement) - len(original)
+    journal['replacements'] += 1
+
+# Writes the journal's last line and closes it
+def closeJournal(journal, inputlength):
+    journal['file'].write(json.dumps({'input_length': inputlength, 'output_length': inputlength + journal['shift'], 'replacements': journal['replacements']}) + '\n')
+    journal['file'].close()
+    verboseprint(f"Journaled {journal['replacements']} replacements")
+
+# Copies length characters from infile to outfile, chunksize at a time. Returns how many were actually copied.
+def copyText(infile, outfile, length, chunksize):
+    copied = 0
+    while copied < length:
+        chunk = infile.read(min(chunksize, length - copied))
+        if not chunk:
+            break
+        outfile.write(chunk)
+        copied += len(chunk)
+    return copied
+
+# Undoes the replacements recorded in a journal in one pass over the text, streaming from textFile to outputFile.
+# Each replacement is checked against the text before it's undone, and bails out of the script if it doesn't match.
+def undoFromJournal(textFile, outputFile, journalFile, chunksize):
+    verboseprint(f'Undoing the replacements in {journalFile}')
+    try:
+        journalreader = open(journalFile, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        sys.exit(f"Journal file '{journalFile}' not found.")
+
+    with journalreader:
+        try:
+            header = json.loads(journalreader.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('journal') != 'textReplacer' or header.get('format') != JOURNAL_FORMAT:
+            sys.exit(f"'{journalFile}' isn't a textReplacer journal.")
+
+        try:
+            with openTextFile(textFile, 'r', '') as infile, openTextFile(outputFile, 'w', '') as outfile:
+                position = 0 # where we're up to in the replaced text
+                restoredlength = 0
+                footer = None
+                for line in journalreader:
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        footer = record
+                        break
+                    offset, original, replacement = record
+
+                    copied = copyText(infile, outfile, offset - position, chunksize)
+                    found = infile.read(len(replacement))
+                    if copied != offset - position or found != replacement:
+                        sys.exit(f"Text at offset {offset} of '{textFile}' doesn't match the journal (expected '{replacement}'). Is it the output the journal was written for?")
+                    outfile.write(original)
+                    position = offset + len(replacement)
+                    restoredlength += copied + len(original)
+
+                copied = copyText(infile, outfile, float('inf'), chunksize)
+                position += copied
+                restoredlength += copied
+        except FileNotFoundError:
+            sys.exit(f"Text file '{textFile}' not found.")
+        except OSError as e:
+            sys.exit(f"Error writing to output file: {e}")
+
+    if footer is None:
+        sys.exit(f"Journal '{journalFile}' is incomplete, the run that wrote it may not have finished.")
+    if position != footer['output_length'] or restoredlength != footer['input_length']:
+        sys.exit(f"'{textFile}' is {position} characters long, but the journal was written for {footer['output_length']} characters. The output may not be what was originally replaced.")
+    verboseprint(f"Undid {footer['replacements']} replacements")
+    return True
+
+# ============= CLOSE MATCHES =============
+
+# Edit distance (insertions, deletions and substitutions) between two strings.
+# Gives up and returns maxdistance + 1 as soon as it's clear the distance will be over maxdistance.
+def levenshteinDistance(a, b, maxdistance):
+    if abs(len(a) - len(b)) > maxdistance:
+        return maxdistance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, chara in enumerate(a, 1):
+        current = [i]
+        for j, charb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (chara != charb)))
+        if min(current) > maxdistance:
+            return maxdistance + 1
+        previous = current
+    return previous[-1]
+
+# Counts the bigrams in a word, padded at both ends so the first and last letters get their own
+def wordBigrams(word):
+    padded = f'\0{word}\0'
+    bigrams = {}
+    for i in range(len(padded) - 1):
+        bigram = padded[i:i + 2]
+        bigrams[bigram] = bigrams.get(bigram, 0) + 1
+    return bigrams
+
+# Builds a bigram index over a set of (lowercase) words, split up by word length so lookups only touch
+# words that are long or short enough to possibly be a close match.
+def buildWordIndex(words):
+    index = {}
+    for word in words:
+        postings = index.setdefault(len(word), {'words': [], 'bigrams': {}})
+        wordid = len(postings['words'])
+        postings['words'].append(word)
+        for bigram, count in wordBigrams(word).items():
+            postings['bigrams'].setdefault(bigram, []).append((wordid, count))
+    return index
+
+# Finds the words in a buildWordIndex index with a similarity of at least threshold to key.
+# Returns a dict of word to similarity.
+# A word within edit distance d of the key has to share at least max(length) + 1 - 2d bigrams with it
+# (each edit can break at most 2), which rules out most of the index before any edit distances get worked out.
+def findCloseWords(index, key, threshold):
+    closewords = {}
+    if not key:
+        return closewords
+    keybigrams = wordBigrams(key)
+
+    shortest = max(1, math.ceil(len(key) * threshold))
+    longest = math.floor(len(key) / threshold)
+    for length in range(shortest, longest + 1):
+        postings = index.get(length)
+        if postings is None:
+            continue
+        longer = max(len(key), length)
+        maxdistance = math.floor(longer * (1 - threshold) + 1e-9)
+        minshared = longer + 1 - 2 * maxdistance
+
+        if minshared > 0:
+            shared = {}
+            for bigram, keycount in keybigrams.items():
+                for wordid, wordcount in postings['bigrams'].get(bigram, ()):
+                    shared[wordid] = shared.get(wordid, 0) + min(keycount, wordcount)
+            candidates = [postings['words'][wordid] for wordid, count in shared.items() if count >= minshared]
+        else:
+            candidates = postings['words']
+
+        for word in candidates:
+            distance = levenshteinDistance(key, word, maxdistance)
+            if distance <= maxdistance:
+                closewords[word] = 1 - distance / longer
+    return closewords
+
+# Warns about words in the text that are similar to, but not the same as, a string being replaced.
+# Builds the vocabulary of the text once, looks every mapping up in an index of it, then reports the offset and
+# context of every occurrence of each close match in a second pass over the text.
+def printCloseMatchWarnings(text, replacements, threshold):
+    for warning in findCloseMatchWarnings(text, replacements, threshold):
+        print(warning)
+
+# Does the work for printCloseMatchWarnings, returning the warnings as a list of strings
+def findCloseMatchWarnings(text, replacements, threshold):
+    verboseprint(f"Checking for close matches with a similarity of at least {threshold}...")
+    vocabulary = set(word.lower() for word in re.findall(r'\b\w+\b', text))
+    index = buildWordIndex(vocabulary)
+
+    keys = set()
+    wildcards = set()
+    for before in replacements.keys():
+        if before.endswith("*"):
+            wildcards.add(before[:-1].lower())
+        else:
+            keys.add(before.lower())
+
+    # word -> (similarity, before) for the most similar mapping to each word
+    closematches = {}
+    for before in replacements.keys():
+        key = before[:-1] if before.endswith("*") else before
+        for word, similarity in findCloseWords(index, key.lower(), threshold).items():
+            # words that are going to be replaced anyway aren't worth warning about
+            if word in keys or any(wildcard and wildcard in word for wildcard in wildcards):
+                continue
+            if word not in closematches or similarity > closematches[word][0]:
+                closematches[word] = (similarity, before)
+    verboseprint(f"Found {len(closematches)} close matches among {len(vocabulary)} unique words.")
+
+    warnings = []
+    if not closematches:
+        return warnings
+    for match in re.finditer(r'\b\w+\b', text):
+        word = match.group(0).lower()
+        if word in closematches:
+            similarity, before = closematches[word]
+            context = text[max(0, match.start() - 30):min(len(text), match.end() + 30)]
+            warnings.append(f"Warning: Close match found at offset {match.start()}: '{match.group(0)}' (similar to '{before}', {similarity:.2f}). Context: '[...]{context}[...]'")
+    return warnings
+
+# Prints how many times each mapping was used if verbose is on
+def verbosePrintCounts(replacements, counts, reverse):
+    for before, after in replacements.items():
+        if reverse:
+            verboseprint(f"Replaced '{before}' with '{after}' (reverse), {counts.get(before, 0)} times.")
+        else:
+            verboseprint(f"Replaced '{before}' with '{after}', {counts.get(before, 0)} times.")
+
+def replaceStrings(text, replacements, reverse, close_match_warning, sequential=False, close_match_threshold=0.7, matcher=None, journal=None, mappingstats=None, counts=None):
     verboseprint("Starting string replacement...")
 
-    # A very basic check to see how much of a string matches one of the replacements.
     # Intent is to catch things like "enemy" and "enemies" which the user may have intended, but not captured
     if close_match_warning:
-        warned_matches = set()
-        for before in replacements.keys():
-            words = re.findall(r'\b\w+\b', text.lower())
-            for word in words:
-                if len(before) > 0 and len(word) > 0:
-                    similarity = sum(1 for a, b in zip(before.lower(), word) if a == b) / max(len(before), len(word))
-                    if similarity >= 0.7 and word != before.lower() and word not in warned_matches:
-                        index = text.lower().find(word)
-                        context = text[max(0, index - 30):min(len(text), index + 30)]
-                        print(f"Warning: Close match found: '{word}' (similar to '{before}'). Context: '[...]{context}[...]'")
-                        warned_matches.add(word)
+        printCloseMatchWarnings(text, replacements, close_match_threshold)
 
-    replacement_counts = {}
+    replacement_counts = counts if counts is not None else {}
 
-    # The actual finding and replacing logic...
+    if sequential:
+        text = replaceStringsSequential(text, replacements, replacement_counts, mappingstats)
+    else:
+        text = replaceStringsSinglePass(text, matcher if matcher is not None else buildMatcher(replacements), replacement_counts, journal, mappingstats)
+    verbosePrintCounts(replacements, replacement_counts, reverse)
+
+    return text
+
+# The legacy finding and replacing logic, one pass over the whole text per mapping...
+# Adds the number of replacements made for each mapping to counts, and the matches and time spent to mappingstats if passed
+def replaceStringsSequential(text, replacements, counts, mappingstats=None):
     for before, after in replacements.items():
         verboseprint(f'Starting on replacing "{before}" with "{after}"')
         count = [0]
+        matches = [0]
 
+        start = time.perf_counter()
         if before.endswith("*"): # handling for when the user had the wildcard specifier '*' at the end of a string in the csv
             before_base = before[:-1]
             escaped_before_base = re.escape(before_base)
-            text = re.sub(re.compile(escaped_before_base, re.IGNORECASE), lambda match: replaceMatch(match, after[:-1] if after.endswith("*") else after, count), text)
+            pattern = re.compile(escaped_before_base, re.IGNORECASE)
+            replacement = after[:-1] if after.endswith("*") else after
         else: # no wildcard
             escaped_before = re.escape(before)
-            text = re.sub(re.compile(rf"\b{escaped_before}\b", re.IGNORECASE), lambda match: replaceMatch(match, after, count), text)
+            pattern = re.compile(rf"\b{escaped_before}\b", re.IGNORECASE)
+            replacement = after
+        compiled = time.perf_counter()
 
-        replacement_counts[before] = count[0]
+        def replaceCounted(match):
+            matches[0] += 1
+            return replaceMatch(match, replacement, count)
+        text = pattern.sub(replaceCounted, text)
 
-        if reverse:
-            verboseprint(f"Replaced '{before}' with '{after}' (reverse), {count[0]} times.")
-        else:
-            verboseprint(f"Replaced '{before}' with '{after}', {count[0]} times.")
+        counts[before] = counts.get(before, 0) + count[0]
+        if mappingstats is not None:
+            addMappingStats(mappingstats, before, matches[0], compiled - start, time.perf_counter() - compiled)
 
     return text
 
+# ============= MAPPING CACHE =============
+
+# bump this whenever the layout of a cached matcher changes, so old cache files get ignored
+CACHE_FORMAT = 1
+
+# Cache files are named after a hash of the csv's contents plus everything else that changes what gets compiled,
+# so an edited csv (or a different python) just misses the cache rather than loading something stale.
+def mappingCacheKey(csvbytes, reverse):
+    key = hashlib.sha256(csvbytes)
+    key.update(f'|reverse={reverse}|format={CACHE_FORMAT}|python={sys.version}|sre={getattr(_sre, "MAGIC", None)}'.encode('utf-8'))
+    return key.hexdigest()
+
+# Reads the replacement mappings and compiled matcher for a csv from the cache, or reads and compiles the csv and saves
+# the result to the cache if it isn't there. Returns (replacements, matcher).
+def loadMappings(csvFile, reverse, cacheDir, cacheSize):
+    try:
+        with open(csvFile, 'rb') as f:
+            csvbytes = f.read()
+    except FileNotFoundError:
+        sys.exit(f"CSV file '{csvFile}' not found.")
+
+    cachefile = os.path.join(cacheDir, mappingCacheKey(csvbytes, reverse) + '.pickle')
+    try:
+        with open(cachefile, 'rb') as f:
+            cached = pickle.load(f)
+        # bump the modified time so eviction knows it was used recently
+        os.utime(cachefile)
+        verboseprint(f'Loaded compiled mappings for {csvFile} from {cachefile}')
+        return cached['replacements'], restoreMatcher(cached['matcher'])
+    except FileNotFoundError:
+        verboseprint(f'No cached mappings for {csvFile}, compiling them')
+    except Exception as e:
+        verboseprint(f'Ignoring unreadable cache file {cachefile}: {e}')
+
+    replacements = readCsvFile(csvFile, reverse)
+    matcher = buildMatcher(replacements)
+    writeMappingCache(cacheDir, cachefile, {'replacements': replacements, 'matcher': storableMatcher(matcher)}, cacheSize)
+    return replacements, matcher
+
+# Saves an entry to the cache, then removes the least recently used entries until the cache fits in cacheSize MB.
+# The cache is only ever a speed up, so problems writing to it are just reported in verbose mode.
+def writeMappingCache(cacheDir, cachefile, content, cacheSize):
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        # write to a temporary file first so another run never reads half a cache file
+        temporaryfile = f'{cachefile}.{os.getpid()}.tmp'
+        with open(temporaryfile, 'wb') as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporaryfile, cachefile)
+        verboseprint(f'Saved compiled mappings to {cachefile}')
+
+        cachefiles = []
+        for filename in os.listdir(cacheDir):
+            if filename.endswith('.pickle'):
+                stat = os.stat(os.path.join(cacheDir, filename))
+                cachefiles.append((stat.st_mtime, stat.st_size, os.path.join(cacheDir, filename)))
+        total = sum(size for mtime, size, path in cachefiles)
+        for mtime, size, path in sorted(cachefiles):
+            if total <= cacheSize * 1024 * 1024:
+                break
+            if path != cachefile:
+                verboseprint(f'Evicting {path} from the cache')
+                os.remove(path)
+                total -= size
+    except OSError as e:
+        verboseprint(f'Unable to write to the cache: {e}')
+
+# Removes everything from the cache directory
+def clearMappingCache(cacheDir):
+    if not os.path.isdir(cacheDir):
+        return
+    for filename in os.listdir(cacheDir):
+        if filename.endswith('.pickle') or filename.endswith('.tmp'):
+            os.remove(os.path.join(cacheDir, filename))
+    verboseprint(f'Cleared the cache in {cacheDir}')
+
+# ============= SERVICE =============
+
+# Everything the service shares between request threads. Tables are swapped out whole when they're reloaded, so a
+# request just grabs the current one and never sees a half loaded table.
+service = {'tables': {}, 'stats': {}, 'lock': threading.Lock(), 'started': time.time(), 'args': None}
+
+# Reads the mappings from a csv both ways round, so forward and reverse requests are both ready to go
+def loadServiceTable(csvFile, args):
+    table = {'csv': csvFile, 'mtime': os.stat(csvFile).st_mtime, 'loaded': datetime.now().isoformat(timespec='seconds')}
+    for direction, reverse in (('forward', False), ('reverse', True)):
+        if args.no_cache:
+            replacements = readCsvFile(csvFile, reverse)
+            table[direction] = (replacements, buildMatcher(replacements))
+        else:
+            table[direction] = loadMappings(csvFile, reverse, args.cache_dir, args.cache_size)
+    return table
+
+# Checks the table csv files every interval seconds and reloads any that have changed.
+# A csv that can't be read (e.g. half saved) leaves the previous version of the table in place.
+def watchServiceTables(interval):
+    while True:
+        time.sleep(interval)
+        for name, table in list(service['tables'].items()):
+            try:
+                if os.stat(table['csv']).st_mtime == table['mtime']:
+                    continue
+                newtable = loadServiceTable(table['csv'], service['args'])
+            except (Exception, SystemExit) as e:
+                print(f"Unable to reload table '{name}' from {table['csv']}: {e}", flush=True)
+                continue
+            service['tables'][name] = newtable
+            print(f"Reloaded table '{name}' from {table['csv']}", flush=True)
+
+# Adds one request to the stats for a table. Only the last 10000 latencies are kept for the percentiles.
+def recordServiceRequest(name, seconds, bytesin, bytesout, failed):
+    with service['lock']:
+        stats = service['stats'].setdefault(name, {'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'latencies': []})
+        stats['requests'] += 1
+        stats['errors'] += failed
+        stats['bytes_in'] += bytesin
+        stats['bytes_out'] += bytesout
+        stats['seconds'] += seconds
+        stats['latencies'].append(seconds)
+        if len(stats['latencies']) > 10000:
+            del stats['latencies'][:1000]
+
+# Summarizes the request stats for GET /stats
+def serviceStats():
+    uptime = time.time() - service['started']
+    summary = {'uptime_seconds': round(uptime, 3), 'tables': {}}
+    with service['lock']:
+        for name, table in service['tables'].items():
+            stats = service['stats'].get(name, {'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'latencies': []})
+            latencies = sorted(stats['latencies'])
+            percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+            summary['tables'][name] = {'csv': table['csv'], 'loaded': table['loaded'],
+                'mappings': len(table['forward'][0]),
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'requests_per_second': round(stats['requests'] / uptime, 3),
+                'bytes_in': stats['bytes_in'],
+                'bytes_out': stats['bytes_out'],
+                'megabytes_per_busy_second': round(stats['bytes_in'] / stats['seconds'] / 1024 / 1024, 3) if stats['seconds'] else None,
+                'latency_ms': {'mean': round(stats['seconds'] / stats['requests'] * 1000, 3) if stats['requests'] else None,
+                    'p50': round(percentiles[49] * 1000, 3) if percentiles else None,
+                    'p99': round(percentiles[98] * 1000, 3) if percentiles else None,
+                    'max': round(latencies[-1] * 1000, 3) if latencies else None}}
+    return summary
+
+# Handles requests to the service:
+#    POST /replace?table=NAME[&reverse=1][&sequential=1][&close_match_threshold=0.7] with the text as the body,
+#        answered with json holding the replaced text, replacement counts and any close match warnings
+#    GET /stats for the request counters
+class ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != '/stats':
+            return self.sendJson(404, {'error': 'Not found'})
+        self.sendJson(200, serviceStats())
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        name = params.get('table', 'default')
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            return self.sendJson(411, {'error': 'Content-Length is required'})
+        if not length.strip().isdigit():
+            self.close_connection = True
+            return self.sendJson(400, {'error': 'Content-Length must be a number of bytes'})
+        body = self.rfile.read(int(length))
+
+        if url.path != '/replace':
+            return self.sendJson(404, {'error': 'Not found'})
+        table = service['tables'].get(name)
+        if table is None:
+            return self.sendJson(404, {'error': f"No table named '{name}'"})
+
+        # checked the same way as the command line arguments, with the same messages
+        closematchthreshold = None
+        error = None
+        if 'close_match_threshold' in params:
+            try:
+                closematchthreshold = float(params['close_match_threshold'])
+            except ValueError:
+                closematchthreshold = float('nan')
+            if not 0 < closematchthreshold <= 1:
+                error = "--close_match_threshold must be greater than 0 and at most 1"
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            error = "The text must be UTF-8"
+        if error is not None:
+            recordServiceRequest(name, time.perf_counter() - start, len(body), 0, True)
+            return self.sendJson(400, {'error': error})
+
+        try:
+            replacements, matcher = table['reverse' if params.get('reverse') == '1' else 'forward']
+            warnings = findCloseMatchWarnings(text, replacements, closematchthreshold) if closematchthreshold is not None else []
+            counts = {}
+            if params.get('sequential') == '1':
+                text = replaceStringsSequential(text, replacements, counts)
+            else:
+                text = replaceStringsSinglePass(text, matcher, counts)
+        except Exception:
+            # the details go to the service's log rather than back to the client
+            self.log_error('%s', traceback.format_exc())
+            recordServiceRequest(name, time.perf_counter() - start, len(body), 0, True)
+            return self.sendJson(500, {'error': 'Unable to replace the text'})
+
+        seconds = time.perf_counter() - start
+        response = self.sendJson(200, {'text': text, 'counts': counts, 'warnings': warnings, 'seconds': seconds})
+        recordServiceRequest(name, seconds, len(body), response, False)
+
+    # Sends a json response, returning the size of the body
+    def sendJson(self, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    # unix socket clients don't have an address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        verboseprint(f'{self.address_string()} - {format % args}')
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Loads the tables and serves requests until stopped
+def runService(args):
+    service['args'] = args
+    tables = dict(table.split('=', 1) for table in (args.table or []))
+    if args.csv:
+        tables.setdefault('default', args.csv)
+    for name, csvFile in tables.items():
+        if not os.path.exists(csvFile):
+            sys.exit(f"CSV file '{csvFile}' not found.")
+        service['tables'][name] = loadServiceTable(csvFile, args)
+        print(f"Loaded table '{name}' from {csvFile} ({len(service['tables'][name]['forward'][0])} mappings)", flush=True)
+
+    threading.Thread(target=watchServiceTables, args=(args.reload_interval,), daemon=True).start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, ServiceRequestHandler)
+        print(f"Serving on unix socket {args.socket}", flush=True)
+    else:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), ServiceRequestHandler)
+        print(f"Serving on http://127.0.0.1:{args.port}", flush=True)
+
+    with server:
+        server.serve_forever()
+
+# An HTTP connection over a unix socket, for talking to a service started with --socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.socketpath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socketpath)
+
+# Sends text to a running service to be replaced. Returns the service's json response.
+# Bails out of the script if the service can't be reached or turns the request down.
+def requestReplacement(server, table, text, reverse, sequential, closematchthreshold):
+    params = {'table': table}
+    if reverse:
+        params['reverse'] = '1'
+    if sequential:
+        params['sequential'] = '1'
+    if closematchthreshold is not None:
+        params['close_match_threshold'] = str(closematchthreshold)
+
+    if server.startswith('unix:'):
+        connection = UnixHTTPConnection(server[len('unix:'):])
+    else:
+        url = urllib.parse.urlsplit(server if '//' in server else 'http://' + server)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 8750)
+
+    verboseprint(f'Sending {len(text)} characters to {server}')
+    try:
+        connection.request('POST', '/replace?' + urllib.parse.urlencode(params), body=text.encode('utf-8'), headers={'Content-Type': 'text/plain; charset=utf-8'})
+        response = connection.getresponse()
+        content = json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        sys.exit(f"Unable to reach the service at {server}: {e}")
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        sys.exit(f"The service at {server} couldn't replace the text: {content.get('error')}")
+    verboseprint(f"Service took {content['seconds'] * 1000:.1f} ms")
+    return content
+
+# ============= WATCH =============
+
+# Roughly how many characters of input each piece of a watched file's output covers.
+# An edit only redoes the pieces it touches (and rewrites the output file from the first of them on).
+WATCH_SEGMENT_SIZE = 64 * 1024
+
+# Whether the single pass scan ends up somewhere depends on the text from one character before it to the length of the
+# longest mapping after it (word boundaries and the lookbehinds in trieToRegex), so a scan started anywhere the full scan
+# would have been looking for a new match, and with the same text around it, carries on exactly like the full scan.
+
+# Runs the single pass replacement over text from start, which has to be a place the full scan would look for a new match.
+# The output is split up into segments of about WATCH_SEGMENT_SIZE characters, each starting at such a place.
+# stops is a sorted list of places the scan can stop at, from stopfrom on, because the output from there is already known.
+# Returns the list of [segment start, segment output] and where it stopped (the end of the text if it didn't).
+def replaceSegments(text, start, matcher, counts, stops=(), stopfrom=None):
+    entries = matcher['entries']
+    entrycounts = [[0] for entry in entries]
+    replaceEntry = entryReplacer(entries, entrycounts, None, None)
+    matches = matcher['pattern'].finditer(text, start) if matcher['pattern'] is not None else iter(())
+    stopindex = bisect.bisect_left(stops, stopfrom) if stopfrom is not None else len(stops)
+
+    segments = []
+    pieces = []
+    segmentstart = position = start
+    while True:
+        match = next(matches, None)
+        nextstart = match.start() if match is not None else len(text)
+
+        # every place from position to nextstart is somewhere the scan looks for a new match
+        while stopindex < len(stops) and stops[stopindex] < position:
+            stopindex += 1
+        stop = stops[stopindex] if stopindex < len(stops) and stops[stopindex] <= nextstart else None
+        limit = nextstart if stop is None else stop
+
+        while max(position, segmentstart + WATCH_SEGMENT_SIZE) < limit:
+            cut = max(position, segmentstart + WATCH_SEGMENT_SIZE)
+            pieces.append(text[position:cut])
+            segments.append([segmentstart, ''.join(pieces)])
+            pieces = []
+            segmentstart = position = cut
+
+        pieces.append(text[position:limit])
+        position = limit
+        if stop is not None or match is None:
+            break
+        pieces.append(replaceEntry(match))
+        position = match.end()
+
+    if position > segmentstart or not segments:
+        segments.append([segmentstart, ''.join(pieces)])
+    addEntryCounts(entries, entrycounts, None, counts, None)
+    return segments, position
+
+# Output segments are kept as the bytes written to the file, so the file can be rewritten from any segment on
+def encodeSegments(segments):
+    for segment in segments:
+        output = segment[1] if os.linesep == '\n' else segment[1].replace('\n', os.linesep)
+        segment[1] = output.encode('utf-8')
+    return segments
+
+# Brings a watched file's output up to date with its new text.
+# The text is compared with the last version processed, and only the segments from just before the first change up to
+# the first place after the last change where the scan lines up with last time are replaced again. Without any previous
+# state (or after the mappings change) the whole text is done. Returns the number of characters replaced again.
+def updateWatchedFile(state, text, matcher, counts):
+    oldtext = state.get('text')
+    segments = state.get('segments')
+    if oldtext is None or segments is None:
+        state['text'], state['segments'] = text, encodeSegments(replaceSegments(text, 0, matcher, counts)[0])
+        state['first'] = 0
+        return len(text)
+
+    prefix = commonPrefixLength(oldtext, text)
+    suffix = commonSuffixLength(oldtext, text, min(len(oldtext), len(text)) - prefix)
+    delta = len(text) - len(oldtext)
+
+    # the last segment starting somewhere the scan isn't affected by the edit
+    starts = [segment[0] for segment in segments]
+    first = max(bisect.bisect_right(starts, max(prefix - matcher['longest'], 0)) - 1, 0)
+    stops = [segstart + delta for segstart in starts[first + 1:]]
+    stopfrom = len(text) - suffix + 1
+
+    newsegments, stopped = replaceSegments(text, starts[first], matcher, counts, stops, stopfrom)
+    rest = segments[bisect.bisect_left(starts, stopped - delta):] if stopped < len(text) else []
+    for segment in rest:
+        segment[0] += delta
+
+    state['text'] = text
+    state['segments'] = segments[:first] + encodeSegments(newsegments) + rest
+    state['first'] = first
+    return stopped - starts[first]
+
+# Length of the part at the start of a and b that's the same, found by comparing halves so it's done at memcmp speed
+def commonPrefixLength(a, b):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# Length of the part at the end of a and b that's the same, up to limit
+def commonSuffixLength(a, b, limit):
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:len(a) - low] == b[len(b) - middle:len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# Writes a watched file's output. Only the segments from the first one that changed on are written, unless the output
+# file isn't what was written last time, in which case it's written from scratch.
+def writeWatchedOutput(state, outputFile):
+    segments = state['segments']
+    first = state['first']
+    offset = sum(len(segment[1]) for segment in segments[:first])
+    try:
+        if first == 0 or state.get('written') != (outputFile, os.path.getsize(outputFile)):
+            first, offset = 0, 0
+        with open(outputFile, 'r+b' if first else 'wb') as f:
+            f.seek(offset)
+            f.writelines(segment[1] for segment in segments[first:])
+            f.truncate()
+            state['written'] = (outputFile, f.tell())
+    except OSError as e:
+        sys.exit(f"Error writing to output file: {e}")
+
+# Loads the mappings for --watch, or returns None if the csv can't be read (e.g. it's half saved)
+def loadWatchMappings(args):
+    try:
+        if args.no_cache:
+            replacements = readCsvFile(args.csv, args.reverse)
+            return replacements, buildMatcher(replacements)
+        return loadMappings(args.csv, args.reverse, args.cache_dir, args.cache_size)
+    except (Exception, SystemExit) as e:
+        print(f"Unable to load mappings from {args.csv}: {e}", flush=True)
+        return None
+
+# Watches the --text file (or --batch files) and the csv, updating the output every time one of them is saved.
+# Edits to a text file only redo the part of the output around them (see updateWatchedFile), a change to the csv redoes everything.
+def watchFiles(args, outputFile, replacements, matcher):
+    csvmtime = os.stat(args.csv).st_mtime_ns
+    watched = {}
+    print(f"Watching for changes every {args.reload_interval} seconds, press Ctrl+C to stop.", flush=True)
+
+    while True:
+        if args.batch:
+            try:
+                files = [(inputpath, os.path.join(outputFile, relativepath)) for inputpath, relativepath in collectBatchFiles(args.batch)]
+            except SystemExit as e:
+                print(e, flush=True)
+                files = []
+        else:
+            files = [(args.text, outputFile)]
+
+        for inputpath, outputpath in files:
+            state = watched.setdefault(inputpath, {})
+            try:
+                stat = os.stat(inputpath)
+                if state.get('mtime') == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                with openTextFile(inputpath, 'r') as f:
+                    text = f.read()
+            except OSError:
+                # editors often replace the file when saving, so it can briefly not be there
+                continue
+            state['mtime'] = (stat.st_mtime_ns, stat.st_size)
+            if text == state.get('text'):
+                continue
+
+            starttime = time.perf_counter()
+            counts = {}
+            replaced = updateWatchedFile(state, text, matcher, counts)
+            if args.close_match_warning:
+                printCloseMatchWarnings(text, replacements, args.close_match_threshold)
+            if args.batch:
+                os.makedirs(os.path.dirname(outputpath), exist_ok=True)
+            writeWatchedOutput(state, outputpath)
+            print(f"Updated '{outputpath}' ({replaced} of {len(text)} characters replaced again, {sum(counts.values())} replacements) in {time.perf_counter() - starttime:.3f} seconds.", flush=True)
+
+        time.sleep(args.reload_interval)
+
+        try:
+            mtime = os.stat(args.csv).st_mtime_ns
+        except OSError:
+            continue
+        if mtime != csvmtime:
+            loaded = loadWatchMappings(args)
+            if loaded is not None:
+                csvmtime = mtime
+                replacements, matcher = loaded
+                # everything has to be done again with the new mappings
+                for state in watched.values():
+                    state.pop('segments', None)
+                    state.pop('mtime', None)
+                    state.pop('text', None)
+                print(f"Reloaded mappings from {args.csv}", flush=True)
+
+# ============= BATCH PROCESSING =============
+
+# Finds every file to process for --batch. Each path can be a file, a directory (walked recursively) or a glob.
+# Returns a list of (input path, path relative to where it was found) so the output can mirror the input tree.
+def collectBatchFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    files.append((filepath, os.path.relpath(filepath, path)))
+        elif any(char in path for char in '*?['):
+            # paths are relative to the part of the glob before the first wildcard
+            basedir = []
+            for part in path.split(os.sep):
+                if any(char in part for char in '*?['):
+                    break
+                basedir.append(part)
+            basedir = os.sep.join(basedir) or '.'
+            for filepath in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(filepath):
+                    files.append((filepath, os.path.relpath(filepath, basedir)))
+        elif os.path.isfile(path):
+            files.append((path, os.path.basename(path)))
+        else:
+            sys.exit(f"Batch path '{path}' not found.")
+
+    seen = {}
+    for filepath, relativepath in files:
+        if relativepath in seen and seen[relativepath] != filepath:
+            sys.exit(f"Batch files '{seen[relativepath]}' and '{filepath}' would both be written to '{relativepath}'.")
+        seen[relativepath] = filepath
+
+    return list(dict.fromkeys(files))
+
+# Sets up a batch worker process. The mappings are loaded and compiled once in the main process and handed over here,
+# so each worker only pays for that once rather than once per file.
+def batchWorkerSetup(settings, verbosestate):
+    global verboseprint, verbosematches, batchsettings
+    verboseprint = verbosePrintSetup(verbosestate)
+    verbosematches = verbosestate
+    batchsettings = dict(settings)
+    if batchsettings['matcher'] is not None and 'pattern' not in batchsettings['matcher']:
+        batchsettings['matcher'] = restoreMatcher(batchsettings['matcher'])
+
+# Runs the replacements over one file for --batch
+# Returns the number of replacements made for each mapping, the mapping stats (if they're being kept), the sizes of
+# the input and output files, and why the file was skipped if it couldn't be read or written (None otherwise). A file that fails doesn't leave
+# any output behind, and doesn't stop the rest of the batch.
+def replaceBatchFile(paths):
+    inputpath, outputpath = paths
+    verboseprint(f'Processing {inputpath} -> {outputpath}')
+    counts = {}
+    mappingstats = {} if batchsettings['stats'] else None
+    outputopened = False
+
+    try:
+        os.makedirs(os.path.dirname(outputpath), exist_ok=True)
+        with open(inputpath, 'r', encoding='utf-8') as infile:
+            if batchsettings['stream']:
+                # streamed files are written as they're read, so a decode error part way through leaves a partial file
+                outputopened = True
+                with open(outputpath, 'w', encoding='utf-8') as outfile:
+                    replaceStreamSinglePass(infile, outfile, batchsettings['matcher'], counts, batchsettings['chunksize'], None, mappingstats)
+            else:
+                text = infile.read()
+                if batchsettings['sequential']:
+                    replacedText = replaceStringsSequential(text, batchsettings['replacements'], counts, mappingstats)
+                else:
+                    replacedText = replaceStringsSinglePass(text, batchsettings['matcher'], counts, None, mappingstats)
+                outputopened = True
+                with open(outputpath, 'w', encoding='utf-8') as outfile:
+                    outfile.write(replacedText)
+    except (UnicodeDecodeError, OSError) as e:
+        if outputopened and os.path.exists(outputpath):
+            os.remove(outputpath)
+        return {}, None, 0, 0, str(e)
+
+    return counts, mappingstats, os.path.getsize(inputpath), os.path.getsize(outputpath), None
+
+# Runs the replacements over every file found by collectBatchFiles, spread across a pool of worker processes.
+# Output files are written under outputDir with the same relative paths as the input.
+# Returns the number of files processed, the total number of replacements made for each mapping across all of them,
+# the combined mapping stats if args.stats is set, the total sizes of the files read and of the files written, and a
+# list of (path, reason) for the files that were skipped because they couldn't be read or written
+def replaceBatch(paths, outputDir, replacements, args, matcher=None):
+    files = collectBatchFiles(paths)
+    verboseprint(f'Found {len(files)} files to process with {args.workers} workers')
+
+    if matcher is None and not args.sequential:
+        matcher = buildMatcher(replacements)
+    settings = {'replacements': replacements,
+        'matcher': matcher,
+        'sequential': args.sequential,
+        'stream': args.stream,
+        'chunksize': args.chunk_size,
+        'stats': bool(args.stats)}
+    jobs = [(inputpath, os.path.join(outputDir, relativepath)) for inputpath, relativepath in files]
+
+    totals = {}
+    totalstats = {} if args.stats else None
+    totalbytes = [0, 0]
+    skipped = []
+    def addCounts(job, result):
+        counts, mappingstats, inputbytes, outputbytes, error = result
+        if error is not None:
+            verboseprint(f'Skipping {job[0]}: {error}')
+            skipped.append((job[0], error))
+            return
+        for before, count in counts.items():
+            totals[before] = totals.get(before, 0) + count
+        for before, stats in (mappingstats or {}).items():
+            addMappingStats(totalstats, before, stats['matches'], stats['compile_seconds'], stats['substitute_seconds'])
+        totalbytes[0] += inputbytes
+        totalbytes[1] += outputbytes
+
+    if args.workers == 1 or len(jobs) <= 1:
+        batchWorkerSetup(settings, args.verbose)
+        for job in jobs:
+            addCounts(job, replaceBatchFile(job))
+    else:
+        # hand out files a few at a time, otherwise tens of thousands of small files are dominated by the back and forth
+        chunksize = max(1, min(64, len(jobs) // (args.workers * 4)))
+        settings['matcher'] = storableMatcher(matcher) if matcher is not None else None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=batchWorkerSetup, initargs=(settings, args.verbose)) as executor:
+            for job, result in zip(jobs, executor.map(replaceBatchFile, jobs, chunksize=chunksize)):
+                addCounts(job, result)
+
+    return len(jobs) - len(skipped), totals, totalstats, totalbytes[0], totalbytes[1], skipped
+
 # ============= CONSOLE OUTPUT =============
 
+# whether replaceMatch logs each match, which is turned on with verbose
+verbosematches = False
+
 # establishes either a functional print with timestamp if `verbosesate` is true,
 # or does nothing with the passed information if false.
 def verbosePrintSetup(verbosestate):
@@ -161,27 +1326,220 @@ def verbosePrintSetup(verbosestate):
         verboseprintfunc = lambda *a: None
     return verboseprintfunc
 
+# Prints the total number of replacements for each mapping after a --batch run
+def printBatchSummary(replacements, totals, filecount, elapsed, skipped=()):
+    print(f"Processed {filecount} files in {elapsed:.2f} seconds. Replacements made:")
+    for before, after in replacements.items():
+        print(f"    '{before}' -> '{after}': {totals.get(before, 0)}")
+    if skipped:
+        print(f"Skipped {len(skipped)} files that couldn't be processed:")
+        for path, error in skipped:
+            print(f"    {path}: {error}")
+
+# ============= STATISTICS =============
+
+# Peak memory use in KB of this process, and of any batch workers that have finished, or None if it can't be measured
+def peakMemoryKb():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # macOS reports bytes rather than KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+# Puts together the statistics for --stats from the timings of each stage and what was recorded for each mapping
+def buildRunStats(mode, replacements, counts, mappingstats, seconds, inputbytes, outputbytes, files=1):
+    replacing = seconds.get('replace', 0.0)
+    mappings = []
+    for before, after in replacements.items():
+        stats = mappingstats.get(before, {'matches': 0, 'compile_seconds': 0.0, 'substitute_seconds': 0.0})
+        mappings.append({'before': before, 'after': after,
+            'matches': stats['matches'],
+            'replacements': counts.get(before, 0),
+            'compile_seconds': round(stats['compile_seconds'], 6),
+            'substitute_seconds': round(stats['substitute_seconds'], 6)})
+
+    return {'mode': mode,
+        'files': files,
+        'mappings_count': len(replacements),
+        'input_bytes': inputbytes,
+        'output_bytes': outputbytes,
+        'seconds': {stage: round(value, 6) for stage, value in seconds.items()},
+        'throughput_mb_per_second': round(inputbytes / replacing / 1024 / 1024, 3) if inputbytes is not None and replacing else None,
+        'peak_memory_kb': peakMemoryKb(),
+        'matches': sum(mapping['matches'] for mapping in mappings),
+        'replacements': sum(mapping['replacements'] for mapping in mappings),
+        'mappings': mappings}
+
+# Writes the --stats output as json, or as csv with a row per mapping followed by a row with the overall numbers
+# Prints it if statsFile is '-'
+def writeStats(statsFile, stats, statsformat):
+    if statsformat == 'csv':
+        columns = ['before', 'after', 'matches', 'replacements', 'compile_seconds', 'substitute_seconds']
+        totalcolumns = ['mode', 'files', 'input_bytes', 'output_bytes', 'throughput_mb_per_second', 'peak_memory_kb']
+        stagecolumns = [f'{stage}_seconds' for stage in stats['seconds']]
+        rows = [dict(mapping) for mapping in stats['mappings']]
+        totalrow = {'before': '(total)', 'matches': stats['matches'], 'replacements': stats['replacements']}
+        totalrow.update({column: stats[column] for column in totalcolumns})
+        totalrow.update({f'{stage}_seconds': value for stage, value in stats['seconds'].items()})
+        rows.append(totalrow)
+
+    try:
+        with contextlib.nullcontext(sys.stdout) if statsFile == '-' else open(statsFile, 'w', encoding='utf-8', newline='') as f:
+            if statsformat == 'csv':
+                writer = csv.DictWriter(f, fieldnames=columns + totalcolumns + stagecolumns)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(stats, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+    except OSError as e:
+        sys.exit(f"Error writing to stats file: {e}")
+
 
 # ============= EXECUTION =============
 def run():
     args = parser.parse_args()
 
-    global verboseprint
-    verboseprint = verbosePrintSetup(args.verbose)
-
-    text = readTextFile(args.text)
-    replacements = readCsvFile(args.csv, args.reverse)
-    
-    replacedText = replaceStrings(text, replacements, args.reverse, args.close_match_warning)
+    if args.serve:
+        if args.text or args.batch or args.server:
+            parser.error("--serve can't be combined with --text, --batch or --server")
+        if not args.csv and not args.table:
+            parser.error("--serve needs -c/--csv or at least one --table NAME=CSV_PATH")
+        if any('=' not in table for table in args.table or []):
+            parser.error("--table should be NAME=CSV_PATH with --serve")
+    elif not args.text and not args.batch:
+        parser.error("one of the arguments -t/--text -b/--batch is required")
+    if args.server and (args.batch or args.stream or args.journal or args.undo):
+        parser.error("--server can't be combined with --batch, --stream, --journal or --undo")
+    if args.server and args.table and len(args.table) > 1:
+        parser.error("only one --table can be used with --server")
+    if not args.csv and not args.undo and not args.server and not args.serve:
+        parser.error("the following arguments are required: -c/--csv")
+    if args.undo and (args.batch or args.journal or args.text is None):
+        parser.error("--undo works on a single --text file and can't be combined with --batch or --journal")
+    if args.journal and (args.batch or args.sequential):
+        parser.error("--journal can't be combined with --batch or --sequential")
+    if args.stream and (args.sequential or args.close_match_warning):
+        parser.error("--stream can't be combined with --sequential or --close_match_warning")
+    if args.batch and (args.close_match_warning or args.output == '-'):
+        parser.error("--batch can't be combined with --close_match_warning or writing to stdout")
+    if args.watch and (args.text == '-' or args.output == '-' or args.sequential or args.stream or args.journal or args.undo or args.server or args.serve or args.stats):
+        parser.error("--watch can't be used with stdin or stdout, --sequential, --stream, --journal, --undo, --server, --serve or --stats")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.cache_size < 0:
+        parser.error("--cache_size can't be negative")
+    if args.chunk_size < 1:
+        parser.error("--chunk_size must be at least 1")
+    if not 0 < args.close_match_threshold <= 1:
+        parser.error("--close_match_threshold must be greater than 0 and at most 1")
 
     if not args.output:
         timestampStr = datetime.now().strftime("%Y%m%d_%H%M%S")
-        outputFile = os.path.join("/tmp", f"replaced_text_{timestampStr}.txt")
+        outputFile = os.path.join("/tmp", f"replaced_text_{timestampStr}" + ("" if args.batch else ".txt"))
     else:
         outputFile = args.output
 
-    if writeOutputFile(outputFile, replacedText):
-        print(f"String replacement completed. Output saved to '{outputFile}'.")
+    # when the output is going to stdout, keep everything else out of it so the script can be used in a pipeline
+    with contextlib.redirect_stdout(sys.stderr if outputFile == '-' else sys.stdout):
+        global verboseprint, verbosematches
+        verboseprint = verbosePrintSetup(args.verbose)
+        verbosematches = args.verbose
+
+        if args.clear_cache:
+            clearMappingCache(args.cache_dir)
+
+        if args.serve:
+            runService(args)
+            return
+
+        if args.server:
+            text = readTextFile(args.text)
+            response = requestReplacement(args.server, args.table[0] if args.table else 'default', text, args.reverse, args.sequential, args.close_match_threshold if args.close_match_warning else None)
+            for warning in response['warnings']:
+                print(warning)
+            for before, count in response['counts'].items():
+                verboseprint(f"Replaced '{before}' {count} times{' (reverse)' if args.reverse else ''}.")
+            if writeOutputFile(outputFile, response['text']) and outputFile != '-':
+                print(f"String replacement completed. Output saved to '{outputFile}'.")
+            return
+
+        if args.undo:
+            if undoFromJournal(args.text, outputFile, args.undo, args.chunk_size) and outputFile != '-':
+                print(f"Undo completed. Output saved to '{outputFile}'.")
+            return
+
+        # how long each stage took, for --stats
+        seconds = {}
+        mappingstats = {} if args.stats else None
+        starttime = time.perf_counter()
+
+        # the sequential mode compiles each mapping as it goes, so there's nothing worth caching
+        if args.no_cache or args.sequential:
+            replacements = readCsvFile(args.csv, args.reverse)
+            seconds['read_csv'] = time.perf_counter() - starttime
+            matcher = None
+            if not args.sequential:
+                matcher = buildMatcher(replacements)
+                seconds['compile'] = time.perf_counter() - starttime - seconds['read_csv']
+        else:
+            replacements, matcher = loadMappings(args.csv, args.reverse, args.cache_dir, args.cache_size)
+            seconds['load_mappings'] = time.perf_counter() - starttime
+
+        if args.watch:
+            watchFiles(args, outputFile, replacements, matcher)
+            return
+
+        # batch runs are labelled with the mode each file was replaced in, e.g. batch_stream
+        mode = 'stream' if args.stream else 'sequential' if args.sequential else 'single_pass'
+        files = 1
+        stagestart = time.perf_counter()
+        if args.batch:
+            mode = 'batch_' + mode
+            files, counts, batchstats, inputbytes, batchoutputbytes, skipped = replaceBatch(args.batch, outputFile, replacements, args, matcher)
+            seconds['replace'] = time.perf_counter() - stagestart
+            printBatchSummary(replacements, counts, files, seconds['replace'], skipped)
+            if mappingstats is not None:
+                mappingstats.update(batchstats)
+            completed = True
+        elif args.stream:
+            counts = streamReplaceFile(args.text, outputFile, replacements, args.reverse, args.chunk_size, matcher, args.journal, mappingstats)
+            seconds['replace'] = time.perf_counter() - stagestart
+            inputbytes = os.path.getsize(args.text) if args.text != '-' else None
+            completed = True
+        else:
+            # a journal has to be able to put back exactly what was there, so line endings are left alone
+            newline = '' if args.journal else None
+            text = readTextFile(args.text, newline)
+            seconds['read_text'] = time.perf_counter() - stagestart
+            inputbytes = (os.path.getsize(args.text) if args.text != '-' else len(text.encode('utf-8'))) if args.stats else None
+
+            stagestart = time.perf_counter()
+            journal = openJournal(args.journal) if args.journal else None
+            counts = {}
+            replacedText = replaceStrings(text, replacements, args.reverse, args.close_match_warning, args.sequential, args.close_match_threshold, matcher, journal, mappingstats, counts)
+            if journal is not None:
+                closeJournal(journal, len(text))
+            seconds['replace'] = time.perf_counter() - stagestart
+
+            stagestart = time.perf_counter()
+            completed = writeOutputFile(outputFile, replacedText, newline)
+            seconds['write_output'] = time.perf_counter() - stagestart
+
+        if args.stats:
+            seconds['total'] = time.perf_counter() - starttime
+            if args.batch:
+                # just the files this run wrote, not anything else that was already in the output directory
+                outputbytes = batchoutputbytes
+            else:
+                outputbytes = os.path.getsize(outputFile) if outputFile != '-' else None
+            writeStats(args.stats, buildRunStats(mode, replacements, counts, mappingstats, seconds, inputbytes, outputbytes, files), args.stats_format or ('csv' if args.stats.endswith('.csv') else 'json'))
+
+        if args.batch and skipped:
+            sys.exit(f"{len(skipped)} of {files + len(skipped)} files were skipped. Output for the rest saved to '{outputFile}'.")
+
+        if completed and outputFile != '-':
+            print(f"String replacement completed. Output saved to '{outputFile}'.")
 
 def main():
     try: